@@ -4,12 +4,11 @@ from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import SimpleITK as sitk
-import sitkUtils
 import numpy
-import scipy
-import math
 import copy
-from skimage.restoration import unwrap_phase
+import threading
+import time
+from PRFThermometryLib import Baselines, Batch, Engine, Parallel, Phantom, Profiling, RealTime, Streaming, Unwrapping, VolumeIO
 
 #
 # PRFThermometry
@@ -246,6 +245,23 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.multiFrameReferencePhaseSelector.setToolTip( "Select a sequence node that contains the reference phase maps" )
     multiFrameFormLayout.addRow("Reference phase sequence: ", self.multiFrameReferencePhaseSelector)
 
+    #
+    # Reference phase file (streamed from the disk instead of the sequence node)
+    #
+    self.multiFrameReferencePhaseFileSelector = ctk.ctkPathLineEdit()
+    self.multiFrameReferencePhaseFileSelector.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Dirs | ctk.ctkPathLineEdit.Readable
+    self.multiFrameReferencePhaseFileSelector.nameFilters = ["4D phase series (*.nrrd *.nhdr *.nii *.nii.gz *.mha *.mhd)", "All files (*)"]
+    self.multiFrameReferencePhaseFileSelector.setToolTip("Optional: a 4D phase file (NRRD, NIfTI, ...) or a directory of frames (e.g. DICOM), read a few frames at a time instead of loading the series into the scene. Used instead of the reference phase sequence if set.")
+    multiFrameFormLayout.addRow("Reference phase file: ", self.multiFrameReferencePhaseFileSelector)
+
+    self.streamChunkSizeSpinBox = qt.QSpinBox()
+    self.streamChunkSizeSpinBox.objectName = 'streamChunkSizeSpinBox'
+    self.streamChunkSizeSpinBox.setMaximum(1024)
+    self.streamChunkSizeSpinBox.setMinimum(1)
+    self.streamChunkSizeSpinBox.setValue(8)
+    self.streamChunkSizeSpinBox.setToolTip("Number of frames of the reference phase file read and processed at a time.")
+    multiFrameFormLayout.addRow("Frames per chunk: ", self.streamChunkSizeSpinBox)
+
     #
     # tempMap volume selector
     #
@@ -261,6 +277,49 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.multiFrameTempMapSelector.setMRMLScene( slicer.mrmlScene )
     self.multiFrameTempMapSelector.setToolTip( "Select an output sequence to store temperature maps." )
     multiFrameFormLayout.addRow("Output Temperature Map: ", self.multiFrameTempMapSelector)
+
+    #
+    # Output frame file (each temperature map is appended to the disk as soon as it is computed)
+    #
+    self.multiFrameTempMapFileSelector = ctk.ctkPathLineEdit()
+    self.multiFrameTempMapFileSelector.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+    self.multiFrameTempMapFileSelector.nameFilters = ["Frame file (*.nhdr)"]
+    self.multiFrameTempMapFileSelector.setToolTip("Optional: a frame file (.nhdr header, .raw data and .index.jsonl frame index) to which each temperature map is appended as soon as it is computed. The frames written survive a crash. If no output sequence is selected, the maps are only written to the file.")
+    multiFrameFormLayout.addRow("Output Temperature Map file: ", self.multiFrameTempMapFileSelector)
+
+    self.reviewFrameSpinBox = qt.QSpinBox()
+    self.reviewFrameSpinBox.objectName = 'reviewFrameSpinBox'
+    self.reviewFrameSpinBox.setMinimum(0)
+    self.reviewFrameSpinBox.setMaximum(0)
+    self.reviewFrameSpinBox.enabled = False
+    self.reviewFrameSpinBox.setToolTip("Show a frame of the output temperature map file (read from the disk on demand).")
+    multiFrameFormLayout.addRow("Review frame: ", self.reviewFrameSpinBox)
+
+    #
+    # Batch mode
+    #
+    self.batchModeFlagCheckBox = qt.QCheckBox()
+    self.batchModeFlagCheckBox.checked = 1
+    self.batchModeFlagCheckBox.setToolTip("If checked, all frames are stacked into a single 4D array and processed at once.")
+    multiFrameFormLayout.addRow("Batch mode: ", self.batchModeFlagCheckBox)
+
+    #
+    # Parallel execution (batch mode)
+    #
+    parallelBoxLayout = qt.QHBoxLayout()
+    self.parallelWorkersSpinBox = qt.QSpinBox()
+    self.parallelWorkersSpinBox.objectName = 'parallelWorkersSpinBox'
+    self.parallelWorkersSpinBox.setMaximum(256)
+    self.parallelWorkersSpinBox.setMinimum(0)
+    self.parallelWorkersSpinBox.setValue(1)
+    self.parallelWorkersSpinBox.setToolTip("Number of workers used to process the frames in the batch mode (1: serial, 0: number of CPUs).")
+    self.parallelModeComboBox = qt.QComboBox()
+    self.parallelModeComboBox.addItem('Threads', 'thread')
+    self.parallelModeComboBox.addItem('Processes', 'process')
+    self.parallelModeComboBox.setToolTip("Use a thread pool or a process pool for the parallel execution.")
+    parallelBoxLayout.addWidget(self.parallelWorkersSpinBox)
+    parallelBoxLayout.addWidget(self.parallelModeComboBox)
+    multiFrameFormLayout.addRow("Parallel workers: ", parallelBoxLayout)
  
     #
     # Apply Button
@@ -295,6 +354,28 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.radiusSpinBox.setToolTip("Radius of the disk mask")
     maskingFormLayout.addRow("Radius: ", self.radiusSpinBox)
 
+    # --------------------
+    # Baseline Library (multiple baselines for moving organs)
+    #
+    baselineLibraryGroupBox = ctk.ctkCollapsibleGroupBox()
+    baselineLibraryGroupBox.title = "Baseline Library"
+    baselineLibraryGroupBox.collapsed = True
+
+    ioFormLayout.addWidget(baselineLibraryGroupBox)
+    baselineLibraryFormLayout = qt.QFormLayout(baselineLibraryGroupBox)
+
+    self.baselineLibrarySelector = slicer.qMRMLNodeComboBox()
+    self.baselineLibrarySelector.nodeTypes = ( ("vtkMRMLSequenceNode"), "" )
+    self.baselineLibrarySelector.selectNodeUponCreation = True
+    self.baselineLibrarySelector.addEnabled = False
+    self.baselineLibrarySelector.removeEnabled = False
+    self.baselineLibrarySelector.noneEnabled = True
+    self.baselineLibrarySelector.showHidden = False
+    self.baselineLibrarySelector.showChildNodeTypes = False
+    self.baselineLibrarySelector.setMRMLScene( slicer.mrmlScene )
+    self.baselineLibrarySelector.setToolTip( "Optional: a sequence of pre-heating phase frames (e.g. over the respiratory cycle). If selected, each reference frame is compared with the baseline whose phase pattern matches best, instead of the baseline phase volume (single and multi-frame)." )
+    baselineLibraryFormLayout.addRow("Baseline Phase Sequence: ", self.baselineLibrarySelector)
+
 
     # --------------------------------------------------
     # PRF Parameters Area
@@ -407,6 +488,60 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     scB0AxisButtonGroup.addButton(self.scB0Axis2RadioButton)
     scParametersFormLayout.addRow('B0 Direction: ', scB0AxisBoxLayout)
 
+    #
+    # FFT padding
+    #
+    self.fftPaddingComboBox = qt.QComboBox()
+    self.fftPaddingComboBox.addItem('None', 'none')
+    self.fftPaddingComboBox.addItem('Fast FFT size', 'fast')
+    self.fftPaddingComboBox.addItem('Object bounding box', 'bbox')
+    self.fftPaddingComboBox.setToolTip("Zero-padding of the object label before the FFT. 'None' is exact. 'Fast FFT size' and 'Object bounding box' (crops the label to the object plus the margin) are faster approximations that change the phase shift by several percent, and by much more on volumes with odd dimensions.")
+    scParametersFormLayout.addRow("FFT padding: ", self.fftPaddingComboBox)
+
+    self.fftMarginSpinBox = qt.QSpinBox()
+    self.fftMarginSpinBox.objectName = 'fftMarginSpinBox'
+    self.fftMarginSpinBox.setMaximum(512)
+    self.fftMarginSpinBox.setMinimum(0)
+    self.fftMarginSpinBox.setValue(16)
+    self.fftMarginSpinBox.setToolTip("Margin (voxels) around the object bounding box.")
+    scParametersFormLayout.addRow("Bounding box margin: ", self.fftMarginSpinBox)
+
+    self.fftWorkersSpinBox = qt.QSpinBox()
+    self.fftWorkersSpinBox.objectName = 'fftWorkersSpinBox'
+    self.fftWorkersSpinBox.setMaximum(256)
+    self.fftWorkersSpinBox.setMinimum(-1)
+    self.fftWorkersSpinBox.setValue(-1)
+    self.fftWorkersSpinBox.setToolTip("Number of FFT worker threads (-1: all CPUs).")
+    scParametersFormLayout.addRow("FFT workers: ", self.fftWorkersSpinBox)
+
+    #
+    # Re-segmentation policy (automatic correction; unchanged magnitude images are never segmented again)
+    #
+    self.resegmentComboBox = qt.QComboBox()
+    self.resegmentComboBox.addItem('When the images change', 'always')
+    self.resegmentComboBox.addItem('Every N frames', 'interval')
+    self.resegmentComboBox.addItem('When the label changes (Dice)', 'dice')
+    self.resegmentComboBox.setToolTip("When the object is segmented again in the automatic mode. The label and the susceptibility map are reused as long as the magnitude images do not change. 'Every N frames' reuses them for N frames after each segmentation. 'When the label changes' segments the new images, but reuses the previous label and map unless the Dice coefficient of the labels falls below the threshold.")
+    scParametersFormLayout.addRow("Re-segmentation: ", self.resegmentComboBox)
+
+    self.resegmentIntervalSpinBox = qt.QSpinBox()
+    self.resegmentIntervalSpinBox.objectName = 'resegmentIntervalSpinBox'
+    self.resegmentIntervalSpinBox.setMaximum(10000)
+    self.resegmentIntervalSpinBox.setMinimum(1)
+    self.resegmentIntervalSpinBox.setValue(10)
+    self.resegmentIntervalSpinBox.setToolTip("Number of frames between segmentations ('Every N frames').")
+    scParametersFormLayout.addRow("Re-segmentation interval (frames): ", self.resegmentIntervalSpinBox)
+
+    self.diceThresholdSpinBox = qt.QDoubleSpinBox()
+    self.diceThresholdSpinBox.objectName = 'diceThresholdSpinBox'
+    self.diceThresholdSpinBox.setMaximum(1.0)
+    self.diceThresholdSpinBox.setMinimum(0.0)
+    self.diceThresholdSpinBox.setDecimals(3)
+    self.diceThresholdSpinBox.setSingleStep(0.01)
+    self.diceThresholdSpinBox.setValue(0.95)
+    self.diceThresholdSpinBox.setToolTip("Dice coefficient below which the new label replaces the previous one ('When the label changes').")
+    scParametersFormLayout.addRow("Dice threshold: ", self.diceThresholdSpinBox)
+
 
     # --------------------------------------------------
     # Parameters Area
@@ -439,6 +574,33 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.phaseUnwrappingPostFlagCheckBox.setToolTip("If checked, use phase unwrapping after computing the phase shift.")
     parametersFormLayout.addRow("Phase unwrapping after subtraction: ", self.phaseUnwrappingPostFlagCheckBox)
 
+    self.temporalUnwrappingFlagCheckBox = qt.QCheckBox()
+    self.temporalUnwrappingFlagCheckBox.checked = 0
+    self.temporalUnwrappingFlagCheckBox.setToolTip("If checked, the phase shift of each frame (multi-frame or automatic update) is unwrapped against the previous frame, which is much faster than spatial unwrapping. Voxels that change by more than pi/2 between frames are unwrapped spatially.")
+    parametersFormLayout.addRow("Temporal phase unwrapping: ", self.temporalUnwrappingFlagCheckBox)
+
+    self.singlePrecisionFlagCheckBox = qt.QCheckBox()
+    self.singlePrecisionFlagCheckBox.checked = 0
+    self.singlePrecisionFlagCheckBox.setToolTip("If checked, compute in single precision (float32). Halves the memory usage; the temperature differs from the double precision result by less than 0.001 deg C.")
+    parametersFormLayout.addRow("Single precision: ", self.singlePrecisionFlagCheckBox)
+
+    self.maskedUnwrappingFlagCheckBox = qt.QCheckBox()
+    self.maskedUnwrappingFlagCheckBox.checked = 1
+    self.maskedUnwrappingFlagCheckBox.setToolTip("If checked, phase unwrapping is limited to the bounding box of the mask, and the voxels outside the mask are excluded from the unwrapping path.")
+    parametersFormLayout.addRow("Masked phase unwrapping: ", self.maskedUnwrappingFlagCheckBox)
+
+    self.unwrapMethodComboBox = qt.QComboBox()
+    for name in Unwrapping.getUnwrapperNames():
+      self.unwrapMethodComboBox.addItem(Unwrapping.getUnwrapperDescription(name), name)
+    self.unwrapMethodComboBox.setToolTip("Phase unwrapping algorithm. The least-squares (DCT) method is much faster than the quality-guided method, but may be less robust to noise.")
+    parametersFormLayout.addRow("Phase unwrapping method: ", self.unwrapMethodComboBox)
+
+    self.phaseOffsetEstimatorComboBox = qt.QComboBox()
+    self.phaseOffsetEstimatorComboBox.addItem('Mean', 'mean')
+    self.phaseOffsetEstimatorComboBox.addItem('Median', 'median')
+    self.phaseOffsetEstimatorComboBox.setToolTip("Estimator of the global pi*N offset between the unwrapped reference and baseline phase (computed inside the mask if masked phase unwrapping is on). The median is more robust to local unwrapping errors.")
+    parametersFormLayout.addRow("Phase offset estimator: ", self.phaseOffsetEstimatorComboBox)
+
     self.complexFlagCheckBox = qt.QCheckBox()
     self.complexFlagCheckBox.checked = 1
     self.complexFlagCheckBox.setToolTip("If checked, use complex values to subtract phase.")
@@ -455,6 +617,51 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.phaseRangeSpinBox.setValue(30.0)
     self.phaseRangeSpinBox.setToolTip("Specify the phase range in degrees. The normal phase range for temperature mapping is [-360 deg, 0 deg]. If '30' is speicified, the range is shifted by 30 degrees (i.e., [-330deg, 30deg]). The shift will allow visualizing negative temperature changes even when complex values are used to calcluate the phase shift.")
     parametersFormLayout.addRow("Phase range shift (deg): ", self.phaseRangeSpinBox)
+
+    #
+    # Referenceless thermometry (background phase fitted in a ring around the heated region)
+    #
+    self.referencelessFlagCheckBox = qt.QCheckBox()
+    self.referencelessFlagCheckBox.checked = 0
+    self.referencelessFlagCheckBox.setToolTip("If checked, no baseline is used: the background phase is estimated by fitting a low-order polynomial to the reference phase in a ring around the heated region, and subtracted. The baseline phase volume is then optional.")
+    parametersFormLayout.addRow("Referenceless (polynomial background): ", self.referencelessFlagCheckBox)
+
+    self.referencelessOrderSpinBox = qt.QSpinBox()
+    self.referencelessOrderSpinBox.objectName = 'referencelessOrderSpinBox'
+    self.referencelessOrderSpinBox.setMaximum(6)
+    self.referencelessOrderSpinBox.setMinimum(0)
+    self.referencelessOrderSpinBox.setValue(2)
+    self.referencelessOrderSpinBox.enabled = False
+    self.referencelessOrderSpinBox.setToolTip("Order of the background polynomial.")
+    parametersFormLayout.addRow("Background order: ", self.referencelessOrderSpinBox)
+
+    self.referencelessSliceFlagCheckBox = qt.QCheckBox()
+    self.referencelessSliceFlagCheckBox.checked = 0
+    self.referencelessSliceFlagCheckBox.enabled = False
+    self.referencelessSliceFlagCheckBox.setToolTip("If checked, fit a 2D polynomial to each slice instead of a 3D polynomial to the volume.")
+    parametersFormLayout.addRow("Fit slice by slice: ", self.referencelessSliceFlagCheckBox)
+
+    self.referencelessInnerRadiusSpinBox = qt.QDoubleSpinBox()
+    self.referencelessInnerRadiusSpinBox.objectName = 'referencelessInnerRadiusSpinBox'
+    self.referencelessInnerRadiusSpinBox.setMaximum(1.0)
+    self.referencelessInnerRadiusSpinBox.setMinimum(0.0)
+    self.referencelessInnerRadiusSpinBox.setDecimals(3)
+    self.referencelessInnerRadiusSpinBox.setSingleStep(0.01)
+    self.referencelessInnerRadiusSpinBox.setValue(0.15)
+    self.referencelessInnerRadiusSpinBox.enabled = False
+    self.referencelessInnerRadiusSpinBox.setToolTip("Inner radius of the ring used for the background fit, relative to the largest extent of the volume. The heated region must be inside.")
+    parametersFormLayout.addRow("Background ring inner radius: ", self.referencelessInnerRadiusSpinBox)
+
+    self.referencelessOuterRadiusSpinBox = qt.QDoubleSpinBox()
+    self.referencelessOuterRadiusSpinBox.objectName = 'referencelessOuterRadiusSpinBox'
+    self.referencelessOuterRadiusSpinBox.setMaximum(1.0)
+    self.referencelessOuterRadiusSpinBox.setMinimum(0.0)
+    self.referencelessOuterRadiusSpinBox.setDecimals(3)
+    self.referencelessOuterRadiusSpinBox.setSingleStep(0.01)
+    self.referencelessOuterRadiusSpinBox.setValue(0.3)
+    self.referencelessOuterRadiusSpinBox.enabled = False
+    self.referencelessOuterRadiusSpinBox.setToolTip("Outer radius of the ring used for the background fit, relative to the largest extent of the volume.")
+    parametersFormLayout.addRow("Background ring outer radius: ", self.referencelessOuterRadiusSpinBox)
     
     #
     # Check box to use threshold
@@ -488,6 +695,25 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.scaleRangeMinSpinBox.setToolTip("Minimum value for the temperature color scale")
     parametersFormLayout.addRow("Min. scale (deg C): ", self.scaleRangeMinSpinBox)
 
+    #
+    # Output type - temperature maps can be stored as scaled 16-bit integers (1/4 of the memory)
+    #
+    self.outputTypeComboBox = qt.QComboBox()
+    self.outputTypeComboBox.addItem('Double (float64)', 'double')
+    self.outputTypeComboBox.addItem('Float (float32)', 'float')
+    self.outputTypeComboBox.addItem('Scaled short (int16)', 'short')
+    self.outputTypeComboBox.setToolTip("Storage type of the output temperature maps. 'Scaled short' stores round(temperature / scale) as 16-bit integers, a quarter of the memory and disk space of double; the scale is recorded in the node attributes and in the output file headers, and the color scale is adjusted to show deg C.")
+    parametersFormLayout.addRow("Output type: ", self.outputTypeComboBox)
+
+    self.outputScaleSpinBox = qt.QDoubleSpinBox()
+    self.outputScaleSpinBox.objectName = 'outputScaleSpinBox'
+    self.outputScaleSpinBox.setMaximum(1.0)
+    self.outputScaleSpinBox.setMinimum(0.0001)
+    self.outputScaleSpinBox.setDecimals(4)
+    self.outputScaleSpinBox.setValue(0.01)
+    self.outputScaleSpinBox.setToolTip("Temperature step (deg C) of the scaled short output type. With 0.01, the range is -327.68 to 327.67 deg C.")
+    parametersFormLayout.addRow("Output scale (deg C): ", self.outputScaleSpinBox)
+
     #
     # Upper threshold - We set threshold value to limit the range of intensity 
     #
@@ -520,6 +746,101 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.autoUpdateCheckBox.setToolTip("Automatic Update: ")
     parametersFormLayout.addRow("Automatic Update", self.autoUpdateCheckBox)
 
+    #
+    # Status of the automatic update (latency and dropped frames)
+    #
+    self.realTimeStatusLabel = qt.QLabel('')
+    parametersFormLayout.addRow("Update status: ", self.realTimeStatusLabel)
+
+    #
+    # Save the parameters for the batch processing (PRFThermometryLib/Batch.py)
+    #
+    self.saveParametersButton = qt.QPushButton("Save Parameters...")
+    self.saveParametersButton.toolTip = "Save the parameters (JSON) for the batch processing of archived sessions from the command line (python -m PRFThermometryLib.Batch)."
+    parametersFormLayout.addRow(self.saveParametersButton)
+
+    # --------------------
+    # Thermal dose
+    #
+    doseCollapsibleButton = ctk.ctkCollapsibleButton()
+    doseCollapsibleButton.text = "Thermal Dose"
+    doseCollapsibleButton.collapsed = True
+    self.layout.addWidget(doseCollapsibleButton)
+
+    doseFormLayout = qt.QFormLayout(doseCollapsibleButton)
+
+    self.doseVolumeSelector = slicer.qMRMLNodeComboBox()
+    self.doseVolumeSelector.nodeTypes = ( ("vtkMRMLScalarVolumeNode"), "" )
+    self.doseVolumeSelector.selectNodeUponCreation = True
+    self.doseVolumeSelector.addEnabled = True
+    self.doseVolumeSelector.removeEnabled = True
+    self.doseVolumeSelector.noneEnabled = True
+    self.doseVolumeSelector.renameEnabled = True
+    self.doseVolumeSelector.showHidden = False
+    self.doseVolumeSelector.showChildNodeTypes = False
+    self.doseVolumeSelector.setMRMLScene( slicer.mrmlScene )
+    self.doseVolumeSelector.setToolTip( "Select an output thermal dose map (CEM43, cumulative equivalent minutes at 43 deg C). The dose is accumulated over the frames of the automatic update mode (timed as they arrive) and of the multi-frame processing (timed by the sequence index, e.g. 'time' in 's')." )
+    doseFormLayout.addRow("Output Dose Map: ", self.doseVolumeSelector)
+
+    self.doseLabelSelector = slicer.qMRMLNodeComboBox()
+    self.doseLabelSelector.nodeTypes = ( ("vtkMRMLLabelMapVolumeNode"), "" )
+    self.doseLabelSelector.selectNodeUponCreation = True
+    self.doseLabelSelector.addEnabled = True
+    self.doseLabelSelector.removeEnabled = True
+    self.doseLabelSelector.noneEnabled = True
+    self.doseLabelSelector.renameEnabled = True
+    self.doseLabelSelector.showHidden = False
+    self.doseLabelSelector.showChildNodeTypes = False
+    self.doseLabelSelector.setMRMLScene( slicer.mrmlScene )
+    self.doseLabelSelector.setToolTip( "Select an output label map of the voxels above the dose threshold." )
+    doseFormLayout.addRow("Output Dose Label: ", self.doseLabelSelector)
+
+    self.doseThresholdSpinBox = qt.QDoubleSpinBox()
+    self.doseThresholdSpinBox.objectName = 'doseThresholdSpinBox'
+    self.doseThresholdSpinBox.setMaximum(100000.0)
+    self.doseThresholdSpinBox.setMinimum(0.0)
+    self.doseThresholdSpinBox.setDecimals(2)
+    self.doseThresholdSpinBox.setValue(240.0)
+    self.doseThresholdSpinBox.setToolTip("Dose threshold (CEM43) of the label map. 240 CEM43 is commonly used as the threshold of thermal necrosis.")
+    doseFormLayout.addRow("Dose threshold (CEM43): ", self.doseThresholdSpinBox)
+
+    self.resetDoseButton = qt.QPushButton("Reset Dose")
+    self.resetDoseButton.toolTip = "Restart the dose accumulation of the automatic update mode."
+    doseFormLayout.addRow(self.resetDoseButton)
+
+    # --------------------
+    # Profiling
+    #
+    profilingCollapsibleButton = ctk.ctkCollapsibleButton()
+    profilingCollapsibleButton.text = "Profiling"
+    profilingCollapsibleButton.collapsed = True
+    self.layout.addWidget(profilingCollapsibleButton)
+
+    profilingFormLayout = qt.QFormLayout(profilingCollapsibleButton)
+
+    self.profilingFlagCheckBox = qt.QCheckBox()
+    self.profilingFlagCheckBox.checked = 0
+    self.profilingFlagCheckBox.setToolTip("If checked, record the wall time of each pipeline stage (pull, cast, mask, scale, unwrap, complex difference, susceptibility, segmentation, temperature, threshold, push, display).")
+    profilingFormLayout.addRow("Profile pipeline stages: ", self.profilingFlagCheckBox)
+
+    self.profilingMemoryFlagCheckBox = qt.QCheckBox()
+    self.profilingMemoryFlagCheckBox.checked = 0
+    self.profilingMemoryFlagCheckBox.setToolTip("If checked, also record the peak memory of each stage (tracemalloc). Slows down the processing considerably.")
+    profilingFormLayout.addRow("Track memory: ", self.profilingMemoryFlagCheckBox)
+
+    self.profilingStatusLabel = qt.QLabel('')
+    self.profilingStatusLabel.wordWrap = True
+    profilingFormLayout.addRow("Last frame: ", self.profilingStatusLabel)
+
+    profilingButtonLayout = qt.QHBoxLayout()
+    self.exportProfileButton = qt.QPushButton("Export...")
+    self.exportProfileButton.toolTip = "Export the recorded stages (CSV) or the frames and the summary (JSON)."
+    self.resetProfileButton = qt.QPushButton("Reset")
+    self.resetProfileButton.toolTip = "Discard the recorded stages."
+    profilingButtonLayout.addWidget(self.exportProfileButton)
+    profilingButtonLayout.addWidget(self.resetProfileButton)
+    profilingFormLayout.addRow(profilingButtonLayout)
+
     # connections
     
     self.applyButtonSingle.connect('clicked(bool)', self.onApplyButtonSingle)
@@ -532,15 +853,29 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     self.baselinePhaseSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectSingle)
     self.referencePhaseSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectSingle)
     self.tempMapSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectSingle)
+    self.baselineLibrarySelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectSingle)
     self.multiFrameReferencePhaseSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectMulti)
     self.multiFrameTempMapSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectMulti)
+    self.multiFrameReferencePhaseFileSelector.connect("currentPathChanged(QString)", self.onSelectMulti)
+    self.multiFrameTempMapFileSelector.connect("currentPathChanged(QString)", self.onSelectMulti)
+    self.multiFrameTempMapFileSelector.connect("currentPathChanged(QString)", self.onTempMapFileChanged)
+    self.reviewFrameSpinBox.connect('valueChanged(int)', self.onReviewFrame)
 
     self.complexFlagCheckBox.connect('toggled(bool)', self.onComplexFlag)
+    self.referencelessFlagCheckBox.connect('toggled(bool)', self.onReferencelessFlag)
+    self.referencelessFlagCheckBox.connect('toggled(bool)', self.onSelectSingle)
     
     self.useThresholdFlagCheckBox.connect('toggled(bool)', self.onUseThreshold)
     self.autoUpdateCheckBox.connect('toggled(bool)', self.onAutoUpdate)
 
     self.simpleMaskingFlagCheckBox.connect('toggled(bool)', self.onUseSimpleMask)
+
+    self.profilingFlagCheckBox.connect('toggled(bool)', self.onProfilingFlag)
+    self.profilingMemoryFlagCheckBox.connect('toggled(bool)', self.onProfilingFlag)
+    self.exportProfileButton.connect('clicked(bool)', self.onExportProfile)
+    self.resetProfileButton.connect('clicked(bool)', self.onResetProfile)
+    self.saveParametersButton.connect('clicked(bool)', self.onSaveParameters)
+    self.resetDoseButton.connect('clicked(bool)', self.onResetDose)
     
     
     # Add vertical spacer
@@ -552,17 +887,89 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
 
     self.tag = None
 
+    # The logic is kept across runs so that cached data (e.g. the preprocessed baseline)
+    # can be reused in the automatic update mode.
+    self.logic = PRFThermometryLogic()
+    self.logic.engine.profiler.addCallback(self.onFrameProfiled)
+    self.onProfilingFlag()
+
+    # In the automatic update mode, the temperature maps are computed on a worker thread.
+    # Only the newest modified reference image is processed; the result is pushed to the scene
+    # from the main thread by a timer.
+    self.realTimePipeline = RealTime.LatestFramePipeline(self.logic.computeSingleFrame)
+    self.realTimeTimer = qt.QTimer()
+    self.realTimeTimer.setInterval(20)
+    self.realTimeTimer.connect('timeout()', self.onRealTimeTimer)
+
     
   def cleanup(self):
-    pass
+    self.realTimeTimer.stop()
+    self.realTimePipeline.stop()
 
   
+  def onProfilingFlag(self):
+    profiler = self.logic.engine.profiler
+    profiler.enabled = self.profilingFlagCheckBox.checked
+    profiler.trackMemory = self.profilingMemoryFlagCheckBox.checked
+
+
+  def onFrameProfiled(self, profile):
+    # Called from the main thread at the end of pushSingleFrame() or runMultiFrameBatch()
+    stages = ', '.join(['%s %.0f' % (stage, elapsed * 1000.0) for stage, elapsed in profile.stages.items()])
+    self.profilingStatusLabel.text = '%.0f ms (%s ms)' % (profile.totalTime * 1000.0, stages)
+
+
+  def onExportProfile(self):
+    path = qt.QFileDialog.getSaveFileName(None, 'Export Profile', 'profile.csv', 'CSV (*.csv);;JSON (*.json)')
+    if not path:
+      return
+    if path.lower().endswith('.json'):
+      self.logic.engine.profiler.exportJSON(path)
+    else:
+      self.logic.engine.profiler.exportCSV(path)
+
+
+  def onResetProfile(self):
+    self.logic.engine.profiler.reset()
+    self.profilingStatusLabel.text = ''
+
+
+  def onSaveParameters(self):
+    path = qt.QFileDialog.getSaveFileName(None, 'Save Parameters', 'param.json', 'JSON (*.json)')
+    if not path:
+      return
+    Batch.saveParam(path, self.getSingleFrameParameters())
+
+
+  def onResetDose(self):
+    self.logic.resetDose()
+
+
   def onSelectSingle(self):
-    self.applyButtonSingle.enabled = self.baselinePhaseSelector.currentNode() and self.baselinePhaseSelector.currentNode() and self.tempMapSelector.currentNode()
+    hasBaseline = (self.baselinePhaseSelector.currentNode() or self.baselineLibrarySelector.currentNode()
+                   or self.referencelessFlagCheckBox.checked)
+    self.applyButtonSingle.enabled = bool(hasBaseline and self.referencePhaseSelector.currentNode() and self.tempMapSelector.currentNode())
 
     
   def onSelectMulti(self):
-    self.applyButtonMulti.enabled = self.multiFrameReferencePhaseSelector.currentNode() and self.multiFrameTempMapSelector.currentNode()
+    hasReference = self.multiFrameReferencePhaseSelector.currentNode() or self.multiFrameReferencePhaseFileSelector.currentPath
+    hasOutput = self.multiFrameTempMapSelector.currentNode() or self.multiFrameTempMapFileSelector.currentPath
+    self.applyButtonMulti.enabled = bool(hasReference and hasOutput)
+
+
+  def onTempMapFileChanged(self):
+    # Update the range of the frames available for review
+    nFrames = self.logic.getStoredFrameCount(self.multiFrameTempMapFileSelector.currentPath)
+    self.reviewFrameSpinBox.setMaximum(max(nFrames - 1, 0))
+    self.reviewFrameSpinBox.enabled = nFrames > 0
+
+
+  def onReviewFrame(self, index):
+    path = self.multiFrameTempMapFileSelector.currentPath
+    if not self.logic.getStoredFrameCount(path):
+      return
+    self.logic.showStoredFrame(path, index, self.scaleRangeMinSpinBox.value, self.scaleRangeMaxSpinBox.value,
+                               self.dispInterpFlagCheckBox.checked)
 
 
   def onComplexFlag(self):
@@ -571,6 +978,13 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     else:
       self.phaseRangeSpinBox.enabled = False
     
+  def onReferencelessFlag(self):
+    enabled = self.referencelessFlagCheckBox.checked
+    self.referencelessOrderSpinBox.enabled = enabled
+    self.referencelessSliceFlagCheckBox.enabled = enabled
+    self.referencelessInnerRadiusSpinBox.enabled = enabled
+    self.referencelessOuterRadiusSpinBox.enabled = enabled
+
   def onUseThreshold(self):
     if self.useThresholdFlagCheckBox.checked == True:
       self.lowerThresholdSpinBox.enabled = True;      
@@ -593,22 +1007,51 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
         self.referencePhaseSelector.enabled = False
         refNode = self.referencePhaseSelector.currentNode()
         self.tag = refNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onModelRefImageModifiedEvent)
+        self.realTimePipeline.resetStatistics()
+        self.logic.engine.resetTemporalUnwrapping()
+        self.logic.resetDose()
+        self.realTimePipeline.start()
+        self.realTimeTimer.start()
       else: # Cannot set autoupdate 
-        self.autoUpdateCheckBox.checked = Falase
+        self.autoUpdateCheckBox.checked = False
     else:
       if self.tag:
         if self.referencePhaseSelector.currentNode():
           refNode = self.referencePhaseSelector.currentNode()
           refNode.RemoveObserver(self.tag)
         self.referencePhaseSelector.enabled = True
+      self.realTimeTimer.stop()
+      self.realTimePipeline.stop()
 
         
   def onModelRefImageModifiedEvent(self, caller, event):
-    self.onApplyButtonSingle()
+    # Pull the volumes on the main thread and hand them to the worker thread.
+    param = self.getSingleFrameParameters()
+    if not param['tempMapVolumeNode']:
+      return
+    frame = self.logic.pullSingleFrame(param, copyInputs=True)
+    if frame:
+      # The frames are timed when they arrive (for the thermal dose)
+      frame['time'] = time.time()
+      self.realTimePipeline.submit(frame)
+
+
+  def onRealTimeTimer(self):
+    output = self.realTimePipeline.takeResult()
+    if output == None:
+      return
+    frame, result, latency = output
+    self.logic.pushSingleFrame(frame, result)
+    stat = self.realTimePipeline.getStatistics()
+    self.realTimeStatusLabel.text = 'Latency: %.0f ms (mean %.0f ms), processed: %d, dropped: %d, failed: %d' % (
+      latency * 1000.0, stat['meanLatency'] * 1000.0, stat['processed'], stat['dropped'], stat['failed'])
 
     
   def onApplyButtonSingle(self):
-    logic = PRFThermometryLogic()
+    self.logic.runSingleFrame(self.getSingleFrameParameters())
+
+
+  def getSingleFrameParameters(self):
 
     suscCorrMethod = 'off'
     if self.scAutoRadioButton.checked:
@@ -620,7 +1063,17 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     param['displayInterpolation']     = self.dispInterpFlagCheckBox.checked
     param['usePhaseUnwrapping']       = self.phaseUnwrappingFlagCheckBox.checked
     param['usePhaseUnwrappingPost']   = self.phaseUnwrappingPostFlagCheckBox.checked
+    param['temporalUnwrapping']       = self.temporalUnwrappingFlagCheckBox.checked
+    param['useMaskedUnwrapping']      = self.maskedUnwrappingFlagCheckBox.checked
+    param['unwrapMethod']             = self.unwrapMethodComboBox.itemData(self.unwrapMethodComboBox.currentIndex)
+    param['phaseOffsetEstimator']     = self.phaseOffsetEstimatorComboBox.itemData(self.phaseOffsetEstimatorComboBox.currentIndex)
     param['useComplex']               = self.complexFlagCheckBox.checked
+    param['referenceless']            = self.referencelessFlagCheckBox.checked
+    param['referenceless.order']      = self.referencelessOrderSpinBox.value
+    param['referenceless.dimension']  = 2 if self.referencelessSliceFlagCheckBox.checked else 3
+    param['referenceless.innerRadius'] = self.referencelessInnerRadiusSpinBox.value
+    param['referenceless.outerRadius'] = self.referencelessOuterRadiusSpinBox.value
+    param['precision']                = 'single' if self.singlePrecisionFlagCheckBox.checked else 'double'
     param['phaseRangeShiftDeg']       = self.phaseRangeSpinBox.value
     param['baselinePhaseVolumeNode']  = self.baselinePhaseSelector.currentNode()
     param['referencePhaseVolumeNode'] = self.referencePhaseSelector.currentNode()
@@ -633,12 +1086,24 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     param['BT']                       = self.BTSpinBox.value
     param['colorScaleMax']            = self.scaleRangeMaxSpinBox.value
     param['colorScaleMin']            = self.scaleRangeMinSpinBox.value
+    param['outputType']               = self.outputTypeComboBox.currentData
+    param['outputScale']              = self.outputScaleSpinBox.value
     param['suscCorrMethod']           = suscCorrMethod
     param['suscCorrObjectLabelNode']  = self.objectLabelSelector.currentNode()
     param['suscCorrBaselineImageNode']= self.objectBaselineImageSelector.currentNode()
     param['suscCorrReferenceImageNode']= self.objectReferenceImageSelector.currentNode()
     param['suscCorrAutoObjectLabelNode']  = self.autoObjectLabelSelector.currentNode()
     param['deltaChi']                 = self.deltaChiSpinBox.value
+    param['suscCorrFFTPadding']       = self.fftPaddingComboBox.itemData(self.fftPaddingComboBox.currentIndex)
+    param['suscCorrFFTMargin']        = self.fftMarginSpinBox.value
+    param['fftWorkers']               = self.fftWorkersSpinBox.value
+    param['suscCorrResegment']        = self.resegmentComboBox.itemData(self.resegmentComboBox.currentIndex)
+    param['suscCorrResegmentInterval'] = self.resegmentIntervalSpinBox.value
+    param['suscCorrDiceThreshold']    = self.diceThresholdSpinBox.value
+    param['doseVolumeNode']           = self.doseVolumeSelector.currentNode()
+    param['doseLabelNode']            = self.doseLabelSelector.currentNode()
+    param['doseThreshold']            = self.doseThresholdSpinBox.value
+    param['baselineLibrarySequenceNode'] = self.baselineLibrarySelector.currentNode()
 
     # Set B0 direction. TODO: need to be verifed.
     if self.scB0Axis0RadioButton.checked:
@@ -661,11 +1126,11 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     else:
       param['simpleMask']        = None
 
-    logic.runSingleFrame(param)
+    return param
 
 
   def onApplyButtonMulti(self):
-    logic = PRFThermometryLogic()
+    logic = self.logic
 
     suscCorrMethod = 'off'
     if self.scAutoRadioButton.checked:
@@ -677,11 +1142,27 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     param['baselinePhaseVolumeNode']  = self.baselinePhaseSelector.currentNode()
     param['maskVolumeNode']           = self.maskSelector.currentNode()
     param['referencePhaseSequenceNode'] = self.multiFrameReferencePhaseSelector.currentNode()
+    param['referencePhaseFile']       = self.multiFrameReferencePhaseFileSelector.currentPath
+    param['streamChunkSize']          = self.streamChunkSizeSpinBox.value
     param['tempMapSequenceNode']        = self.multiFrameTempMapSelector.currentNode()
+    param['tempMapFile']              = self.multiFrameTempMapFileSelector.currentPath
+    param['batchMode']                = self.batchModeFlagCheckBox.checked
+    param['parallelWorkers']          = self.parallelWorkersSpinBox.value
+    param['parallelMode']             = self.parallelModeComboBox.itemData(self.parallelModeComboBox.currentIndex)
     param['displayInterpolation']     = self.dispInterpFlagCheckBox.checked    
     param['usePhaseUnwrapping']       = self.phaseUnwrappingFlagCheckBox.checked
     param['usePhaseUnwrappingPost']   = self.phaseUnwrappingPostFlagCheckBox.checked
+    param['temporalUnwrapping']       = self.temporalUnwrappingFlagCheckBox.checked
+    param['useMaskedUnwrapping']      = self.maskedUnwrappingFlagCheckBox.checked
+    param['unwrapMethod']             = self.unwrapMethodComboBox.itemData(self.unwrapMethodComboBox.currentIndex)
+    param['phaseOffsetEstimator']     = self.phaseOffsetEstimatorComboBox.itemData(self.phaseOffsetEstimatorComboBox.currentIndex)
     param['useComplex']               = self.complexFlagCheckBox.checked
+    param['referenceless']            = self.referencelessFlagCheckBox.checked
+    param['referenceless.order']      = self.referencelessOrderSpinBox.value
+    param['referenceless.dimension']  = 2 if self.referencelessSliceFlagCheckBox.checked else 3
+    param['referenceless.innerRadius'] = self.referencelessInnerRadiusSpinBox.value
+    param['referenceless.outerRadius'] = self.referencelessOuterRadiusSpinBox.value
+    param['precision']                = 'single' if self.singlePrecisionFlagCheckBox.checked else 'double'
     param['phaseRangeShiftDeg']       = self.phaseRangeSpinBox.value
     #param['truePhasePointNode']       = self.truePhasePointSelector.currentNode()
     param['alpha']                    = self.alphaSpinBox.value
@@ -691,6 +1172,8 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     param['BT']                       = self.BTSpinBox.value
     param['colorScaleMax']            = self.scaleRangeMaxSpinBox.value
     param['colorScaleMin']            = self.scaleRangeMinSpinBox.value
+    param['outputType']               = self.outputTypeComboBox.currentData
+    param['outputScale']              = self.outputScaleSpinBox.value
     param['B0vec']                    = [0.0, 0.0, 1.0]  # TODO: Should depend on the patient orientation.
 
     # TODO: Susceptibility correction hasn't been implemented for multi-frame mapping.
@@ -701,6 +1184,16 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
     param['suscCorrAutoObjectLabelNode']= None
 
     param['deltaChi']                 = self.deltaChiSpinBox.value
+    param['suscCorrFFTPadding']       = self.fftPaddingComboBox.itemData(self.fftPaddingComboBox.currentIndex)
+    param['suscCorrFFTMargin']        = self.fftMarginSpinBox.value
+    param['fftWorkers']               = self.fftWorkersSpinBox.value
+    param['suscCorrResegment']        = self.resegmentComboBox.itemData(self.resegmentComboBox.currentIndex)
+    param['suscCorrResegmentInterval'] = self.resegmentIntervalSpinBox.value
+    param['suscCorrDiceThreshold']    = self.diceThresholdSpinBox.value
+    param['doseVolumeNode']           = self.doseVolumeSelector.currentNode()
+    param['doseLabelNode']            = self.doseLabelSelector.currentNode()
+    param['doseThreshold']            = self.doseThresholdSpinBox.value
+    param['baselineLibrarySequenceNode'] = self.baselineLibrarySelector.currentNode()
 
     if self.useThresholdFlagCheckBox.checked == True:
       param['upperThreshold']         = self.upperThresholdSpinBox.value
@@ -709,7 +1202,14 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
       param['upperThreshold']         = False
       param['lowerThreshold']         = False
 
+    if self.simpleMaskingFlagCheckBox.checked == 1:
+      param['simpleMask']        = 'disk'
+      param['simpleMask.radius'] = self.radiusSpinBox.value
+    else:
+      param['simpleMask']        = None
+
     logic.runMultiFrame(param)
+    self.onTempMapFileChanged()
 
 
   def onScChange(self):
@@ -746,6 +1246,20 @@ class PRFThermometryWidget(ScriptedLoadableModuleWidget):
 
 class PRFThermometryLogic(ScriptedLoadableModuleLogic):
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.engine = Engine.ThermometryEngine()
+    self.volumeIO = VolumeIO.SlicerVolumeIO()
+    self.doseAccumulator = Engine.DoseAccumulator()
+    # The engine (with its caches) and the dose are shared with the worker thread of the automatic
+    # update (see RealTime.py). Both threads hold this lock while they use them.
+    self.engineLock = threading.RLock()
+    self.baselineLibrary = None
+    self.baselineLibraryKey = None
+    self.phaseDiff = None
+    self.resultCache = Engine.ResultCache(self.getNodeKey)
+
+
   def isValidInputOutputData(self, baselinePhaseVolumeNode, referencePhaseVolumeNode):
     """Validates if the output is not the same as input
     """
@@ -760,19 +1274,7 @@ class PRFThermometryLogic(ScriptedLoadableModuleLogic):
 
   def generateDiskMask(self, refImage, center=[0.5,0.5,0.5], radius=0.5):
 
-    refImageArray = sitk.GetArrayFromImage(refImage)
-    dims = refImageArray.shape
-    maxDim = numpy.double(numpy.max(dims))
-    r = maxDim * radius
-    
-    cx = dims[0] * center[0]
-    cy = dims[1] * center[1]
-    cz = dims[2] * center[2]
-    y, x, z = numpy.ogrid[-cx:dims[0]-cx, -cy:dims[1]-cy, -cz:dims[2]-cz]
-    mask = x*x + y*y + z*z <= r*r
-    voxels = numpy.zeros((dims[0], dims[1], dims[2]))
-    voxels[mask] = 1
-    
+    voxels = Engine.generateDiskMask(refImage.GetSize()[::-1], center, radius, numpy.uint8, refImage.GetSpacing())
     maskImage = sitk.GetImageFromArray(voxels)
     maskImage.CopyInformation(refImage) 
     
@@ -784,286 +1286,325 @@ class PRFThermometryLogic(ScriptedLoadableModuleLogic):
     Run the actual algorithm
     """
 
-    displayInterpolation     = param['displayInterpolation']
-    usePhaseUnwrapping       = param['usePhaseUnwrapping']
-    usePhaseUnwrappingPost   = param['usePhaseUnwrappingPost']
-    useComplex               = param['useComplex']
-    phaseRangeShiftDeg       = param['phaseRangeShiftDeg']
+    # Display-, threshold- or output-only changes reuse the phase difference of the previous run
+    if param['tempMapVolumeNode']:
+      cached = self.getCachedSingleFrame(param)
+      if cached != None:
+        self.pushSingleFrame(*cached)
+        logging.info('Processing completed (cached phase difference)')
+        return True
+
+    frame = self.pullSingleFrame(param)
+    if frame == None:
+      return False
+
+    if param['tempMapVolumeNode']:
+      self.phaseDiff = None
+      result = self.computeSingleFrame(frame)
+      self.resultCache.store(frame['param'], result, geometry=frame['geometry'],
+                             objectGeometry=frame['objectGeometry'])
+      self.pushSingleFrame(frame, result)
+
+    logging.info('Processing completed')
+
+    return True
+
+
+  def getCachedSingleFrame(self, param):
+    """
+    Return (frame, result) for pushSingleFrame() built from the intermediate products of the previous
+    runSingleFrame() if its inputs and phase parameters are unchanged, or None. Only the conversion to
+    temperature (if its parameters changed) and the threshold are computed again (see Engine.ResultCache).
+    """
+
+    entry = self.resultCache.lookup(param)
+    if entry == None:
+      return None
+
+    profiler = self.engine.profiler
+    frame = {}
+    frame['param'] = param
+    frame['profile'] = profiler.beginFrame(param['referencePhaseVolumeNode'].GetName())
+    frame['geometry'] = entry['geometry']
+    frame['objectGeometry'] = entry['objectGeometry']
+    with self.engineLock, profiler.activate(frame['profile']):
+      result = self.resultCache.getResult(self.engine, param)
+    return (frame, result)
+
+
+  def pullSingleFrame(self, param, copyInputs=False):
+    """
+    Pull the input volumes from the scene as arrays. Returns a dictionary ('frame') for
+    computeSingleFrame() and pushSingleFrame(), or None if the inputs are invalid.
+    The arrays are read-only views of the volume nodes (see VolumeIO.py); set 'copyInputs' if the
+    frame is computed on a worker thread while the scene may update the nodes.
+    Must be called from the main thread.
+    """
+
     baselinePhaseVolumeNode  = param['baselinePhaseVolumeNode']
     referencePhaseVolumeNode = param['referencePhaseVolumeNode']
     maskVolumeNode           = param['maskVolumeNode']
-    tempMapVolumeNode        = param['tempMapVolumeNode']
-    #truePhasePointNode       = param['truePhasePointNode']
     alpha                    = param['alpha']
     gamma                    = param['gamma']
     B0                       = param['B0']
     TE                       = param['TE']
     BT                       = param['BT']
-    B0vec                    = param['B0vec']
-    colorScaleMax            = param['colorScaleMax']
-    colorScaleMin            = param['colorScaleMin']
-    upperThreshold           = param['upperThreshold']
-    lowerThreshold           = param['lowerThreshold']
 
     suscCorrMethod           = param['suscCorrMethod']
     suscCorrObjectLabelNode   = param['suscCorrObjectLabelNode']
     suscCorrBaselineImageNode = param['suscCorrBaselineImageNode']
     suscCorrReferenceImageNode= param['suscCorrReferenceImageNode']
-    suscCorrAutoObjectLabelNode=param['suscCorrAutoObjectLabelNode']
-    deltaChi                 = param['deltaChi']
 
+    # With a baseline library, the baseline of the frame is selected by the engine. The geometry and
+    # the scalar type are then those of the first baseline of the library.
+    baselineLibrary = self.getBaselineLibrary(param)
+    if baselineLibrary is not None and baselinePhaseVolumeNode == None:
+      baselinePhaseVolumeNode = param['baselineLibrarySequenceNode'].GetNthDataNode(0)
+
+    # In the referenceless mode, the background phase is fitted in the reference itself and no
+    # baseline is pulled. The geometry and the scalar type are then those of the reference.
+    referenceless = param.get('referenceless', False)
+    if referenceless and baselinePhaseVolumeNode == None:
+      baselinePhaseVolumeNode = referencePhaseVolumeNode
 
-    # Convert the phase range shift from degree to radian
-    phaseRangeShift = numpy.pi * phaseRangeShiftDeg/180.0
-    
     if not self.isValidInputOutputData(baselinePhaseVolumeNode, referencePhaseVolumeNode):
       slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
-      return False
+      return None
 
     logging.info('Processing started')
 
-    print(baselinePhaseVolumeNode.GetName())
-    print(referencePhaseVolumeNode.GetName())
+    logging.debug('Baseline: %s, reference: %s' % (baselinePhaseVolumeNode.GetName(), referencePhaseVolumeNode.GetName()))
+    logging.debug('(alpha, gamma, B0, TE, BT) = (%f, %f, %f, %f, %f)' % (alpha, gamma, B0, TE, BT))
 
-    imageBaseline = None
-    imageReference = None
-    
-    # Check the scalar type (Siemens SRC sends image data in 'short' instead of 'unsigned short')
-    baselineImageData = baselinePhaseVolumeNode.GetImageData()
-    scalarType = ''
-    if baselineImageData != None:
-      scalarType = baselineImageData.GetScalarTypeAsString()
-      
-    imageBaseline  = sitk.Cast(sitkUtils.PullVolumeFromSlicer(baselinePhaseVolumeNode), sitk.sitkFloat64)
-    imageReference  = sitk.Cast(sitkUtils.PullVolumeFromSlicer(referencePhaseVolumeNode), sitk.sitkFloat64)
-    
-    mask = None
-    
-    if param['simpleMask'] == 'disk':
-      simpleMaskRadius         = param['simpleMask.radius'] 
-      mask = self.generateDiskMask(imageBaseline, radius=simpleMaskRadius)
-      imageBaseline = imageBaseline * mask
-      imageReference = imageReference * mask
-    elif param['maskVolumeNode']:
-      mask = sitk.Cast(sitkUtils.PullVolumeFromSlicer(maskVolumeNode), sitk.sitkFloat64)
-      imageBaseline = imageBaseline * mask
-      imageRefeprence = imageReference * mask
-    
-    if tempMapVolumeNode:
+    # The frame is profiled from the pull to the end of pushSingleFrame() (see Profiling.py)
+    profiler = self.engine.profiler
+    profile = profiler.beginFrame(referencePhaseVolumeNode.GetName())
+    with profiler.activate(profile), profiler.stage('pull'):
+      frame = {}
+      frame['param'] = param
+      frame['profile'] = profile
 
-      self.phaseDiff = None
-      self.phaseDrift = None
-      
-      if scalarType == 'unsigned short':
-        print('imageBaseline*numpy.pi/2048.0 - numpy.pi')
-        imageBaselinePhase = imageBaseline*numpy.pi/2048.0 - numpy.pi
-        imageReferencePhase = imageReference*numpy.pi/2048.0 - numpy.pi
-      else:
-        print('imageBaseline*numpy.pi/4096.0')
-        imageBaselinePhase = imageBaseline*numpy.pi/4096.0
-        imageReferencePhase = imageReference*numpy.pi/4096.0
-
-      # Phase unwrapping on the raw input images
-      if usePhaseUnwrapping == True:
-        print('usePhaseUnwrapping')
-        imageBaselinePhase  = self.unwrap(imageBaselinePhase)
-        imageReferencePhase = self.unwrap(imageReferencePhase)
-
-        # Match the phases
-        # Phase unwrapping often ends up shifting the entire phase map by pi*N. Try shifting the reference phase map
-        # by pi*N where N = -2, -1, ... ,2 and check the difference between the baseline and reference images.
-        stat = sitk.StatisticsImageFilter()
-        meanDiffList = numpy.array([])
-        nList = list(range(-4,4))
-        for n in nList:
-          phaseShift = numpy.pi * n 
-          diffImage = imageReferencePhase + phaseShift - imageBaselinePhase
-          stat.Execute(diffImage)
-          meanDiffList = numpy.append(meanDiffList, numpy.abs(stat.GetMean()))
-        
-        minIndex = numpy.argmin(meanDiffList)
-        print('minIndex = ' + str(minIndex))
-        phaseShift = numpy.pi * nList[minIndex]
-        imageReferencePhase = imageReferencePhase + phaseShift
-
-      # Phase shift can be determined by either subtracting the phase values or
-      # calculating the rotation in the complex space
-      if useComplex == True:
-        # Convert the phase images to complex images (as numpy arrays)
-        arrayBaseline = sitk.GetArrayFromImage(imageBaselinePhase)
-        arrayBaselineComplex = numpy.cos(arrayBaseline) + numpy.sin(arrayBaseline) * 1.0j
-        arrayReference = sitk.GetArrayFromImage(imageReferencePhase)
-        arrayReferenceComplex = numpy.cos(arrayReference) + numpy.sin(arrayReference) * 1.0j
-        
-        arrayPhaseDiffComplex = arrayReferenceComplex / arrayBaselineComplex
-        arrayPhaseDiff = numpy.angle(arrayPhaseDiffComplex)
-        
-        # Change the range from [-pi, pi] to [-2pi+numpy.pi/4, numpy.pi/4] (allow some temperature decrease)
-        arrayPhaseDiff[arrayPhaseDiff>phaseRangeShift] -= 2*numpy.pi
-        
-        self.phaseDiff = sitk.GetImageFromArray(arrayPhaseDiff)
-        self.phaseDiff.SetOrigin(imageBaseline.GetOrigin())
-        self.phaseDiff.SetSpacing(imageBaseline.GetSpacing())
-        self.phaseDiff.SetDirection(imageBaseline.GetDirection())
-        
-      else:
-        self.phaseDiff = imageReferencePhase - imageBaselinePhase        
+      # Check the scalar type (Siemens SRC sends image data in 'short' instead of 'unsigned short')
+      scalarType = self.volumeIO.getScalarType(baselinePhaseVolumeNode)
+      frame['scalarType'] = scalarType
       
-      if usePhaseUnwrappingPost == True:
-        print('usePhaseUnwrappingPost')
-        self.phaseDiff  = self.unwrap(self.phaseDiff)
-        
-      #self.phaseDiff = self.phaseDiff
-      #
-      # Susceptibility correction
+      frame['geometry'] = self.getVolumeGeometry(baselinePhaseVolumeNode)
+
+      # The preprocessed baseline (and the mask) are cached by the engine under 'baselineKey'. They
+      # are pulled for every frame anyway (as views, or copies with 'copyInputs'): the frame may be
+      # computed on a worker thread, after the cache entry has been replaced. The simple masks (param['simpleMask'] 'disk' or 'ellipsoid') are generated (and cached) by the engine.
+      useMaskVolume = param.get('simpleMask') not in ('disk', 'ellipsoid') and maskVolumeNode
+      baselineKey = self.getBaselineKey(baselinePhaseVolumeNode, maskVolumeNode if useMaskVolume else None)
+      frame['baselineKey'] = baselineKey
+      frame['baselineLibrary'] = baselineLibrary
+      frame['baseline'] = None
+      frame['mask'] = None
+      # The phase is not cast here, the engine casts it once when it is scaled. The mask is not
+      # cast either, the engine only tests for voxels > 0.
+      if referenceless:
+        # The mask is used for every frame
+        if useMaskVolume:
+          frame['mask'] = self.volumeIO.pull(maskVolumeNode) > 0
+      elif baselineLibrary is None:
+        frame['baseline'] = self.volumeIO.pull(baselinePhaseVolumeNode, copy=copyInputs)
+        if useMaskVolume:
+          frame['mask'] = self.volumeIO.pull(maskVolumeNode) > 0
+
+      frame['reference'] = self.volumeIO.pull(referencePhaseVolumeNode, copy=copyInputs)
+
+      frame['objectLabel'] = None
+      frame['objectBaseline'] = None
+      frame['objectReference'] = None
+      frame['objectGeometry'] = None
       if suscCorrMethod == 'manual':
-        labelImage = sitk.Cast(sitkUtils.PullVolumeFromSlicer(suscCorrObjectLabelNode), sitk.sitkInt16)
-        deltaPhase = self.generateSusceptibilityMap(labelImage, param)
-        self.phaseDiff = self.phaseDiff - deltaPhase
+        frame['objectLabel'] = self.volumeIO.pull(suscCorrObjectLabelNode, numpy.int16, copy=copyInputs)
       elif suscCorrMethod == 'auto':
-        baselineImage = sitk.Cast(sitkUtils.PullVolumeFromSlicer(suscCorrBaselineImageNode), sitk.sitkInt16)
-        referenceImage = sitk.Cast(sitkUtils.PullVolumeFromSlicer(suscCorrReferenceImageNode), sitk.sitkInt16)
-        labelImage = self.segmentObject(baselineImage, referenceImage, param)
-        if suscCorrAutoObjectLabelNode:
-          sitkUtils.PushVolumeToSlicer(labelImage, suscCorrAutoObjectLabelNode.GetName(), 0, True)
-        deltaPhase = self.generateSusceptibilityMap(labelImage, param)
-        self.phaseDiff = self.phaseDiff - deltaPhase
-
-      print("(alpha, gamma, B0, TE, TE) = (%f, %f, %f, %f, %f)" % (alpha, gamma, B0, TE, BT))
-      imageTemp = self.phaseDiff / (alpha * 2.0 * numpy.pi * gamma * B0 * TE) + BT
-        
-      if upperThreshold or lowerThreshold:
-        imageTempThreshold = sitk.Threshold(imageTemp, lowerThreshold, upperThreshold, 0.0)
-        sitkUtils.PushVolumeToSlicer(imageTempThreshold, tempMapVolumeNode.GetName(), 0, True)
-      else:
-        sitkUtils.PushVolumeToSlicer(imageTemp, tempMapVolumeNode.GetName(), 0, True)
+        frame['objectGeometry'] = self.getVolumeGeometry(suscCorrBaselineImageNode)
+        frame['objectBaseline'] = self.volumeIO.pull(suscCorrBaselineImageNode, numpy.int16, copy=copyInputs)
+        frame['objectReference'] = self.volumeIO.pull(suscCorrReferenceImageNode, numpy.int16, copy=copyInputs)
 
-      dnode = tempMapVolumeNode.GetDisplayNode()
-      if dnode == None:
-        dnode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLScalarVolumeDisplayNode')
-        slicer.mrmlScene.AddNode(dnode)
-        tempMapVolumeNode.SetAndObserveDisplayNodeID(dnode.GetID())
+    return frame
 
-      dnode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileColdToHotRainbow.txt')
-      dnode.SetWindowLevelLocked(0)
-      dnode.SetAutoWindowLevel(0)
-      dnode.SetWindowLevelMinMax(colorScaleMin, colorScaleMax)
 
-      colorLegendDisplayNode = slicer.modules.colors.logic().AddDefaultColorLegendDisplayNode(tempMapVolumeNode)
-      colorLegendDisplayNode.VisibilityOn()
+  def computeSingleFrame(self, frame):
+    """
+    Compute the temperature map for a frame returned by pullSingleFrame().
+    Does not access the scene, and can be called from a worker thread.
+    """
+
+    with self.engineLock:
+      with self.engine.profiler.activate(frame['profile']):
+        result = self.engine.run(frame['baseline'], frame['reference'], frame['param'],
+                                 mask=frame['mask'], scalarType=frame['scalarType'], geometry=frame['geometry'],
+                                 objectLabel=frame['objectLabel'], objectBaseline=frame['objectBaseline'],
+                                 objectReference=frame['objectReference'], baselineKey=frame['baselineKey'],
+                                 baselineLibrary=frame.get('baselineLibrary'))
+      if frame.get('baselineLibrary') is not None:
+        logging.debug('Baseline library: baseline %d (distance %.3f)' % frame['baselineLibrary'].lastMatch)
+
+      # Thermal dose of the timed frames (automatic update mode). The dose is copied, as the
+      # accumulator is updated by the next frame while this one is pushed.
+      if frame.get('time') is not None and self.isDoseEnabled(frame['param']):
+        temperature = self.getDoseTemperature(result, frame['param'])
+        frame['dose'] = self.doseAccumulator.update(temperature, frame['time'] / 60.0).copy()
+
+    return result
+
+
+  def resetDose(self):
+    with self.engineLock:
+      self.doseAccumulator.reset()
+
+
+  def getDoseTemperature(self, result, param):
+    """
+    Return the temperature of 'result' (Engine.ThermometryResult) before the threshold, for the
+    thermal dose. The threshold sets the voxels above param['upperThreshold'] to 0, which would
+    drop the dose of the hottest voxels.
+    """
+
+    if param.get('upperThreshold', False) or param.get('lowerThreshold', False):
+      return self.engine.convertTemperature(result.phaseDiff, param)
+    return result.temperature
+
+
+  def pushSingleFrame(self, frame, result):
+    """
+    Push the result of computeSingleFrame() to the output volume and set up its display.
+    Must be called from the main thread.
+    """
+
+    param                    = frame['param']
+    geometry                 = frame['geometry']
+    displayInterpolation     = param['displayInterpolation']
+    tempMapVolumeNode        = param['tempMapVolumeNode']
+    colorScaleMax            = param['colorScaleMax']
+    colorScaleMin            = param['colorScaleMin']
+    suscCorrAutoObjectLabelNode=param['suscCorrAutoObjectLabelNode']
+
+    profiler = self.engine.profiler
+    with profiler.activate(frame['profile']):
+      with profiler.stage('push'):
+        self.phaseDiff = geometry.toImage(result.phaseDiff)
+        if param['suscCorrMethod'] == 'auto' and suscCorrAutoObjectLabelNode:
+          self.volumeIO.push(suscCorrAutoObjectLabelNode, result.objectLabel, frame['objectGeometry'])
+          if suscCorrAutoObjectLabelNode.GetDisplayNode() == None:
+            suscCorrAutoObjectLabelNode.CreateDefaultDisplayNodes()
+
+        self.volumeIO.push(tempMapVolumeNode, Engine.quantizeTemperature(result.temperature, param), geometry)
+        self.setOutputScale(tempMapVolumeNode, param)
 
-      if displayInterpolation == True:
-        dnode.SetInterpolate(1)
+        if frame.get('dose') is not None:
+          self.pushDose(param, frame['dose'], geometry)
+
+      with profiler.stage('display'):
+        self.setTempMapDisplay(tempMapVolumeNode, colorScaleMin, colorScaleMax, displayInterpolation)
+
+    profiler.endFrame(frame['profile'])
+
+
+  def setOutputScale(self, volumeNode, param):
+    """Record the scale of the stored temperature maps (Engine.getOutputFormat()) in the node attributes.
+    """
+    self.setOutputMetaData(volumeNode, Engine.getOutputMetaData(param))
+
+
+  def setOutputMetaData(self, volumeNode, metaData):
+    # Missing values (unscaled maps) remove the attributes
+    for key in Engine.outputMetaDataKeys:
+      if metaData.get(key):
+        volumeNode.SetAttribute(key, metaData[key])
       else:
-        dnode.SetInterpolate(0)
+        volumeNode.RemoveAttribute(key)
+    self.setVoxelValueUnits(volumeNode)
 
-    logging.info('Processing completed')
 
-    return True
+  def getOutputMetaData(self, volumeNode):
+    return dict((key, volumeNode.GetAttribute(key)) for key in Engine.outputMetaDataKeys)
+
+
+  def getOutputUnits(self, volumeNode):
+    """Return the units of the stored values of a temperature map node (see Engine.getOutputUnits()).
+    """
+    return volumeNode.GetAttribute(Engine.outputUnitsKey) or Engine.getOutputUnits(*self.getOutputScale(volumeNode))
+
+
+  def setVoxelValueUnits(self, volumeNode):
+    """Set the voxel value units of a temperature map node (shown with the voxel values, e.g. by
+    the data probe). Slicer does not apply the scale of the stored values; the units of a scaled
+    map say what a stored step is (e.g. '0.01 deg C').
+    """
+    if not hasattr(volumeNode, 'SetVoxelValueUnits'):
+      return
+    scale, offset = self.getOutputScale(volumeNode)
+    units = slicer.vtkCodedEntry()
+    units.SetValueSchemeMeaning('Cel' if scale == 1.0 else '%g.Cel' % scale, 'UCUM', self.getOutputUnits(volumeNode))
+    volumeNode.SetVoxelValueUnits(units)
+
+
+  def getOutputScale(self, volumeNode):
+    """Return (scale, offset) of a temperature map node: temperature (deg C) = value * scale + offset.
+    """
+    return Engine.getOutputScale(self.getOutputMetaData(volumeNode))
 
 
-  def ft3d(self, array):
-    return scipy.fft.fftshift(scipy.fft.fftn(array))
+  def setTempMapDisplay(self, tempMapVolumeNode, colorScaleMin, colorScaleMax, displayInterpolation):
 
+    dnode = tempMapVolumeNode.GetDisplayNode()
+    if dnode == None:
+      dnode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLScalarVolumeDisplayNode')
+      slicer.mrmlScene.AddNode(dnode)
+      tempMapVolumeNode.SetAndObserveDisplayNodeID(dnode.GetID())
 
-  def ift3d(self, array):
-    return scipy.fft.ifftn(scipy.fft.fftshift(array))
+    dnode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileColdToHotRainbow.txt')
+    dnode.SetWindowLevelLocked(0)
+    dnode.SetAutoWindowLevel(0)
+    # Scaled maps store (temperature - offset) / scale; the window is set in the stored units
+    scale, offset = self.getOutputScale(tempMapVolumeNode)
+    dnode.SetWindowLevelMinMax((colorScaleMin - offset) / scale, (colorScaleMax - offset) / scale)
+
+    colorLegendDisplayNode = slicer.modules.colors.logic().AddDefaultColorLegendDisplayNode(tempMapVolumeNode)
+    colorLegendDisplayNode.VisibilityOn()
+    # The legend shows the stored values (e.g. 4213 for 42.13 deg C with a scale of 0.01)
+    colorLegendDisplayNode.SetTitleText('Temperature (%s)' % self.getOutputUnits(tempMapVolumeNode))
+
+    if displayInterpolation == True:
+      dnode.SetInterpolate(1)
+    else:
+      dnode.SetInterpolate(0)
 
 
   def generateSusceptibilityMap(self, label, param):
 
-    gammaPI = param['gamma'] * 2.0 * numpy.pi
-    #H0    = param['H0']
-    TE    = param['TE']
-    deltaChi = param['deltaChi']
-    alpha = param['alpha']
-    B0    = param['B0']
-    BT    = param['BT']
-    B0vec = param['B0vec']
-    H0 = B0
-
-    # Find the image axis closest to the B0
-    # TODO: We need to find the orientation vector of the B0 field w.r.t. the image matrix frame (not the patient frame)
-    B0vec = numpy.array([B0vec])
-    d = numpy.array(label.GetDirection())
-    M = d.reshape(3,3)
-    M = M.transpose()
-    # Calculate the magnitudes of inner products (or cosines, assuming the vectors are normal)
-    ac = numpy.abs(numpy.inner(M,B0vec))
-
-    B0_dir = 2 - numpy.argmax(ac) # Needs to be flipped for numpy; (x,y,z) in NRRD becomes (z,y,x)
-
-    print('B0_dir = ' + str(B0_dir))
-
-    array_label = sitk.GetArrayFromImage(label)
-    shape_org = array_label.shape
-    mask = 1.0 - array_label
-
-    N = array_label.shape[0]
-    r = numpy.pi*(N-1)/N
-    zs = numpy.linspace(-r, r, N)
-    N = array_label.shape[1]
-    r = numpy.pi*(N-1)/N
-    ys = numpy.linspace(-r, r, N)
-    N = array_label.shape[2]
-    r = numpy.pi*(N-1)/N
-    xs = numpy.linspace(-r, r, N)
-    k_grid = numpy.meshgrid(zs, ys, xs, indexing='ij')
-
-    k_label = (1./3. - k_grid[B0_dir]**2 / (k_grid[0]**2 + k_grid[1]**2 + k_grid[2]**2)) * self.ft3d(array_label)
-    p_susc = gammaPI * H0 * TE * deltaChi * numpy.real(self.ift3d(k_label))
-
-    # Mask
-    p_susc = p_susc * mask
-
-    suscMap = sitk.GetImageFromArray(p_susc)
-    suscMap.SetOrigin(label.GetOrigin())
-    suscMap.SetSpacing(label.GetSpacing())
-    suscMap.SetDirection(label.GetDirection())
-
-    return suscMap
+    p_susc = Engine.generateSusceptibilityMap(sitk.GetArrayFromImage(label), label.GetDirection(), param,
+                                              self.engine.kernelCache, label.GetSpacing())
+
+    return Engine.VolumeGeometry.fromImage(label).toImage(p_susc)
 
 
   def segmentObject(self, baselineImage, referenceImage, param):
 
-    # Subtraction
-    image_diff = baselineImage - referenceImage
-
-    # Threshold
-    otsu_filter = sitk.MaximumEntropyThresholdImageFilter()
-    otsu_filter.SetInsideValue(0)
-    otsu_filter.SetOutsideValue(1)
-    otsu_filter.SetNumberOfHistogramBins(5)
-    image_threshold = otsu_filter.Execute(image_diff)
-
-    # Relabel connected regions
-    cc_filter = sitk.ConnectedComponentImageFilter()
-    image_cc = cc_filter.Execute(image_threshold)
-    relabel_filter = sitk.RelabelComponentImageFilter()
-    relabel_filter.SetMinimumObjectSize(30)
-    image_relabel = relabel_filter.Execute(image_cc)
-
-    # Pick the largest region (regions are sorted by area)
-    image_obj = (image_relabel == 1)
-
-    # Smoothing
-    dilate_filter = sitk.BinaryDilateImageFilter()
-    dilate_filter.SetKernelRadius([1,1,1])
-    dilate_filter.SetForegroundValue(1.0)
-    dilate_filter.SetBackgroundValue(0.0)
-    image_obj = dilate_filter.Execute(image_obj)
-
-    erode_filter = sitk.BinaryErodeImageFilter()
-    erode_filter.SetKernelRadius([2,2,2])
-    erode_filter.SetForegroundValue(1.0)
-    erode_filter.SetBackgroundValue(0.0)
-    image_obj = erode_filter.Execute(image_obj)
+    image_obj = sitk.GetImageFromArray(Engine.segmentObject(sitk.GetArrayFromImage(baselineImage),
+                                                            sitk.GetArrayFromImage(referenceImage)))
+    image_obj.CopyInformation(baselineImage)
 
     return image_obj
 
   
   def runMultiFrame(self, param):
     
+    # The engine and the dose are not shared with the automatic update while the frames are processed
+    with self.engineLock:
+      self.engine.resetTemporalUnwrapping()
+      if param.get('referencePhaseFile'):
+        return self.runMultiFrameStream(param)
+      if param.get('batchMode'):
+        return self.runMultiFrameBatch(param)
+      return self.runMultiFrameSequence(param)
+
+
+  def runMultiFrameSequence(self, param):
+    
     # Run the algorithm for each volume frame under the given sequence node.
     # If a baseline volume is not specified, the first frame is used as the baseline for the temperature calculation.
     # Note that this function temporarily copies the baseline and reference nodes from the sequence node
@@ -1080,9 +1621,10 @@ class PRFThermometryLogic(ScriptedLoadableModuleLogic):
     prefix = '%s_TempMap_' % refSeqNode.GetName()
 
     # Set up the output sequence node
-    tempMapSeqNode.SetIndexType(refSeqNode.GetIndexType())
-    tempMapSeqNode.SetIndexName(refSeqNode.GetIndexName())
-    tempMapSeqNode.SetIndexUnit(unit)
+    if tempMapSeqNode:
+      tempMapSeqNode.SetIndexType(refSeqNode.GetIndexType())
+      tempMapSeqNode.SetIndexName(refSeqNode.GetIndexName())
+      tempMapSeqNode.SetIndexUnit(unit)
     
     # If 'baselinePhaseVolumeNode' is None, use the first image as a baseline
     if param['baselinePhaseVolumeNode'] == None:
@@ -1098,22 +1640,48 @@ class PRFThermometryLogic(ScriptedLoadableModuleLogic):
     tempMapNode.SetName(prefix+'Temp')
     slicer.mrmlScene.AddNode(tempMapNode)
     singleParam['tempMapVolumeNode'] = tempMapNode
-    
-    for i in range(nVolumes):
-      print('Processing image # %d / %d' % ((i+1), nVolumes))
-      phaseVolumeNode = refSeqNode.GetNthDataNode(i)
-      copiedPhaseVolumeNode = slicer.mrmlScene.CopyNode(phaseVolumeNode)
-      indexValue = refSeqNode.GetNthIndexValue(i)
-      singleParam['referencePhaseVolumeNode'] = copiedPhaseVolumeNode
-      self.runSingleFrame(singleParam)
 
-      tempMapSeqNode.SetDataNodeAtValue(tempMapNode, indexValue)
-      n = tempMapSeqNode.GetItemNumberFromIndexValue(indexValue)
-      # Give a new new to the copied TempMap under the sequence.
-      dnode = tempMapSeqNode.GetNthDataNode(n)
-      dnode.SetName('%s%s%s' % (prefix, indexValue, unit))
-
-      slicer.mrmlScene.RemoveNode(copiedPhaseVolumeNode)
+    # Thermal dose, accumulated over the frames (see getDoseTimes())
+    doseTimes = self.getDoseTimes(param, [refSeqNode.GetNthIndexValue(i) for i in range(nVolumes)], unit)
+    self.doseAccumulator.reset()
+
+    # The output frame file is opened once the shape of the temperature maps is known
+    writer = None
+    try:
+      for i in range(nVolumes):
+        logging.info('Processing image # %d / %d' % ((i+1), nVolumes))
+        phaseVolumeNode = refSeqNode.GetNthDataNode(i)
+        copiedPhaseVolumeNode = slicer.mrmlScene.CopyNode(phaseVolumeNode)
+        indexValue = refSeqNode.GetNthIndexValue(i)
+        singleParam['referencePhaseVolumeNode'] = copiedPhaseVolumeNode
+        completed = self.runSingleFrame(singleParam)
+
+        if doseTimes and completed:
+          # The temperature before the threshold (see getDoseTemperature())
+          temperature = self.engine.convertTemperature(self.resultCache.entry['phaseDiff'], singleParam)
+          self.doseAccumulator.update(temperature, doseTimes[i])
+
+        if param.get('tempMapFile'):
+          temperature = self.volumeIO.pull(tempMapNode)
+          if writer is None:
+            writer = self.openTempMapFile(param, temperature.shape, self.getVolumeGeometry(tempMapNode),
+                                          refSeqNode.GetIndexName(), unit)
+          writer.append(temperature, indexValue)
+
+        if tempMapSeqNode:
+          tempMapSeqNode.SetDataNodeAtValue(tempMapNode, indexValue)
+          n = tempMapSeqNode.GetItemNumberFromIndexValue(indexValue)
+          # Give a new new to the copied TempMap under the sequence.
+          dnode = tempMapSeqNode.GetNthDataNode(n)
+          dnode.SetName('%s%s%s' % (prefix, indexValue, unit))
+
+        slicer.mrmlScene.RemoveNode(copiedPhaseVolumeNode)
+    finally:
+      if writer is not None:
+        writer.close()
+
+    if doseTimes:
+      self.pushDose(param, self.doseAccumulator.dose, self.getVolumeGeometry(tempMapNode))
 
     if param['baselinePhaseVolumeNode'] == None:
       slicer.mrmlScene.RemoveNode(copiedBaselinePhaseVolumeNode)
@@ -1122,7 +1690,367 @@ class PRFThermometryLogic(ScriptedLoadableModuleLogic):
     colorScaleMax            = param['colorScaleMax']
     colorScaleMin            = param['colorScaleMin']
     
-    self.setProxyNode(tempMapSeqNode, colorScaleMin, colorScaleMax)
+    if tempMapSeqNode:
+      self.setProxyNode(tempMapSeqNode, colorScaleMin, colorScaleMax)
+
+
+  def runMultiFrameBatch(self, param):
+
+    # Vectorized version of runMultiFrame(). The frames are read directly from the sequence node
+    # (without copying them to the Slicer scene), stacked into a single (T, Z, Y, X) array, and
+    # processed by the engine in one pass. The temperature maps are then written to the output
+    # sequence node in bulk.
+
+    refSeqNode     = param['referencePhaseSequenceNode']
+    tempMapSeqNode = param['tempMapSequenceNode']
+    maskVolumeNode = param['maskVolumeNode']
+
+    nVolumes = refSeqNode.GetNumberOfDataNodes()
+    if nVolumes == 0:
+      logging.warning('runMultiFrameBatch: the reference phase sequence is empty.')
+      return False
+
+    startTime = time.time()
+
+    # The whole series is profiled as a single frame (see Profiling.py)
+    profiler = self.engine.profiler
+    profile = profiler.beginFrame('%s (%d frames)' % (refSeqNode.GetName(), nVolumes))
+    with profiler.activate(profile):
+      unit = refSeqNode.GetIndexUnit()
+      prefix = '%s_TempMap_' % refSeqNode.GetName()
+
+      # Set up the output sequence node
+      if tempMapSeqNode:
+        tempMapSeqNode.SetIndexType(refSeqNode.GetIndexType())
+        tempMapSeqNode.SetIndexName(refSeqNode.GetIndexName())
+        tempMapSeqNode.SetIndexUnit(unit)
+
+      # If 'baselinePhaseVolumeNode' is None, use the first image as a baseline
+      baselinePhaseVolumeNode = param['baselinePhaseVolumeNode']
+      if baselinePhaseVolumeNode == None:
+        baselinePhaseVolumeNode = refSeqNode.GetNthDataNode(0)
+
+      # Check the scalar type (Siemens SRC sends image data in 'short' instead of 'unsigned short')
+      scalarType = ''
+      if baselinePhaseVolumeNode.GetImageData() != None:
+        scalarType = baselinePhaseVolumeNode.GetImageData().GetScalarTypeAsString()
+
+      useMaskVolume = param.get('simpleMask') not in ('disk', 'ellipsoid') and maskVolumeNode
+      baselineKey = self.getBaselineKey(baselinePhaseVolumeNode, maskVolumeNode if useMaskVolume else None)
+
+      with profiler.stage('pull'):
+        arrayBaseline = self.volumeIO.pull(baselinePhaseVolumeNode)
+        arrayReference = numpy.empty((nVolumes,) + arrayBaseline.shape, dtype=Engine.getFloatType(param))
+        for i in range(nVolumes):
+          arrayReference[i] = self.volumeIO.pull(refSeqNode.GetNthDataNode(i))
+
+        arrayMask = None
+        if useMaskVolume:
+          arrayMask = self.volumeIO.pull(maskVolumeNode)
+
+        arrayObjectLabel = None
+        if param['suscCorrMethod'] == 'manual' and param['suscCorrObjectLabelNode']:
+          arrayObjectLabel = self.volumeIO.pull(param['suscCorrObjectLabelNode'])
+
+      # Frames are processed in parallel if more than one worker is requested (0: number of CPUs)
+      executor = None
+      if param.get('parallelWorkers', 1) != 1:
+        executor = Parallel.FrameExecutor(param['parallelWorkers'], param.get('parallelMode', 'thread'))
+
+      loadTime = time.time()
+
+      result = self.engine.runSeries(arrayBaseline, arrayReference, param, mask=arrayMask, scalarType=scalarType,
+                                     geometry=self.getVolumeGeometry(baselinePhaseVolumeNode),
+                                     objectLabel=arrayObjectLabel, baselineKey=baselineKey, executor=executor,
+                                     baselineLibrary=self.getBaselineLibrary(param))
+      del arrayReference
+
+      computeTime = time.time()
+
+      # Thermal dose, accumulated over the frames (see getDoseTimes())
+      doseTimes = self.getDoseTimes(param, [refSeqNode.GetNthIndexValue(i) for i in range(nVolumes)], unit)
+      if doseTimes:
+        self.doseAccumulator.reset()
+        for i, temperature in enumerate(self.getDoseTemperature(result, param)):
+          self.doseAccumulator.update(temperature, doseTimes[i])
+        self.pushDose(param, self.doseAccumulator.dose, self.getVolumeGeometry(baselinePhaseVolumeNode))
+
+      # Write the output sequence and/or the output frame file. The sequence node deep-copies the
+      # data node, so a single temporary node (not added to the scene) is reused for all frames.
+      with profiler.stage('push'):
+        tempMapNode = slicer.vtkMRMLScalarVolumeNode()
+        tempMapNode.CopyOrientation(baselinePhaseVolumeNode)
+        self.setOutputScale(tempMapNode, param)
+        temperature = Engine.quantizeTemperature(result.temperature, param)
+        writer = self.openTempMapFile(param, temperature.shape[1:], self.getVolumeGeometry(baselinePhaseVolumeNode),
+                                      refSeqNode.GetIndexName(), unit)
+        try:
+          for i in range(nVolumes):
+            indexValue = refSeqNode.GetNthIndexValue(i)
+            self.appendTempMapFrame(tempMapSeqNode, tempMapNode, writer, temperature[i], indexValue,
+                                    '%s%s%s' % (prefix, indexValue, unit))
+        finally:
+          if writer is not None:
+            writer.close()
+
+      if tempMapSeqNode:
+        with profiler.stage('display'):
+          self.setProxyNode(tempMapSeqNode, param['colorScaleMin'], param['colorScaleMax'])
+
+    profiler.endFrame(profile)
+
+    endTime = time.time()
+    logging.info('runMultiFrameBatch: %d frames in %.3f s (%.1f frames/s; load %.3f s, compute %.3f s, write %.3f s)'
+                 % (nVolumes, endTime - startTime, nVolumes / max(endTime - startTime, 1e-9),
+                    loadTime - startTime, computeTime - loadTime, endTime - computeTime))
+
+    return True
+
+
+  def runMultiFrameStream(self, param):
+
+    # Out-of-core version of runMultiFrameBatch(). The reference frames are read lazily from
+    # param['referencePhaseFile'] (see PRFThermometryLib/Streaming.py) and processed in chunks of
+    # param['streamChunkSize'] frames, so only a few input frames are in memory at a time, and
+    # only the output sequence is kept in the scene.
+
+    tempMapSeqNode = param['tempMapSequenceNode']
+    maskVolumeNode = param['maskVolumeNode']
+
+    series = Streaming.openSeries(param['referencePhaseFile'])
+    nVolumes = len(series)
+    if nVolumes == 0:
+      logging.warning('runMultiFrameStream: the reference phase file is empty.')
+      return False
+
+    startTime = time.time()
+
+    profiler = self.engine.profiler
+    profile = profiler.beginFrame('%s (%d frames)' % (os.path.basename(param['referencePhaseFile']), nVolumes))
+    with profiler.activate(profile):
+      prefix = '%s_TempMap_' % os.path.basename(param['referencePhaseFile']).split('.')[0]
+      if tempMapSeqNode:
+        tempMapSeqNode.SetIndexType(tempMapSeqNode.NumericIndex)
+        tempMapSeqNode.SetIndexName('frame')
+        tempMapSeqNode.SetIndexUnit('')
+
+      # If 'baselinePhaseVolumeNode' is None, use the first frame as a baseline
+      baselinePhaseVolumeNode = param['baselinePhaseVolumeNode']
+      useMaskVolume = param.get('simpleMask') not in ('disk', 'ellipsoid') and maskVolumeNode
+      with profiler.stage('pull'):
+        if baselinePhaseVolumeNode != None:
+          arrayBaseline = self.volumeIO.pull(baselinePhaseVolumeNode)
+          geometry = self.getVolumeGeometry(baselinePhaseVolumeNode)
+          scalarType = ''
+          if baselinePhaseVolumeNode.GetImageData() != None:
+            scalarType = baselinePhaseVolumeNode.GetImageData().GetScalarTypeAsString()
+        else:
+          arrayBaseline = series[0]
+          geometry = series.geometry
+          scalarType = series.scalarType
+        arrayMask = self.volumeIO.pull(maskVolumeNode) if useMaskVolume else None
+        arrayObjectLabel = None
+        if param['suscCorrMethod'] == 'manual' and param['suscCorrObjectLabelNode']:
+          arrayObjectLabel = self.volumeIO.pull(param['suscCorrObjectLabelNode'])
+
+      executor = None
+      if param.get('parallelWorkers', 1) != 1:
+        executor = Parallel.FrameExecutor(param['parallelWorkers'], param.get('parallelMode', 'thread'))
+
+      tempMapNode = slicer.vtkMRMLScalarVolumeNode()
+      self.setVolumeGeometry(tempMapNode, geometry)
+      self.setOutputScale(tempMapNode, param)
+      writer = self.openTempMapFile(param, series.frameShape, geometry)
+
+      # Thermal dose (if the frames of the file are timed, see getDoseTimes())
+      indexValues = series.indexValues if series.indexValues is not None else range(nVolumes)
+      doseTimes = self.getDoseTimes(param, indexValues, series.indexUnit)
+      self.doseAccumulator.reset()
+      try:
+        for start, result in self.engine.iterSeries(arrayBaseline, series, param, mask=arrayMask, scalarType=scalarType,
+                                                    geometry=geometry, objectLabel=arrayObjectLabel, executor=executor,
+                                                    chunkSize=param.get('streamChunkSize', 8),
+                                                    baselineLibrary=self.getBaselineLibrary(param)):
+          logging.info('Processed frames %d-%d / %d' % (start + 1, start + result.temperature.shape[0], nVolumes))
+          if doseTimes:
+            for i, temperature in enumerate(self.getDoseTemperature(result, param)):
+              self.doseAccumulator.update(temperature, doseTimes[start + i])
+          with profiler.stage('push'):
+            for i, temperature in enumerate(Engine.quantizeTemperature(result.temperature, param)):
+              indexValue = str(start + i)
+              self.appendTempMapFrame(tempMapSeqNode, tempMapNode, writer, temperature, indexValue,
+                                      '%s%s' % (prefix, indexValue))
+      finally:
+        series.close()
+        if writer is not None:
+          writer.close()
+
+      if doseTimes:
+        self.pushDose(param, self.doseAccumulator.dose, geometry)
+
+      if tempMapSeqNode:
+        with profiler.stage('display'):
+          self.setProxyNode(tempMapSeqNode, param['colorScaleMin'], param['colorScaleMax'])
+
+    profiler.endFrame(profile)
+
+    endTime = time.time()
+    logging.info('runMultiFrameStream: %d frames in %.3f s (%.1f frames/s)'
+                 % (nVolumes, endTime - startTime, nVolumes / max(endTime - startTime, 1e-9)))
+
+    return True
+
+
+  def isDoseEnabled(self, param):
+    return bool(param.get('doseVolumeNode') or param.get('doseLabelNode'))
+
+
+  def getDoseTimes(self, param, indexValues, indexUnit):
+    """Return the times (minutes) of the frames for the thermal dose, given the index values and the
+    index unit (e.g. 's') of a sequence. Returns None if no dose output is set, or (with a warning)
+    if the index is not a time.
+    """
+    if not self.isDoseEnabled(param):
+      return None
+    scale = Engine.getTimeScale(indexUnit)
+    try:
+      if scale is None:
+        raise ValueError(indexUnit)
+      return [float(value) * scale for value in indexValues]
+    except ValueError:
+      logging.warning("The thermal dose is not computed: the frame index (unit '%s') is not a time." % indexUnit)
+      return None
+
+
+  def pushDose(self, param, dose, geometry):
+    """Push a thermal dose map (CEM43) to param['doseVolumeNode'] and the label map of the voxels
+    above param['doseThreshold'] to param['doseLabelNode'] (if set).
+    """
+    threshold = param.get('doseThreshold', 240.0)
+    doseVolumeNode = param.get('doseVolumeNode')
+    if doseVolumeNode:
+      self.volumeIO.push(doseVolumeNode, dose, geometry)
+      if doseVolumeNode.GetDisplayNode() == None:
+        doseVolumeNode.CreateDefaultDisplayNodes()
+      dnode = doseVolumeNode.GetDisplayNode()
+      dnode.SetAutoWindowLevel(0)
+      dnode.SetWindowLevelMinMax(0.0, threshold)
+
+    doseLabelNode = param.get('doseLabelNode')
+    if doseLabelNode:
+      self.volumeIO.push(doseLabelNode, Engine.getDoseLabel(dose, threshold), geometry)
+      if doseLabelNode.GetDisplayNode() == None:
+        doseLabelNode.CreateDefaultDisplayNodes()
+
+
+  def openTempMapFile(self, param, frameShape, geometry, indexName='frame', indexUnit=''):
+    """Return a Streaming.FrameWriter for the output frame file (param['tempMapFile']), or None if
+    no output file is set. The temperature maps are stored as selected by param['outputType'], but
+    at most in single precision.
+    """
+    if not param.get('tempMapFile'):
+      return None
+    dtype = Engine.getOutputFormat(param)[0]
+    if dtype == numpy.float64:
+      dtype = numpy.float32
+    return Streaming.FrameWriter(param['tempMapFile'], frameShape, dtype, geometry, indexName, indexUnit,
+                                 metaData=Engine.getOutputMetaData(param))
+
+
+  def appendTempMapFrame(self, tempMapSeqNode, tempMapNode, writer, temperature, indexValue, name):
+    """Append an output frame (stored values, see Engine.quantizeTemperature()) to the frame file
+    ('writer', if any) and to the output sequence node (if any). 'tempMapNode' is a temporary volume
+    node that is deep-copied into the sequence.
+    """
+    if writer is not None:
+      writer.append(temperature, indexValue)
+    if tempMapSeqNode:
+      self.volumeIO.push(tempMapNode, temperature)
+      tempMapSeqNode.SetDataNodeAtValue(tempMapNode, indexValue)
+      n = tempMapSeqNode.GetItemNumberFromIndexValue(indexValue)
+      tempMapSeqNode.GetNthDataNode(n).SetName(name)
+
+
+  def getStoredFrameCount(self, path):
+    """Return the number of frames in an output frame file (0 if it does not exist).
+    """
+    headerPath = Streaming.getFrameFilePaths(path)[0] if path else None
+    if not headerPath or not os.path.exists(headerPath):
+      return 0
+    series = Streaming.openSeries(headerPath)
+    nFrames = len(series)
+    series.close()
+    return nFrames
+
+
+  def showStoredFrame(self, path, index, colorScaleMin, colorScaleMax, displayInterpolation):
+    """Read a single frame of an output frame file and show it in a review volume node.
+    """
+    series = Streaming.openSeries(Streaming.getFrameFilePaths(path)[0])
+    try:
+      index = min(index, len(series) - 1)
+      temperature = numpy.array(series[index])
+      geometry = series.geometry
+      metaData = series.metaData or {}
+    finally:
+      series.close()
+
+    name = '%s_Review' % os.path.basename(path).split('.')[0]
+    reviewNode = slicer.mrmlScene.GetFirstNodeByName(name)
+    if reviewNode == None:
+      reviewNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+    self.volumeIO.push(reviewNode, temperature, geometry)
+    self.setOutputMetaData(reviewNode, metaData)
+    self.setTempMapDisplay(reviewNode, colorScaleMin, colorScaleMax, displayInterpolation)
+    slicer.util.setSliceViewerLayers(foreground=reviewNode)
+    return reviewNode
+
+
+  def getNodeKey(self, value):
+    """Return a key that changes whenever the node or its image data is modified, or None if 'value'
+    is not a node (see VolumeIO.VolumeIO.getNodeKey()).
+    """
+    return self.volumeIO.getNodeKey(value)
+
+
+  def getBaselineLibrary(self, param):
+    """Return the Baselines.BaselineLibrary of the frames of param['baselineLibrarySequenceNode'], or None.
+    The library (and its index) is rebuilt only if the sequence or the mask change.
+    """
+    sequenceNode = param.get('baselineLibrarySequenceNode')
+    if not sequenceNode or sequenceNode.GetNumberOfDataNodes() == 0:
+      return None
+    maskVolumeNode = param['maskVolumeNode'] if param.get('simpleMask') not in ('disk', 'ellipsoid') else None
+    key = (sequenceNode.GetID(), sequenceNode.GetMTime(), self.getNodeKey(maskVolumeNode))
+    if key != self.baselineLibraryKey:
+      imageData = sequenceNode.GetNthDataNode(0).GetImageData()
+      scalarType = imageData.GetScalarTypeAsString() if imageData != None else ''
+      mask = self.volumeIO.pull(maskVolumeNode) > 0 if maskVolumeNode else None
+      library = Baselines.BaselineLibrary(mask, scalarType)
+      for i in range(sequenceNode.GetNumberOfDataNodes()):
+        library.add(self.volumeIO.pull(sequenceNode.GetNthDataNode(i), copy=True))
+      self.baselineLibrary = library
+      self.baselineLibraryKey = key
+    return self.baselineLibrary
+
+
+  def getBaselineKey(self, baselinePhaseVolumeNode, maskVolumeNode=None):
+    """Key identifying the baseline (and mask) data for the engine's baseline cache.
+    """
+    return (self.getNodeKey(baselinePhaseVolumeNode), self.getNodeKey(maskVolumeNode))
+
+
+  def getVolumeGeometry(self, volumeNode):
+    """Return the geometry of a volume node in the SimpleITK (LPS) convention.
+    """
+    return self.volumeIO.getGeometry(volumeNode)
+
+
+  def setVolumeGeometry(self, volumeNode, geometry):
+    """Set the geometry of a volume node from a geometry in the SimpleITK (LPS) convention
+    (the inverse of getVolumeGeometry()).
+    """
+    self.volumeIO.setGeometry(volumeNode, geometry)
 
 
   def setProxyNode(self, sequenceNode, scaleMin, scaleMax):
@@ -1156,16 +2084,19 @@ class PRFThermometryLogic(ScriptedLoadableModuleLogic):
     dNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileColdToHotRainbow.txt')
     dNode.SetWindowLevelLocked(0)
     dNode.SetAutoWindowLevel(0)
-    dNode.SetWindowLevelMinMax(scaleMin, scaleMax)
+    # Scaled maps: see setTempMapDisplay()
+    if sequenceNode.GetNumberOfDataNodes() > 0:
+      self.setOutputMetaData(pNode, self.getOutputMetaData(sequenceNode.GetNthDataNode(0)))
+    scale, offset = self.getOutputScale(pNode)
+    dNode.SetWindowLevelMinMax((scaleMin - offset) / scale, (scaleMax - offset) / scale)
     
   
-  def unwrap(self, imagePhase):
-    imagePhaseNP = sitk.GetArrayFromImage(imagePhase)
-    imageUnwrappedNP = unwrap_phase(imagePhaseNP)
-    imageUnwrapped = sitk.GetImageFromArray(imageUnwrappedNP)
-    imageUnwrapped.SetOrigin(imagePhase.GetOrigin())
-    imageUnwrapped.SetSpacing(imagePhase.GetSpacing())
-    imageUnwrapped.SetDirection(imagePhase.GetDirection())
+  def getUnwrapMethods(self):
+    return Unwrapping.getUnwrapperNames()
+
+  def unwrap(self, imagePhase, method='skimage'):
+    imageUnwrapped = sitk.GetImageFromArray(Engine.unwrap(sitk.GetArrayFromImage(imagePhase), method=method))
+    imageUnwrapped.CopyInformation(imagePhase)
 
     return imageUnwrapped
     
@@ -1200,28 +2131,87 @@ class PRFThermometryTest(ScriptedLoadableModuleTest):
     your test should break so they know that the feature is needed.
     """
 
-    pass
-
-    #self.delayDisplay("Starting the test")
-    ##
-    ## first, get some data
-    ##
-    #import urllib
-    #downloads = (
-    #    ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-    #    )
-    #
-    #for url,name,loader in downloads:
-    #  filePath = slicer.app.temporaryPath + '/' + name
-    #  if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-    #    logging.info('Requesting download %s from %s...\n' % (name, url))
-    #    urllib.urlretrieve(url, filePath)
-    #  if loader:
-    #    logging.info('Loading %s...' % (name,))
-    #    loader(filePath)
-    #self.delayDisplay('Finished with download and loading')
-    #
-    #volumeNode = slicer.util.getNode(pattern="FA")
-    #logic = PRFThermometryLogic()
-    #self.assertTrue( logic.hasImageData(volumeNode) )
-    #self.delayDisplay('Test passed!')
+    self.delayDisplay("Starting the test")
+
+    # Synthetic phantom with a heating spot and an object (see PRFThermometryLib/Phantom.py)
+    generator = Phantom.PhantomGenerator((16,64,64), frames=4)
+    param = generator.getParam()
+    engine = Engine.ThermometryEngine()
+    result = engine.runSeries(generator.getBaseline(), generator.getReferenceSeries(), param,
+                              mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    evaluationMask = generator.getEvaluationMask()
+    for i in range(generator.frames):
+      error = numpy.abs(result.temperature[i] - generator.getTemperature(i))[evaluationMask]
+      self.assertLess(error.max(), 3.0)
+
+    # The single-frame path gives the same temperature as the series path
+    single = engine.run(generator.getBaseline(), generator.getReference(0), param, mask=generator.getMask(),
+                        objectLabel=generator.getObjectLabel())
+    self.assertTrue(numpy.allclose(single.temperature, result.temperature[0]))
+
+    # Scaled short output: within half a step of the temperature
+    quantizedParam = dict(param, outputType='short', outputScale=0.01)
+    stored = Engine.quantizeTemperature(result.temperature, quantizedParam)
+    self.assertEqual(stored.dtype, numpy.int16)
+    scale, offset = Engine.getOutputScale(Engine.getOutputMetaData(quantizedParam))
+    error = numpy.abs(Engine.dequantizeTemperature(stored, scale, offset) - result.temperature)
+    self.assertLessEqual(error.max(), 0.005 + 1e-9)
+    self.assertEqual(Engine.getOutputMetaData(quantizedParam)[Engine.outputUnitsKey], '0.01 deg C')
+
+    # Thermal dose: 10 minutes at 43 deg C is 10 CEM43, at 44 deg C 20 CEM43
+    accumulator = Engine.DoseAccumulator()
+    for minute in range(11):
+      dose = accumulator.update(numpy.array([43.0, 44.0, 37.0]), float(minute))
+    self.assertTrue(numpy.allclose(dose[:2], [10.0, 20.0]))
+    self.assertEqual(list(Engine.getDoseLabel(dose, 15.0)), [0, 1, 0])
+
+    # The dose is accumulated from the temperature before the threshold, so the hottest voxels
+    # (set to 0 by the threshold) still gain dose
+    thresholdParam = dict(param, upperThreshold=60.0)
+    thresholded = engine.runSeries(generator.getBaseline(), generator.getReferenceSeries(), thresholdParam,
+                                   mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    hottest = numpy.unravel_index(numpy.argmax(result.temperature[-1]), result.temperature.shape[1:])
+    self.assertEqual(thresholded.temperature[-1][hottest], 0.0)
+    accumulator = Engine.DoseAccumulator()
+    for i, temperature in enumerate(PRFThermometryLogic().getDoseTemperature(thresholded, thresholdParam)):
+      dose = accumulator.update(temperature, float(i))
+    self.assertGreater(dose[hottest], 10.0)
+
+    # Baseline library: the nearest baseline is used (the same result as with that baseline alone)
+    library = Baselines.BaselineLibrary(generator.getMask())
+    library.add(generator.getReference(3))
+    library.add(generator.getBaseline())
+    libraryResult = engine.run(None, generator.getReference(0), param, objectLabel=generator.getObjectLabel(),
+                               baselineLibrary=library)
+    self.assertEqual(library.lastMatch.index, 1)
+    self.assertTrue(numpy.allclose(libraryResult.temperature, single.temperature))
+
+    # Referenceless: a polynomial background is removed without a baseline, and the fit is reused
+    z, y, x = numpy.mgrid[0:8, 0:32, 0:32] / 32.0
+    background = 0.5 + 0.8 * x - 0.6 * y * y + 0.3 * x * z
+    referencelessParam = dict(param, referenceless=True, suscCorrMethod='off', simpleMask=None,
+                              usePhaseUnwrapping=False, usePhaseUnwrappingPost=False)
+    for i in range(2):
+      fitResult = engine.run(None, background * 4096.0 / numpy.pi, referencelessParam)
+      self.assertLess(numpy.abs(fitResult.phaseDiff).max(), 1e-9)
+    self.assertEqual((engine.polynomialFitCache.misses, engine.polynomialFitCache.hits), (1, 1))
+
+    # Automatic susceptibility correction: unchanged magnitude images are segmented (and convolved) once
+    autoParam = dict(param, suscCorrMethod='auto')
+    for i in range(2):
+      engine.run(generator.getBaseline(), generator.getReference(0), autoParam, mask=generator.getMask(),
+                 objectBaseline=generator.getObjectBaseline(), objectReference=generator.getObjectReference())
+    self.assertEqual((engine.susceptibilityCache.misses, engine.susceptibilityCache.hits), (1, 1))
+
+    # Volume I/O on the in-memory scene: the input is viewed, the output is written in place
+    scene = VolumeIO.MemoryScene()
+    volumeIO = VolumeIO.MemoryVolumeIO()
+    referenceNode = scene.addVolume('reference', generator.getReference(0))
+    tempMapNode = scene.addVolume('TempMap', numpy.zeros(generator.shape))
+    ioResult = engine.run(generator.getBaseline(), volumeIO.pull(referenceNode), param, mask=generator.getMask(),
+                          objectLabel=generator.getObjectLabel())
+    volumeIO.push(tempMapNode, ioResult.temperature, volumeIO.getGeometry(referenceNode))
+    self.assertEqual((volumeIO.views, volumeIO.copies), (1, 1))
+    self.assertTrue(numpy.array_equal(tempMapNode.array, single.temperature))
+
+    self.delayDisplay('Test passed!')
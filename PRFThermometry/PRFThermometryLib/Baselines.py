@@ -0,0 +1,142 @@
+"""Multi-baseline library for moving organs.
+
+With respiratory motion, a single baseline only matches the reference frames acquired in the same
+phase of the breathing cycle. A BaselineLibrary stores the pre-heating frames acquired over the
+cycle, and the baseline of each reference frame is the library frame with the closest signature.
+
+A signature is the complex phase exp(i*phase), averaged in blocks of 'downsample' voxels (inside
+the mask), with the global phase removed so that a uniform drift does not change the match. The
+signatures are projected on their first principal components, and the nearest candidates are
+found with a KD-tree; the candidates are then ranked by the distance of the full signatures. The
+cost per frame is therefore nearly independent of the number of baselines.
+
+  library = Baselines.BaselineLibrary(mask, scalarType='short')
+  for frame in preheatingFrames:
+    library.add(frame)
+  result = engine.run(None, reference, param, baselineLibrary=library)
+"""
+
+import collections
+import itertools
+import numpy
+import scipy.spatial
+
+from . import Engine
+
+
+Match = collections.namedtuple('Match', ['index', 'distance'])
+
+_libraryIds = itertools.count()
+
+
+class BaselineLibrary(object):
+  """Library of raw baseline phase frames (Z, Y, X) with a nearest-baseline index.
+
+  'mask' (voxels > 0) limits the signatures and is used for the preprocessing of the baselines.
+  'components' is the number of principal components of the index, and 'candidates' the number of
+  nearest baselines compared with the full signatures. The preprocessed baselines (see
+  ThermometryEngine.prepareBaseline()) of the last 'maxPrepared' baselines used are kept.
+  """
+
+  def __init__(self, mask=None, scalarType='', downsample=4, components=8, candidates=4, maxPrepared=16):
+    self.mask = mask
+    self.scalarType = scalarType
+    self.downsample = downsample
+    self.components = components
+    self.candidates = candidates
+    self.maxPrepared = maxPrepared
+    self.id = next(_libraryIds)
+    self.clear()
+
+  def clear(self):
+    self.baselines = []
+    self.signatures = []
+    self.prepared = collections.OrderedDict()
+    self.lastMatch = None
+    self._matrix = None
+    self._mean = None
+    self._projection = None
+    self._tree = None
+
+  def __len__(self):
+    return len(self.baselines)
+
+  def add(self, baseline):
+    """Add a raw baseline phase frame and return its index.
+    """
+    baseline = numpy.asarray(baseline)
+    if self.baselines and baseline.shape != self.baselines[0].shape:
+      raise ValueError('BaselineLibrary: frame shape %s differs from %s' % (baseline.shape, self.baselines[0].shape))
+    self.baselines.append(baseline)
+    self.signatures.append(self.getSignature(baseline))
+    self._matrix = None
+    return len(self.baselines) - 1
+
+  def getSignature(self, frame):
+    """Return the signature (float32 vector) of a raw phase frame.
+    """
+    z = numpy.exp(1.0j * Engine.scalePhase(numpy.asarray(frame, dtype=numpy.float32), self.scalarType))
+    if self.mask is not None:
+      z *= Engine.getInsideMask(self.mask)
+
+    # Block average (the last incomplete blocks are cropped)
+    factors = [max(1, min(self.downsample, n)) for n in z.shape]
+    blocks = [n // f for n, f in zip(z.shape, factors)]
+    z = z[tuple(slice(0, b * f) for b, f in zip(blocks, factors))]
+    z = z.reshape(blocks[0], factors[0], blocks[1], factors[1], blocks[2], factors[2]).mean(axis=(1, 3, 5))
+
+    # Remove the global phase
+    total = z.sum()
+    if abs(total) > 0.0:
+      z *= numpy.conj(total) / abs(total)
+    return numpy.concatenate([z.real.ravel(), z.imag.ravel()]).astype(numpy.float32)
+
+  def buildIndex(self):
+    """(Re)build the index of the signatures. Called on the first lookup after add().
+    """
+    self._matrix = numpy.array(self.signatures)
+    self._mean = self._matrix.mean(axis=0)
+    self._tree = None
+    if len(self.signatures) > self.candidates:
+      centered = self._matrix - self._mean
+      components = min(self.components, len(self.signatures) - 1)
+      _, _, vt = numpy.linalg.svd(centered, full_matrices=False)
+      self._projection = vt[:components].T
+      self._tree = scipy.spatial.cKDTree(centered.dot(self._projection))
+
+  def findNearest(self, frame):
+    """Return the Match (index, distance of the signatures) of the baseline closest to a raw phase frame.
+    """
+    if not self.baselines:
+      raise ValueError('BaselineLibrary: the library is empty')
+    if self._matrix is None:
+      self.buildIndex()
+    signature = self.getSignature(frame)
+    if self._tree is None:
+      candidates = numpy.arange(len(self.signatures))
+    else:
+      _, candidates = self._tree.query((signature - self._mean).dot(self._projection), k=self.candidates)
+      candidates = numpy.atleast_1d(candidates)
+    distances = numpy.linalg.norm(self._matrix[candidates] - signature, axis=1)
+    best = int(numpy.argmin(distances))
+    self.lastMatch = Match(int(candidates[best]), float(distances[best]))
+    return self.lastMatch
+
+  def prepare(self, engine, index, param, geometry=None):
+    """Return the preprocessed baseline 'index' (an Engine.BaselineCache) for 'engine'.
+    """
+    baselineKey = ('BaselineLibrary', self.id, int(index))
+    key = engine.getBaselineCacheKey(baselineKey, param, self.scalarType, geometry)
+    cache = self.prepared.pop(key, None)
+    if cache is None:
+      cache = Engine.BaselineCache()
+      engine.prepareBaseline(self.baselines[index], param, self.mask, self.scalarType, baselineKey, geometry, cache=cache)
+      while len(self.prepared) >= self.maxPrepared:
+        self.prepared.popitem(last=False)
+    self.prepared[key] = cache
+    return cache
+
+  def select(self, engine, frame, param, geometry=None):
+    """Return the preprocessed baseline closest to a raw phase frame (see findNearest()).
+    """
+    return self.prepare(engine, self.findNearest(frame).index, param, geometry)
@@ -0,0 +1,350 @@
+"""Headless batch reprocessing of archived PRF thermometry sessions (no Slicer required).
+
+Usage (from the PRFThermometry directory):
+
+  python -m PRFThermometryLib.Batch jobs.json --workers 4
+
+'jobs.json' lists the sessions and the parameters (relative paths are relative to the jobs file):
+
+  {
+    "param": "param.json",
+    "sessions": [
+      {"name": "case001", "baseline": "case001/baseline.nrrd", "reference": "case001/reference.nrrd",
+       "mask": "case001/mask.nrrd", "output": "out/case001_TempMap.nrrd"},
+      {"name": "case002", "reference": "case002/dicom", "output": "out/case002_TempMap.nii.gz",
+       "objectLabel": "case002/applicator-label.nrrd", "param": {"suscCorrMethod": "manual"}}
+    ]
+  }
+
+"param" is a dict or a JSON file with the keys of the PRF parameters, e.g. saved with
+"Save Parameters..." in the module panel; the values not given are the panel defaults (see
+getDefaultParam()), and a session may override them with its own "param".
+
+The reference phase series ("reference") is a 4D image (NRRD, NIfTI, ...), a list of 3D images,
+a glob pattern, or a DICOM directory (each series is a frame, or, for a single series, each
+temporal position). The frames are read lazily, a few at a time (see Streaming.py).
+Without a "baseline", the first reference frame is the baseline. "mask" and
+"objectLabel" (manual susceptibility correction) are optional. The temperature series is written
+to "output" as a 4D image. If "output" is a '.nhdr' file, the temperature maps are instead appended to
+a frame file (Streaming.FrameWriter) as they are computed, so the whole series is never held in memory.
+
+The sessions are processed concurrently on a process pool. Each completed (or failed) session is
+appended to a JSON Lines manifest (default: 'jobs.manifest.jsonl'). When the batch is run again,
+the sessions that are already done with the same inputs and parameters are skipped, so a crashed
+or interrupted batch picks up where it stopped. The 4D image outputs are written to a temporary file
+first, so an interrupted session never leaves a partial output behind (a frame file keeps the frames
+written so far, and is overwritten when the session is run again).
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+import numpy
+import SimpleITK as sitk
+
+from . import Engine
+from . import Streaming
+
+
+def getDefaultParam():
+  """Return the defaults of the PRF parameters of the module panel.
+  """
+  return {
+    'usePhaseUnwrapping': False, 'usePhaseUnwrappingPost': True, 'temporalUnwrapping': False,
+    'useMaskedUnwrapping': True, 'unwrapMethod': 'skimage', 'phaseOffsetEstimator': 'mean',
+    'useComplex': True, 'precision': 'double', 'phaseRangeShiftDeg': 30.0,
+    'referenceless': False, 'referenceless.order': 2, 'referenceless.dimension': 3,
+    'referenceless.innerRadius': 0.15, 'referenceless.outerRadius': 0.3,
+    'alpha': -0.01, 'gamma': 42.576, 'B0': 3.0, 'TE': 0.01, 'BT': 37.0,
+    'upperThreshold': 1000.0, 'lowerThreshold': -1000.0, 'simpleMask': None,
+    'suscCorrMethod': 'off', 'deltaChi': 3.2, 'B0vec': [0.0, 0.0, 1.0],
+    'suscCorrFFTPadding': 'none', 'suscCorrFFTMargin': 16, 'fftWorkers': -1,
+    'suscCorrResegment': 'always', 'suscCorrResegmentInterval': 10, 'suscCorrDiceThreshold': 0.95,
+    'outputType': 'double', 'outputScale': 0.01, 'outputOffset': 0.0,
+    }
+
+
+def saveParam(path, param):
+  """Write the parameters to a JSON file. Values that cannot be stored (e.g. MRML nodes) are skipped.
+  """
+  storable = dict((key, value) for key, value in param.items()
+                  if value is None or isinstance(value, (bool, int, float, str, list, tuple)))
+  with open(path, 'w') as f:
+    json.dump(storable, f, indent=2, sort_keys=True)
+
+
+def loadParam(path):
+  """Return the panel defaults updated with the parameters of a JSON file.
+  """
+  param = getDefaultParam()
+  with open(path) as f:
+    param.update(json.load(f))
+  return param
+
+
+#
+# Input/output
+#
+
+def getScalarType(image):
+  """Return the scalar type string used by Engine.scalePhase() for a SimpleITK image.
+  """
+  return {sitk.sitkUInt16: 'unsigned short', sitk.sitkInt16: 'short'}.get(image.GetPixelID(), '')
+
+
+def readImage(path):
+  """Read an image file, or a DICOM directory with a single frame.
+  """
+  if os.path.isdir(path):
+    frames = Streaming.getDicomFrameFileNames(path)
+    if len(frames) != 1:
+      raise ValueError("'%s' contains %d frames (expected a single volume)" % (path, len(frames)))
+    return sitk.ReadImage(frames[0])
+  return sitk.ReadImage(path)
+
+
+def writeSeries(path, series, geometry, useCompression=True, metaData=None):
+  """Write a (T, Z, Y, X) series as a 4D image. The image is written to a temporary file in the same
+  directory and renamed, so 'path' is either complete or absent. 'metaData' (a dict of strings) is
+  stored in the header (if the file format supports it, e.g. NRRD).
+  """
+  image = sitk.JoinSeries([geometry.toImage(frame) for frame in series])
+  for key, value in (metaData or {}).items():
+    image.SetMetaData(key, value)
+  directory, fileName = os.path.split(os.path.abspath(path))
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  partialPath = os.path.join(directory, '.partial-' + fileName)
+  sitk.WriteImage(image, partialPath, useCompression)
+  os.replace(partialPath, path)
+
+
+#
+# Sessions
+#
+
+def getSessionHash(session, param):
+  """Return a hash of the inputs and parameters of a session (a changed session is processed again).
+  """
+  text = json.dumps({'session': session, 'param': param}, sort_keys=True, default=str)
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def processSession(session, param, chunkSize=8):
+  """Compute the temperature series of a session and write it to session['output'].
+  The reference frames are read lazily (Streaming.openSeries()) and processed in chunks of
+  'chunkSize' frames. For a '.nhdr' output, each chunk is appended to a frame file as soon as it is
+  computed. The maps are stored as selected by param['outputType'] (see Engine.getOutputFormat()), and
+  the scale of quantized maps is recorded in the header. Returns the number of frames.
+  """
+  referenceSeries = Streaming.openSeries(session['reference'])
+  geometry = referenceSeries.geometry
+  scalarType = referenceSeries.scalarType
+  if session.get('baseline'):
+    baselineImage = readImage(session['baseline'])
+    baseline = sitk.GetArrayFromImage(baselineImage)
+    geometry = Engine.VolumeGeometry.fromImage(baselineImage)
+    scalarType = getScalarType(baselineImage)
+  else:
+    baseline = referenceSeries[0]
+  if baseline.shape != referenceSeries.frameShape:
+    raise ValueError('The baseline %s and the reference frames %s differ in size' % (baseline.shape, referenceSeries.frameShape))
+
+  mask = None
+  if session.get('mask'):
+    maskImage = readImage(session['mask'])
+    mask = sitk.GetArrayViewFromImage(maskImage) > 0
+  objectLabel = None
+  if session.get('objectLabel'):
+    objectLabel = sitk.GetArrayFromImage(readImage(session['objectLabel']))
+
+  engine = Engine.ThermometryEngine()
+  outputType = Engine.getOutputFormat(param)[0]
+  metaData = Engine.getOutputMetaData(param)
+  writer = None
+  if session['output'].endswith('.nhdr'):
+    # The frame file stores at most single precision
+    writer = Streaming.FrameWriter(session['output'], referenceSeries.frameShape,
+                                   numpy.float32 if outputType == numpy.float64 else outputType, geometry,
+                                   metaData=metaData)
+  temperature = None
+  try:
+    for start, result in engine.iterSeries(baseline, referenceSeries, param, mask=mask,
+                                           scalarType=session.get('scalarType', scalarType), geometry=geometry,
+                                           objectLabel=objectLabel, chunkSize=chunkSize):
+      stored = Engine.quantizeTemperature(result.temperature, param)
+      if writer is not None:
+        writer.extend(stored)
+        continue
+      if temperature is None:
+        temperature = numpy.empty((len(referenceSeries),) + referenceSeries.frameShape, dtype=stored.dtype)
+      temperature[start:start + stored.shape[0]] = stored
+  finally:
+    referenceSeries.close()
+    if writer is not None:
+      writer.close()
+  if writer is not None:
+    return len(writer.indexValues)
+  writeSeries(session['output'], temperature, geometry, metaData=metaData)
+  return temperature.shape[0]
+
+
+def runSession(session, param, sessionHash=None, chunkSize=8):
+  """Run processSession() and return the manifest entry of the session (errors are reported in the
+  entry, so a failed session does not stop the batch).
+  """
+  if sessionHash is None:
+    sessionHash = getSessionHash(session, param)
+  entry = {'session': session['name'], 'hash': sessionHash, 'output': session['output']}
+  startTime = time.time()
+  try:
+    entry['frames'] = processSession(session, param, chunkSize)
+    entry['status'] = 'done'
+  except Exception as e:
+    entry['status'] = 'failed'
+    entry['error'] = '%s: %s' % (type(e).__name__, e)
+    entry['traceback'] = traceback.format_exc()
+  entry['time'] = time.time() - startTime
+  entry['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+  return entry
+
+
+def loadJobs(path, param=None):
+  """Return the sessions of a jobs file, with the paths resolved and the parameters merged
+  ('param' overrides the parameters of the jobs file), as a list of (session, param).
+  """
+  with open(path) as f:
+    jobs = json.load(f)
+  baseDirectory = os.path.dirname(os.path.abspath(path))
+  resolve = lambda p: os.path.join(baseDirectory, p)
+
+  batchParam = getDefaultParam()
+  jobParam = jobs.get('param', {})
+  if isinstance(jobParam, str):
+    with open(resolve(jobParam)) as f:
+      jobParam = json.load(f)
+  batchParam.update(jobParam)
+  if param:
+    batchParam.update(param)
+
+  sessions = []
+  names = set()
+  for session in jobs['sessions']:
+    session = dict(session)
+    for key in ('baseline', 'mask', 'objectLabel', 'output'):
+      if session.get(key):
+        session[key] = resolve(session[key])
+    if isinstance(session['reference'], (list, tuple)):
+      session['reference'] = [resolve(p) for p in session['reference']]
+    else:
+      session['reference'] = resolve(session['reference'])
+    session.setdefault('name', os.path.basename(session['output']))
+    if session['name'] in names:
+      raise ValueError("Duplicate session name '%s' in '%s'" % (session['name'], path))
+    names.add(session['name'])
+    sessionParam = dict(batchParam)
+    sessionParam.update(session.pop('param', {}))
+    sessions.append((session, sessionParam))
+  return sessions
+
+
+def loadManifest(path):
+  """Return a dict mapping the session names to their last manifest entry.
+  """
+  entries = {}
+  if os.path.exists(path):
+    with open(path) as f:
+      for line in f:
+        if line.strip():
+          entry = json.loads(line)
+          entries[entry['session']] = entry
+  return entries
+
+
+def appendManifest(path, entry):
+  with open(path, 'a') as f:
+    f.write(json.dumps(entry) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def isDone(session, param, entry):
+  return (entry is not None and entry['status'] == 'done' and entry['hash'] == getSessionHash(session, param)
+          and os.path.exists(session['output']))
+
+
+def runBatch(sessions, manifestPath, workers=None, force=False, callback=None, chunkSize=8):
+  """Process the (session, param) pairs of loadJobs() on 'workers' processes (None or 0: number of
+  CPUs; 1: in the calling process), skipping the sessions done according to the manifest unless 'force'.
+  Calls 'callback(entry)' for each completed session and returns the entries of this run.
+  """
+  manifest = loadManifest(manifestPath)
+  pending = [(session, param) for session, param in sessions
+             if force or not isDone(session, param, manifest.get(session['name']))]
+  if not workers:
+    workers = os.cpu_count() or 1
+  workers = min(workers, max(len(pending), 1))
+
+  entries = []
+  def complete(entry):
+    appendManifest(manifestPath, entry)
+    entries.append(entry)
+    if callback:
+      callback(entry)
+
+  if workers == 1:
+    for session, param in pending:
+      complete(runSession(session, param, None, chunkSize))
+    return entries
+
+  with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+    futures = []
+    for session, param in pending:
+      # The sessions run concurrently; multi-threaded FFTs would only compete for the same cores
+      # (the number of FFT workers does not change the result, nor the hash of the session)
+      sessionHash = getSessionHash(session, param)
+      if param.get('fftWorkers', -1) == -1:
+        param = dict(param, fftWorkers=1)
+      futures.append(executor.submit(runSession, session, param, sessionHash, chunkSize))
+    for future in concurrent.futures.as_completed(futures):
+      complete(future.result())
+  return entries
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Batch reprocessing of PRF thermometry sessions.')
+  parser.add_argument('jobs', help='JSON file with the sessions and the parameters')
+  parser.add_argument('--param', help='JSON file with parameters overriding those of the jobs file')
+  parser.add_argument('--manifest', help='JSON Lines manifest of the completed sessions (default: <jobs>.manifest.jsonl)')
+  parser.add_argument('--workers', type=int, default=0, help='number of sessions processed concurrently (default: number of CPUs)')
+  parser.add_argument('--force', action='store_true', help='process all sessions, including those already done')
+  parser.add_argument('--chunkSize', type=int, default=8, help='number of frames read and processed at a time (default: 8)')
+  args = parser.parse_args(argv)
+
+  param = None
+  if args.param:
+    with open(args.param) as f:
+      param = json.load(f)
+  sessions = loadJobs(args.jobs, param)
+  manifestPath = args.manifest or os.path.splitext(args.jobs)[0] + '.manifest.jsonl'
+
+  def report(entry):
+    if entry['status'] == 'done':
+      print('%-24s done     %4d frames  %8.1f s  %s' % (entry['session'], entry['frames'], entry['time'], entry['output']))
+    else:
+      print('%-24s FAILED   %s' % (entry['session'], entry['error']))
+
+  entries = runBatch(sessions, manifestPath, args.workers, args.force, report, args.chunkSize)
+  failed = [entry for entry in entries if entry['status'] != 'done']
+  print('%d sessions, %d processed, %d failed, %d skipped (manifest: %s)'
+        % (len(sessions), len(entries), len(failed), len(sessions) - len(entries), manifestPath))
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,515 @@
+"""Benchmarks for the PRF thermometry engine (no Slicer required).
+
+Usage (from the PRFThermometry directory):
+
+  python -m PRFThermometryLib.Benchmark
+
+runs the comparison benchmarks of the optimizations (legacy vs. current implementations), and
+
+  python -m PRFThermometryLib.Benchmark --suite --shape 16,128,128 --shape 64,512,512 --frames 10 \
+    --history benchmark_history.jsonl
+
+times the pipeline stages on synthetic phantoms (see Phantom.py), appends the results to a
+JSON Lines history file, and reports the stages that became slower than in the previous runs
+(the exit status is 1 if any).
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy
+import SimpleITK as sitk
+
+from . import Engine
+from . import Phantom
+from . import Unwrapping
+from . import VolumeIO
+
+
+def timeit(function, repeat=3):
+  """Return the best wall time (s) of 'repeat' calls of 'function'.
+  """
+  best = None
+  for i in range(repeat):
+    startTime = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - startTime
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def getNeedleLabel(shape):
+  """Return a needle label (4x8x60 voxels, along the x axis) at the center of a volume of 'shape'.
+  """
+  labelArray = numpy.zeros(shape)
+  center = [n//2 for n in shape]
+  labelArray[center[0]-2:center[0]+2, center[1]-4:center[1]+4, center[2]-30:center[2]+30] = 1.0
+  return labelArray
+
+
+def legacySusceptibilityField(labelArray, B0_dir):
+  """Dipole convolution as it was implemented before the real-FFT path (complex FFTs with fftshift).
+  """
+  kernel = Engine.generateDipoleKernel(labelArray.shape, B0_dir)
+  return numpy.real(numpy.fft.ifftn(numpy.fft.fftshift(kernel * numpy.fft.fftshift(numpy.fft.fftn(labelArray)))))
+
+
+def benchmarkSusceptibility(shapes=((16,256,256), (32,256,256), (64,256,256), (14,202,202)), repeat=3, workers=-1):
+  """Compare the legacy complex-FFT dipole convolution with convolveDipoleKernel().
+  Returns a list of dicts (one per shape and padding mode).
+  """
+  results = []
+  for shape in shapes:
+    labelArray = getNeedleLabel(shape)
+    B0_dir = 0
+
+    reference = legacySusceptibilityField(labelArray, B0_dir)
+    legacyTime = timeit(lambda: legacySusceptibilityField(labelArray, B0_dir), repeat)
+    scale = numpy.abs(reference).max()
+
+    for padding in ('none', 'fast'):
+      kernelCache = Engine.DipoleKernelCache()
+      field = Engine.convolveDipoleKernel(labelArray, B0_dir, padding, workers, kernelCache)
+      fastTime = timeit(lambda: Engine.convolveDipoleKernel(labelArray, B0_dir, padding, workers, kernelCache), repeat)
+      results.append({
+        'shape': shape,
+        'padding': padding,
+        'legacyTime': legacyTime,
+        'time': fastTime,
+        'speedup': legacyTime / fastTime,
+        'maxRelativeError': numpy.abs(field - reference).max() / scale,
+        })
+  return results
+
+
+def makePhasePair(shape, heating=1.5, seed=0):
+  """Return raw (int16, 'short' scaling) baseline and reference phase arrays with a linear
+  background, a Gaussian heating spot and noise.
+  """
+  rng = numpy.random.default_rng(seed)
+  z, y, x = numpy.indices(shape, dtype=numpy.float64)
+  background = 0.06 * (x - shape[2]/2) + 0.04 * (y - shape[1]/2) + 0.2 * (z - shape[0]/2)
+  spot = heating * numpy.exp(-((x - shape[2]/2)**2 + (y - shape[1]/2)**2 + (4.0*(z - shape[0]/2))**2) / 200.0)
+
+  def toRaw(phase):
+    phase = numpy.angle(numpy.exp(1.0j * (phase + 0.02 * rng.standard_normal(shape))))
+    return numpy.round(phase * 4096.0 / numpy.pi).astype(numpy.int16)
+
+  return toRaw(background), toRaw(background - spot)
+
+
+def measure(function):
+  """Return (result, wall time (s), peak traced memory (bytes)) of a single call.
+  """
+  tracemalloc.start()
+  startTime = time.perf_counter()
+  result = function()
+  elapsed = time.perf_counter() - startTime
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return (result, elapsed, peak)
+
+
+def benchmarkPrecision(shapes=((16,128,128), (32,256,256)), unwrapping=True, suscCorrection=True):
+  """Compare the double and single precision modes of ThermometryEngine.run() (per-frame cost
+  with a warm kernel cache). Memory allocated inside scikit-image is not traced. Returns a list of dicts with wall times, peak memory and the maximum temperature difference.
+  """
+  results = []
+  for shape in shapes:
+    baseline, reference = makePhasePair(shape)
+    objectLabel = numpy.zeros(shape, dtype=numpy.int16)
+    center = [n//2 for n in shape]
+    objectLabel[center[0]-2:center[0]+2, center[1]-3:center[1]+3, center[2]-20:center[2]+20] = 1
+
+    param = {
+      'usePhaseUnwrapping': False, 'usePhaseUnwrappingPost': unwrapping, 'useComplex': True,
+      'phaseRangeShiftDeg': 30.0, 'alpha': -0.01, 'gamma': 42.576, 'B0': 3.0, 'TE': 0.01, 'BT': 37.0,
+      'B0vec': [0.0, 0.0, 1.0], 'deltaChi': 3.2, 'upperThreshold': False, 'lowerThreshold': False,
+      'suscCorrMethod': 'manual' if suscCorrection else 'off', 'simpleMask': 'disk', 'simpleMask.radius': 0.45,
+      }
+
+    measured = {}
+    for precision in ('double', 'single'):
+      param['precision'] = precision
+      engine = Engine.ThermometryEngine()
+      # Warm up the dipole kernel cache to measure the steady-state (per-frame) cost
+      engine.run(baseline, reference, param, objectLabel=objectLabel)
+      measured[precision] = measure(lambda: engine.run(baseline, reference, param, objectLabel=objectLabel))
+
+    double, single = measured['double'], measured['single']
+    results.append({
+      'shape': shape,
+      'doubleTime': double[1],
+      'singleTime': single[1],
+      'doublePeakMemory': double[2],
+      'singlePeakMemory': single[2],
+      'maxTemperatureError': float(numpy.abs(double[0].temperature - single[0].temperature).max()),
+      'maxPhaseError': float(numpy.abs(double[0].phaseDiff - single[0].phaseDiff).max()),
+      })
+  return results
+
+
+def legacyAlignPhaseOffset(baselinePhase, referencePhase):
+  """Phase offset alignment as it was implemented before the closed-form estimator (search over N = -4, ..., 3).
+  """
+  nList = list(range(-4,4))
+  meanDiffList = numpy.array([numpy.abs(numpy.mean(referencePhase + numpy.pi * n - baselinePhase)) for n in nList])
+  return referencePhase + numpy.pi * nList[numpy.argmin(meanDiffList)]
+
+
+def benchmarkPhaseOffset(shape=(32,256,256), offsets=(-3, -1, 0, 2, 3, 6, -9), repeat=3):
+  """Compare the legacy search with alignPhaseOffset() for reference phases shifted by pi*N
+  (N in 'offsets'). Returns a list of dicts; 'legacyAligned' and 'aligned' tell whether the offset was removed.
+  """
+  truePhase, wrapped, mask = makeWrappedPhantom(shape)
+  results = []
+  for n in offsets:
+    reference = truePhase + 0.3 + numpy.pi * n
+    legacy = legacyAlignPhaseOffset(truePhase, reference)
+    aligned = Engine.alignPhaseOffset(truePhase, reference)
+    results.append({
+      'shape': shape,
+      'offset': n,
+      'legacyTime': timeit(lambda: legacyAlignPhaseOffset(truePhase, reference), repeat),
+      'time': timeit(lambda: Engine.alignPhaseOffset(truePhase, reference), repeat),
+      'maskedTime': timeit(lambda: Engine.alignPhaseOffset(truePhase, reference, mask), repeat),
+      'medianTime': timeit(lambda: Engine.alignPhaseOffset(truePhase, reference, mask, 'median'), repeat),
+      'legacyAligned': bool(abs(numpy.mean(legacy - truePhase) - 0.3) < 1e-6),
+      'aligned': bool(abs(numpy.mean(aligned - truePhase) - 0.3) < 1e-6),
+      })
+  return results
+
+
+def makeWrappedPhantom(shape, amplitude=12.0, noise=0.1, seed=0):
+  """Return (true phase, wrapped phase, mask) for a smooth phase with a range of about
+  'amplitude' radians (a ramp plus Gaussian bumps) and Gaussian noise inside an ellipsoidal mask.
+  """
+  rng = numpy.random.default_rng(seed)
+  z, y, x = numpy.indices(shape, dtype=numpy.float64)
+  z, y, x = (z + 0.5) / shape[0] - 0.5, (y + 0.5) / shape[1] - 0.5, (x + 0.5) / shape[2] - 0.5
+  truePhase = amplitude * (0.5 * x + 0.25 * y + 0.1 * z)
+  truePhase += amplitude * 0.6 * numpy.exp(-((x - 0.1)**2 + (y + 0.1)**2 + z**2) / 0.02)
+  truePhase -= amplitude * 0.4 * numpy.exp(-((x + 0.2)**2 + (y - 0.15)**2 + z**2) / 0.01)
+  truePhase += noise * rng.standard_normal(shape)
+  mask = (x**2 + y**2 + (z / 1.2)**2) < 0.2
+  return (truePhase, Unwrapping.wrap(truePhase), mask.astype(numpy.uint8))
+
+
+def benchmarkUnwrapping(shapes=((16,128,128), (32,256,256)), methods=None, masked=(False, True), repeat=1):
+  """Compare the phase unwrapping backends on wrapped phantoms (see makeWrappedPhantom()).
+  The error is measured inside the mask after removing a global 2*pi*N offset; 'failureRate' is the
+  fraction of voxels that are off by 2*pi or more. Returns a list of dicts.
+  """
+  if methods is None:
+    methods = Unwrapping.getUnwrapperNames()
+  results = []
+  for shape in shapes:
+    truePhase, wrapped, mask = makeWrappedPhantom(shape)
+    inside = mask > 0
+    for useMask in masked:
+      unwrapMask = mask if useMask else None
+      for method in methods:
+        unwrapped = Engine.unwrap(wrapped, unwrapMask, method)
+        elapsed = timeit(lambda: Engine.unwrap(wrapped, unwrapMask, method), repeat)
+        error = (unwrapped - truePhase)[inside]
+        error -= 2.0 * numpy.pi * numpy.round(numpy.median(error) / (2.0 * numpy.pi))
+        results.append({
+          'shape': shape,
+          'method': method,
+          'masked': useMask,
+          'time': elapsed,
+          'failureRate': float(numpy.mean(numpy.abs(error) > numpy.pi)),
+          'rmsError': float(numpy.sqrt(numpy.mean(error**2))),
+          })
+  return results
+
+
+def makePhaseSeries(shape, frames=10, heating=12.0, seed=0):
+  """Return raw (int16) baseline and (T, Z, Y, X) reference phase arrays where the heating spot
+  grows linearly to 'heating' radians (the phase shift wraps several times over the series).
+  """
+  rng = numpy.random.default_rng(seed)
+  z, y, x = numpy.indices(shape, dtype=numpy.float64)
+  background = 0.06 * (x - shape[2]/2) + 0.04 * (y - shape[1]/2) + 0.2 * (z - shape[0]/2)
+  spot = numpy.exp(-((x - shape[2]/2)**2 + (y - shape[1]/2)**2 + (4.0*(z - shape[0]/2))**2) / 200.0)
+
+  def toRaw(phase):
+    phase = numpy.angle(numpy.exp(1.0j * (phase + 0.02 * rng.standard_normal(phase.shape))))
+    return numpy.round(phase * 4096.0 / numpy.pi).astype(numpy.int16)
+
+  series = numpy.stack([toRaw(background - heating * (t + 1) / frames * spot) for t in range(frames)])
+  return (toRaw(background), series)
+
+
+def benchmarkTemporalUnwrapping(shapes=((16,128,128), (32,256,256)), frames=10, method='skimage'):
+  """Compare spatial and temporal post-unwrapping of the phase shift for a heating series
+  (ThermometryEngine.computePhaseDifferenceSeries()). Returns a list of dicts with the wall times,
+  the maximum phase difference between the two modes and the maximum error of the heating spot.
+  """
+  results = []
+  for shape in shapes:
+    baseline, series = makePhaseSeries(shape, frames)
+    param = {
+      'usePhaseUnwrapping': False, 'usePhaseUnwrappingPost': True, 'useComplex': True,
+      'phaseRangeShiftDeg': 30.0, 'simpleMask': 'disk', 'simpleMask.radius': 0.45, 'unwrapMethod': method,
+      }
+    measured = {}
+    for temporal in (False, True):
+      param['temporalUnwrapping'] = temporal
+      engine = Engine.ThermometryEngine()
+      startTime = time.perf_counter()
+      measured[temporal] = (engine.computePhaseDifferenceSeries(baseline, series, param), time.perf_counter() - startTime)
+
+    center = tuple(n//2 for n in shape)
+    expected = -12.0 * numpy.arange(1, frames + 1) / frames
+    results.append({
+      'shape': shape,
+      'frames': frames,
+      'spatialTime': measured[False][1],
+      'temporalTime': measured[True][1],
+      'maxDifference': float(numpy.abs(measured[True][0] - measured[False][0]).max()),
+      'spatialSpotError': float(numpy.abs(measured[False][0][(slice(None),) + center] - expected).max()),
+      'temporalSpotError': float(numpy.abs(measured[True][0][(slice(None),) + center] - expected).max()),
+      })
+  return results
+
+
+def legacyPullVolume(array, geometry, pixelType=sitk.sitkFloat64):
+  """Volume pull as it was implemented before the I/O adapters: sitkUtils.PullVolumeFromSlicer()
+  (a copy of the voxels into a SimpleITK image), sitk.Cast() and sitk.GetArrayFromImage().
+  """
+  return sitk.GetArrayFromImage(sitk.Cast(geometry.toImage(array), pixelType))
+
+
+def legacyPushVolume(array, geometry):
+  """Volume push as it was implemented before the I/O adapters: a SimpleITK image of the array, and
+  sitkUtils.PushVolumeToSlicer() (a copy of the voxels into a new image data).
+  """
+  return numpy.array(sitk.GetArrayFromImage(geometry.toImage(array)))
+
+
+def benchmarkVolumeIO(shapes=((16,128,128), (32,256,256), (64,512,512)), repeat=5):
+  """Compare the legacy pull/push of a frame (raw int16 phase in, float64 temperature out) with
+  VolumeIO on a MemoryScene. Returns a list of dicts with the wall times and the adapter counts.
+  """
+  results = []
+  geometry = Engine.VolumeGeometry.identity()
+  for shape in shapes:
+    scene = VolumeIO.MemoryScene()
+    io = VolumeIO.MemoryVolumeIO()
+    referenceNode = scene.addVolume('reference', numpy.zeros(shape, dtype=numpy.int16), geometry)
+    tempMapNode = scene.addVolume('TempMap')
+    temperature = numpy.full(shape, 37.0)
+    io.push(tempMapNode, temperature.copy(), geometry)
+    io.resetCounts()
+    pullTime = timeit(lambda: io.pull(referenceNode), repeat)
+    pushTime = timeit(lambda: io.push(tempMapNode, temperature, geometry), repeat)
+    counts = io.getCounts()
+    results.append({
+      'shape': shape,
+      'legacyPullTime': timeit(lambda: legacyPullVolume(referenceNode.array, geometry), repeat),
+      'pullTime': pullTime,
+      'legacyPushTime': timeit(lambda: legacyPushVolume(temperature, geometry), repeat),
+      'pushTime': pushTime,
+      'views': counts['views'] / float(repeat),
+      'copies': counts['copies'] / float(repeat),
+      })
+  return results
+
+
+def benchmarkStages(shape=(16,128,128), frames=10, repeat=3, unwrapMethod='skimage', chunkSize=10):
+  """Time the pipeline stages on a phantom (Phantom.PhantomGenerator). Each stage is timed
+  'repeat' times (best wall time); the multi-frame run (ThermometryEngine.runSeries()) processes
+  the frames in chunks of 'chunkSize' frames, so long series do not need to fit in memory.
+  Returns a dict with the case, the stage times (s) and the largest temperature error (deg C).
+  """
+  generator = Phantom.PhantomGenerator(shape, frames)
+  param = generator.getParam()
+  param['unwrapMethod'] = unwrapMethod
+  baseline = generator.getBaseline()
+  reference = generator.getReference(frames - 1)
+  mask = generator.getMask()
+  objectLabel = generator.getObjectLabel()
+  objectBaseline = generator.getObjectBaseline()
+  objectReference = generator.getObjectReference()
+  direction = Engine.VolumeGeometry.identity().direction
+
+  engine = Engine.ThermometryEngine()
+  baselinePhase = engine.preprocess(baseline, '', mask)
+  referencePhase = engine.preprocess(reference, '', mask)
+  phaseRangeShift = numpy.pi * param['phaseRangeShiftDeg']/180.0
+  phaseDiff = Engine.computePhaseDifference(baselinePhase, referencePhase, True, phaseRangeShift)
+  kernelCache = Engine.DipoleKernelCache()
+  Engine.generateSusceptibilityMap(objectLabel, direction, param, kernelCache)
+
+  stages = collections.OrderedDict()
+  stages['generateDiskMask'] = timeit(lambda: Engine.generateDiskMask(shape, radius=0.45), repeat)
+  stages['complexDifference'] = timeit(lambda: Engine.computePhaseDifference(baselinePhase, referencePhase, True,
+                                                                             phaseRangeShift), repeat)
+  stages['unwrap'] = timeit(lambda: Engine.unwrap(phaseDiff, mask, unwrapMethod), repeat)
+  stages['generateSusceptibilityMap'] = timeit(lambda: Engine.generateSusceptibilityMap(objectLabel, direction, param,
+                                                                                        kernelCache), repeat)
+  stages['segmentObject'] = timeit(lambda: Engine.segmentObject(objectBaseline, objectReference), repeat)
+  stages['singleFrame'] = timeit(lambda: engine.run(baseline, reference, param, mask, objectLabel=objectLabel,
+                                                    baselineKey='phantom'), repeat)
+
+  # Multi-frame (only the engine is timed, not the generation of the frames)
+  evaluationMask = generator.getEvaluationMask()
+  multiFrameTime = 0.0
+  maxTemperatureError = 0.0
+  for start in range(0, frames, chunkSize):
+    stop = min(start + chunkSize, frames)
+    referenceSeries = generator.getReferenceSeries(start, stop)
+    startTime = time.perf_counter()
+    result = engine.runSeries(baseline, referenceSeries, param, mask, objectLabel=objectLabel, baselineKey='phantom')
+    multiFrameTime += time.perf_counter() - startTime
+    for i in range(start, stop):
+      error = numpy.abs(result.temperature[i - start] - generator.getTemperature(i))[evaluationMask]
+      maxTemperatureError = max(maxTemperatureError, float(error.max()))
+    del referenceSeries, result
+  stages['multiFrame'] = multiFrameTime
+  stages['multiFramePerFrame'] = multiFrameTime / frames
+
+  return {
+    'case': '%s/%d/%s' % ('x'.join([str(n) for n in shape]), frames, unwrapMethod),
+    'shape': list(shape),
+    'frames': frames,
+    'unwrapMethod': unwrapMethod,
+    'stages': stages,
+    'maxTemperatureError': maxTemperatureError,
+    }
+
+
+def getEnvironment():
+  """Return the time stamp, the git commit (if available) and the platform for the history.
+  """
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                     stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'commit': commit,
+    'platform': platform.platform(),
+    'python': platform.python_version(),
+    'numpy': numpy.__version__,
+    'cpuCount': os.cpu_count(),
+    }
+
+
+def loadHistory(path):
+  """Return the entries of a JSON Lines history file (an empty list if the file does not exist).
+  """
+  if not os.path.exists(path):
+    return []
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def appendHistory(path, results):
+  entry = getEnvironment()
+  entry['results'] = results
+  with open(path, 'a') as f:
+    f.write(json.dumps(entry) + '\n')
+  return entry
+
+
+def findRegressions(results, history, tolerance=1.25, window=5, maxErrorIncrease=0.5):
+  """Compare the stage times of 'results' (benchmarkStages()) with the median of the last 'window'
+  history entries of the same case. Returns a list of dicts for the stages slower than 'tolerance'
+  times the median, and for a temperature error larger than the median by 'maxErrorIncrease' (deg C).
+  """
+  regressions = []
+  for result in results:
+    for stage, elapsed in result['stages'].items():
+      previous = [r['stages'][stage] for entry in history for r in entry['results']
+                  if r['case'] == result['case'] and stage in r['stages']][-window:]
+      if not previous:
+        continue
+      reference = float(numpy.median(previous))
+      if elapsed > tolerance * reference:
+        regressions.append({'case': result['case'], 'stage': stage, 'time': elapsed, 'reference': reference,
+                            'ratio': elapsed / reference})
+    previous = [r['maxTemperatureError'] for entry in history for r in entry['results'] if r['case'] == result['case']][-window:]
+    if previous and result['maxTemperatureError'] > float(numpy.median(previous)) + maxErrorIncrease:
+      regressions.append({'case': result['case'], 'stage': 'maxTemperatureError', 'error': result['maxTemperatureError'],
+                          'reference': float(numpy.median(previous))})
+  return regressions
+
+
+def parseShape(text):
+  return tuple(int(n) for n in text.split(','))
+
+
+def runSuite(args):
+  results = []
+  for shape in (args.shape or [(16,128,128)]):
+    result = benchmarkStages(shape, args.frames, args.repeat, args.unwrapMethod)
+    results.append(result)
+    print('%s  max temperature error %.2f deg C' % (result['case'], result['maxTemperatureError']))
+    for stage, elapsed in result['stages'].items():
+      print('  %-26s %9.4f s' % (stage, elapsed))
+
+  if not args.history:
+    return 0
+  regressions = findRegressions(results, loadHistory(args.history), args.tolerance)
+  appendHistory(args.history, results)
+  for regression in regressions:
+    if 'error' in regression:
+      print('REGRESSION %s %s: %.2f deg C (median of previous runs %.2f deg C)'
+            % (regression['case'], regression['stage'], regression['error'], regression['reference']))
+    else:
+      print('REGRESSION %s %s: %.4f s (median of previous runs %.4f s, x%.2f)'
+            % (regression['case'], regression['stage'], regression['time'], regression['reference'], regression['ratio']))
+  return 1 if regressions else 0
+
+
+def runComparisons():
+  for result in benchmarkSusceptibility():
+    print('susceptibility %-16s padding=%-5s legacy %.4f s  fast %.4f s  x%.1f  max rel. error %.1e'
+          % (str(result['shape']), result['padding'], result['legacyTime'], result['time'],
+             result['speedup'], result['maxRelativeError']))
+  for result in benchmarkPrecision():
+    print('precision      %-16s double %.3f s %7.1f MB  single %.3f s %7.1f MB  max error %.1e rad / %.1e deg C'
+          % (str(result['shape']), result['doubleTime'], result['doublePeakMemory'] / 1e6,
+             result['singleTime'], result['singlePeakMemory'] / 1e6,
+             result['maxPhaseError'], result['maxTemperatureError']))
+  for result in benchmarkPhaseOffset():
+    print('phase offset   %-16s N=%-3d legacy %.4f s (aligned: %-5s)  mean %.4f s (aligned: %-5s)  masked %.4f s  median %.4f s'
+          % (str(result['shape']), result['offset'], result['legacyTime'], result['legacyAligned'], result['time'],
+             result['aligned'], result['maskedTime'], result['medianTime']))
+  for result in benchmarkUnwrapping():
+    print('unwrapping     %-16s %-13s masked=%-5s %.3f s  failure rate %.2e  RMS error %.3f rad'
+          % (str(result['shape']), result['method'], result['masked'], result['time'],
+             result['failureRate'], result['rmsError']))
+  for result in benchmarkVolumeIO():
+    print('volume I/O     %-16s pull: legacy %.4f s  view %.6f s  push: legacy %.4f s  in place %.4f s  (%.0f view, %.0f copy per pull+push)'
+          % (str(result['shape']), result['legacyPullTime'], result['pullTime'], result['legacyPushTime'],
+             result['pushTime'], result['views'], result['copies']))
+  for result in benchmarkTemporalUnwrapping():
+    print('temporal       %-16s %d frames  spatial %.3f s  temporal %.3f s  max difference %.1e rad  spot error %.2f / %.2f rad'
+          % (str(result['shape']), result['frames'], result['spatialTime'], result['temporalTime'],
+             result['maxDifference'], result['spatialSpotError'], result['temporalSpotError']))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks for the PRF thermometry engine.')
+  parser.add_argument('--suite', action='store_true', help='time the pipeline stages on synthetic phantoms')
+  parser.add_argument('--shape', type=parseShape, action='append', help='phantom size Z,Y,X (repeatable; default: 16,128,128)')
+  parser.add_argument('--frames', type=int, default=10, help='number of frames (default: 10)')
+  parser.add_argument('--repeat', type=int, default=3, help='repetitions per stage (default: 3)')
+  parser.add_argument('--unwrapMethod', default='skimage', help='phase unwrapping method (default: skimage)')
+  parser.add_argument('--history', help='JSON Lines file to compare with and append the results to')
+  parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown reported as a regression (default: 1.25)')
+  args = parser.parse_args()
+  if args.suite:
+    sys.exit(runSuite(args))
+  runComparisons()
@@ -0,0 +1,1430 @@
+"""Slicer-independent PRF thermometry engine.
+
+All functions take and return NumPy arrays in SimpleITK/NumPy index order
+(z, y, x), so the pipeline can be run, profiled and parallelized outside of a
+Slicer process. PRFThermometryLogic is a thin adapter on top of this module.
+"""
+
+import collections
+import hashlib
+import logging
+import numpy
+import scipy.fft
+import scipy.linalg
+import SimpleITK as sitk
+
+from . import Profiling
+from . import Unwrapping
+
+
+#
+# Volume geometry
+#
+
+class VolumeGeometry(collections.namedtuple('VolumeGeometry', ['origin', 'spacing', 'direction'])):
+  """Physical placement of a volume (SimpleITK convention, (x, y, z) order).
+  """
+
+  __slots__ = ()
+
+  @classmethod
+  def identity(cls):
+    return cls((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+
+  @classmethod
+  def fromImage(cls, image):
+    return cls(tuple(image.GetOrigin()), tuple(image.GetSpacing()), tuple(image.GetDirection()))
+
+  def toImage(self, array):
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin(self.origin)
+    image.SetSpacing(self.spacing)
+    image.SetDirection(self.direction)
+    return image
+
+
+#
+# Precision
+#
+
+def getFloatType(param):
+  """Return the floating point type selected by param['precision']: 'double' (default) or 'single'.
+  In the single precision mode, the phase is carried as float32/complex64 through the whole pipeline
+  (phase unwrapping is computed in double precision and cast back).
+  """
+  if param.get('precision', 'double') == 'single':
+    return numpy.float32
+  return numpy.float64
+
+
+#
+# Output format
+#
+
+# Storage types of the temperature maps (param['outputType'])
+outputTypes = collections.OrderedDict([('double', numpy.float64), ('float', numpy.float32), ('short', numpy.int16)])
+
+# Metadata (volume node attributes, file header fields) recording the scale of the stored
+# temperature maps: temperature (deg C) = value * scale + offset, and the units of the stored values
+# (see getOutputUnits())
+outputScaleKey = 'PRFThermometry.OutputScale'
+outputOffsetKey = 'PRFThermometry.OutputOffset'
+outputUnitsKey = 'PRFThermometry.OutputUnits'
+outputMetaDataKeys = (outputScaleKey, outputOffsetKey, outputUnitsKey)
+
+
+def getOutputFormat(param):
+  """Return (dtype, scale, offset) of the stored temperature maps selected by param['outputType']:
+  'double' (default), 'float' or 'short'. 'short' stores round((T - offset) / scale) as int16, with
+  param['outputScale'] (deg C per step, default 0.01) and param['outputOffset'] (deg C, default 0.0),
+  i.e. -327.68 to 327.67 deg C in steps of 0.01 deg C by default. The float types are not scaled.
+  """
+  outputType = param.get('outputType', 'double')
+  if outputType not in outputTypes:
+    raise ValueError("Unknown output type '%s' (%s)" % (outputType, ', '.join(outputTypes)))
+  dtype = outputTypes[outputType]
+  if numpy.issubdtype(dtype, numpy.integer):
+    return (dtype, float(param.get('outputScale', 0.01)), float(param.get('outputOffset', 0.0)))
+  return (dtype, 1.0, 0.0)
+
+
+def quantizeTemperature(temperature, param):
+  """Convert temperature maps (deg C) to the storage type of getOutputFormat(). Scaled values are
+  rounded and clipped to the range of the type; NaN is stored as 'offset'.
+  """
+  dtype, scale, offset = getOutputFormat(param)
+  if not numpy.issubdtype(dtype, numpy.integer):
+    return numpy.asarray(temperature, dtype=dtype)
+  values = numpy.subtract(temperature, offset, dtype=numpy.float64)
+  values /= scale
+  numpy.rint(values, out=values)
+  numpy.nan_to_num(values, copy=False, nan=0.0)
+  info = numpy.iinfo(dtype)
+  numpy.clip(values, info.min, info.max, out=values)
+  return values.astype(dtype)
+
+
+def dequantizeTemperature(values, scale=1.0, offset=0.0, dtype=numpy.float64):
+  """Inverse of quantizeTemperature(): stored values -> temperature (deg C).
+  """
+  temperature = numpy.array(values, dtype=dtype)
+  if scale != 1.0:
+    temperature *= scale
+  if offset != 0.0:
+    temperature += offset
+  return temperature
+
+
+def getOutputMetaData(param):
+  """Return the scale, offset and units of getOutputFormat() as metadata strings (outputMetaDataKeys).
+  """
+  dtype, scale, offset = getOutputFormat(param)
+  return {outputScaleKey: repr(scale), outputOffsetKey: repr(offset), outputUnitsKey: getOutputUnits(scale, offset)}
+
+
+def getOutputUnits(scale=1.0, offset=0.0):
+  """Return the units of the stored values of a temperature map, e.g. 'deg C', or '0.01 deg C' for
+  the scaled short type (with the offset, if any: '0.01 deg C, offset 20 deg C').
+  """
+  units = 'deg C' if scale == 1.0 else '%g deg C' % scale
+  if offset != 0.0:
+    units += ', offset %g deg C' % offset
+  return units
+
+
+def getOutputScale(metaData):
+  """Return (scale, offset) recorded by getOutputMetaData() in a dict of strings; (1.0, 0.0) for
+  missing values (unscaled temperature maps).
+  """
+  metaData = metaData or {}
+  scale = metaData.get(outputScaleKey)
+  offset = metaData.get(outputOffsetKey)
+  return (float(scale) if scale else 1.0, float(offset) if offset else 0.0)
+
+
+#
+# Phase operations
+#
+
+def scalePhase(array, scalarType=''):
+  """Convert raw phase values to radians.
+  Siemens SRC sends image data in 'short' instead of 'unsigned short'.
+  """
+  if scalarType == 'unsigned short':
+    logging.debug('scalePhase: array*numpy.pi/2048.0 - numpy.pi')
+    return array*numpy.pi/2048.0 - numpy.pi
+  logging.debug('scalePhase: array*numpy.pi/4096.0')
+  return array*numpy.pi/4096.0
+
+
+def generateDiskMask(shape, center=[0.5,0.5,0.5], radius=0.5, dtype=numpy.float64, spacing=None):
+  """Return a binary (0.0/1.0, or False/True if 'dtype' is bool) spherical mask for an array of the
+  given shape. 'center' is relative to the array size and 'radius' to the largest dimension.
+  If 'spacing' ((x, y, z) order) is given, the sphere is round in physical units and 'radius' is
+  relative to the largest physical extent; otherwise, it is round in voxel units.
+  """
+  dims = shape
+  if spacing is None:
+    voxelSize = (1.0, 1.0, 1.0)
+  else:
+    voxelSize = tuple(spacing)[::-1]
+  r = numpy.max([n * s for n, s in zip(dims, voxelSize)]) * radius
+
+  z, y, x = numpy.ogrid[0:dims[0], 0:dims[1], 0:dims[2]]
+  z = (z - dims[0] * center[0]) * voxelSize[0]
+  y = (y - dims[1] * center[1]) * voxelSize[1]
+  x = (x - dims[2] * center[2]) * voxelSize[2]
+  mask = x*x + y*y + z*z <= r*r
+
+  return mask.astype(dtype, copy=False)
+
+
+def generateEllipsoidMask(shape, geometry, center, radii, dtype=bool):
+  """Return a binary ellipsoidal mask in physical units. 'center' is a point in the physical
+  (LPS) space of 'geometry' (VolumeGeometry) and 'radii' are the radii (mm) along the x, y and z
+  axes of the volume.
+  """
+  spacing = numpy.asarray(geometry.spacing, dtype=numpy.float64)
+  direction = numpy.asarray(geometry.direction, dtype=numpy.float64).reshape(3, 3)
+  # Continuous index (x, y, z) of the center
+  centerIndex = numpy.linalg.solve(direction * spacing, numpy.asarray(center, dtype=numpy.float64) - geometry.origin)
+
+  z, y, x = numpy.ogrid[0:shape[0], 0:shape[1], 0:shape[2]]
+  z = (z - centerIndex[2]) * (spacing[2] / radii[2])
+  y = (y - centerIndex[1]) * (spacing[1] / radii[1])
+  x = (x - centerIndex[0]) * (spacing[0] / radii[0])
+  mask = x*x + y*y + z*z <= 1.0
+
+  return mask.astype(dtype, copy=False)
+
+
+class MaskCache(object):
+  """Bounded LRU cache of read-only boolean masks keyed by the mask type, the array shape,
+  the geometry and the mask parameters ('disk': generateDiskMask(), 'ellipsoid': generateEllipsoidMask()).
+  """
+
+  def __init__(self, maxSize=4):
+    self.maxSize = maxSize
+    self.masks = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def clear(self):
+    self.masks.clear()
+
+  def get(self, kind, shape, geometry=None, center=None, radius=None):
+    """Return the mask 'kind' ('disk' or 'ellipsoid'). For 'disk', 'center' and 'radius' are relative
+    (see generateDiskMask()), and the spacing of 'geometry' is used if given. For 'ellipsoid',
+    'center' is a physical point and 'radius' the radii (mm) along the volume axes.
+    """
+    key = (kind, tuple(shape), geometry,
+           None if center is None else tuple(center),
+           tuple(radius) if numpy.ndim(radius) else radius)
+    mask = self.masks.get(key)
+    if mask is not None:
+      self.hits += 1
+      self.masks.move_to_end(key)
+      return mask
+
+    self.misses += 1
+    if kind == 'disk':
+      mask = generateDiskMask(shape, [0.5,0.5,0.5] if center is None else center, radius, bool,
+                              None if geometry is None else geometry.spacing)
+    elif kind == 'ellipsoid':
+      if geometry is None:
+        geometry = VolumeGeometry.identity()
+      mask = generateEllipsoidMask(shape, geometry, center, radius)
+    else:
+      raise ValueError("MaskCache: unknown mask type '%s'" % kind)
+    mask.flags.writeable = False
+    self.masks[key] = mask
+    while len(self.masks) > self.maxSize:
+      self.masks.popitem(last=False)
+    return mask
+
+
+def getInsideMask(mask):
+  """Return 'mask' as a boolean array (True inside), without a copy if it is already boolean.
+  """
+  mask = numpy.asarray(mask)
+  if mask.dtype == bool:
+    return mask
+  return mask > 0
+
+
+def getLabelBoundingBox(labelArray, margin=0):
+  """Return the bounding box of the non-zero voxels, extended by 'margin' voxels and
+  clipped to the array, as a tuple of slices, or None if the label is empty.
+  """
+  box = []
+  for axis in range(labelArray.ndim):
+    otherAxes = tuple(a for a in range(labelArray.ndim) if a != axis)
+    indices = numpy.nonzero(numpy.any(labelArray, axis=otherAxes))[0]
+    if len(indices) == 0:
+      return None
+    box.append(slice(max(indices[0] - margin, 0), min(indices[-1] + margin + 1, labelArray.shape[axis])))
+  return tuple(box)
+
+
+def unwrap(arrayPhase, mask=None, method='skimage'):
+  """Unwrap the phase with the backend 'method' (see Unwrapping.py). If 'mask' is given, the array
+  is cropped to the bounding box of the mask and the voxels outside the mask are excluded from the
+  unwrapping. The voxels outside the mask keep their input values.
+  """
+  unwrapper = Unwrapping.getUnwrapper(method)
+  if mask is None:
+    return unwrapper(arrayPhase).astype(arrayPhase.dtype, copy=False)
+
+  inside = getInsideMask(mask)
+  box = getLabelBoundingBox(inside)
+  if box is None:
+    return arrayPhase.copy()
+
+  unwrapped = arrayPhase.copy()
+  arrayBox = arrayPhase[box]
+  insideBox = inside[box]
+  if arrayBox.size < 2:
+    return unwrapped
+
+  # Drop length-1 axes (e.g. a single-slice ROI) to use the lower-dimensional algorithm
+  unwrappedBox = unwrapper(numpy.squeeze(arrayBox), numpy.squeeze(insideBox)).reshape(arrayBox.shape)
+  unwrapped[box] = numpy.where(insideBox, unwrappedBox, arrayBox)
+  return unwrapped
+
+
+def getUnwrapMask(param, mask):
+  """Return the mask for unwrap(), or None if param['useMaskedUnwrapping'] (default: True) is off.
+  """
+  if param.get('useMaskedUnwrapping', True):
+    return mask
+  return None
+
+
+def getUnwrapMethod(param):
+  """Return the phase unwrapping backend selected by param['unwrapMethod'] (default: 'skimage').
+  """
+  return param.get('unwrapMethod', 'skimage')
+
+
+def unwrapTemporal(arrayPhase, previousPhase, mask=None, method='skimage', maxChange=numpy.pi/2, maxFailure=0.05):
+  """Unwrap the phase against the unwrapped phase of the previous frame: each voxel is shifted by the
+  multiple of 2*pi that brings it closest to 'previousPhase'. Voxels that still change by more than
+  'maxChange' are unwrapped spatially (unwrap() on their bounding box, aligned to the neighboring
+  voxels). If more than 'maxFailure' of the voxels (inside 'mask') fail, the whole frame is unwrapped
+  spatially and aligned to the previous frame.
+  """
+  twoPi = 2.0 * numpy.pi
+  unwrapped = (arrayPhase + twoPi * numpy.round((previousPhase - arrayPhase) / twoPi)).astype(arrayPhase.dtype, copy=False)
+
+  # Consistency check
+  if mask is None:
+    inside = numpy.ones(arrayPhase.shape, dtype=bool)
+  else:
+    inside = getInsideMask(mask)
+  failed = (numpy.abs(unwrapped - previousPhase) > maxChange) & inside
+  nFailed = numpy.count_nonzero(failed)
+  if nFailed == 0:
+    return unwrapped
+
+  if nFailed > maxFailure * numpy.count_nonzero(inside):
+    logging.debug('unwrapTemporal: %d voxels failed. Falling back to spatial unwrapping.' % nFailed)
+    return alignPhaseOffset(previousPhase, unwrap(arrayPhase, mask, method), mask, 'median', twoPi)
+
+  logging.debug('unwrapTemporal: %d voxels failed. Unwrapping them spatially.' % nFailed)
+  box = getLabelBoundingBox(failed, margin=2)
+  spatial = unwrap(arrayPhase[box], inside[box], method)
+  spatial = alignPhaseOffset(unwrapped[box], spatial, inside[box] & ~failed[box], 'median', twoPi)
+  unwrapped[box] = numpy.where(failed[box], spatial, unwrapped[box])
+  return unwrapped
+
+
+def alignPhaseOffset(baselinePhase, referencePhase, mask=None, estimator='mean', step=numpy.pi):
+  """Shift the reference phase by step*N to match the baseline.
+  Phase unwrapping often ends up shifting the entire phase map by a multiple of pi. The offset between
+  the reference and the baseline is estimated in a single pass ('mean' or the more robust 'median' of the
+  difference, only inside 'mask' if given) and rounded to the nearest multiple of 'step'. With 'mean',
+  this gives the same shift as searching N for the smallest mean difference, for any N.
+  """
+  baselineValues, referenceValues = baselinePhase, referencePhase
+  if mask is not None:
+    inside = getInsideMask(mask)
+    if numpy.any(inside):
+      baselineValues, referenceValues = baselinePhase[inside], referencePhase[inside]
+
+  if estimator == 'median':
+    offset = numpy.median(baselineValues - referenceValues)
+  elif estimator == 'mean':
+    offset = numpy.mean(baselineValues) - numpy.mean(referenceValues)
+  else:
+    raise ValueError("alignPhaseOffset: unknown estimator '%s'" % estimator)
+
+  n = int(numpy.round(offset / step))
+  logging.debug('alignPhaseOffset: N = %d' % n)
+  if n == 0:
+    return referencePhase
+  return referencePhase + referencePhase.dtype.type(step * n)
+
+
+def computePhaseDifference(baselinePhase, referencePhase, useComplex=True, phaseRangeShift=0.0, baselineConjugate=None):
+  """Compute the phase shift either by subtracting the phase values or by
+  calculating the rotation in the complex space. 'baselineConjugate' (exp(-i*baselinePhase))
+  can be given to skip the conversion of the baseline.
+  """
+  if useComplex:
+    if baselineConjugate is None:
+      baselineConjugate = numpy.exp(-1.0j * baselinePhase)
+    phaseDiff = numpy.angle(numpy.exp(1.0j * referencePhase) * baselineConjugate)
+
+    # Change the range from [-pi, pi] to [-2pi+phaseRangeShift, phaseRangeShift] (allow some temperature decrease)
+    phaseDiff[phaseDiff>phaseRangeShift] -= 2*numpy.pi
+    return phaseDiff
+
+  return referencePhase - baselinePhase
+
+
+def phaseToTemperature(phaseDiff, alpha, gamma, B0, TE, BT):
+  return phaseDiff / (alpha * 2.0 * numpy.pi * gamma * B0 * TE) + BT
+
+
+def applyThreshold(array, lowerThreshold, upperThreshold, outsideValue=0.0):
+  """Same as sitk.Threshold(): values outside [lower, upper] are replaced by 'outsideValue'.
+  """
+  return numpy.where((array >= lowerThreshold) & (array <= upperThreshold), array, outsideValue)
+
+
+#
+# Thermal dose
+#
+
+# Minutes per unit of the frame index (e.g. the index unit of a time sequence)
+timeUnits = {'ms': 1.0 / 60000.0, 's': 1.0 / 60.0, 'sec': 1.0 / 60.0, 'min': 1.0, 'h': 60.0}
+
+
+def getTimeScale(unit):
+  """Return the minutes per 'unit' (see timeUnits), or None if 'unit' is not a time unit.
+  """
+  return timeUnits.get((unit or '').strip().lower())
+
+
+def getCEM43Rate(temperature):
+  """Return the thermal dose rate (CEM43, equivalent minutes at 43 deg C per minute) at 'temperature':
+  R^(43 - T), with R = 0.5 at or above 43 deg C and R = 0.25 below (Sapareto and Dewey).
+  NaN (e.g. outside the mask) gives no dose.
+  """
+  temperature = numpy.nan_to_num(numpy.asarray(temperature, dtype=numpy.float64), nan=-numpy.inf)
+  rate = numpy.where(temperature >= 43.0, 0.5, 0.25)
+  with numpy.errstate(over='ignore'):
+    numpy.power(rate, 43.0 - temperature, out=rate)
+  return rate
+
+
+def getDoseLabel(dose, threshold=240.0):
+  """Return a label map (uint8) of the voxels with a dose of at least 'threshold' (CEM43).
+  """
+  return (dose >= threshold).astype(numpy.uint8)
+
+
+class DoseAccumulator(object):
+  """Incremental CEM43 thermal dose. update() adds the dose of the interval since the previous frame,
+  R^(43 - Tmean) * dt, where Tmean is the mean temperature of the two frames. Only the running dose
+  and the previous frame are kept, so each frame costs O(voxels) regardless of the number of frames.
+  """
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.dose = None
+    self.previousTemperature = None
+    self.previousTime = None
+    self.frames = 0
+
+  def update(self, temperature, time):
+    """Add a temperature map (deg C) acquired at 'time' (minutes) and return the dose map.
+    The first frame (or a frame of a different shape, which restarts the dose) gives no dose.
+    """
+    temperature = numpy.array(temperature, dtype=numpy.float64)
+    if self.dose is None or self.dose.shape != temperature.shape:
+      if self.dose is not None:
+        logging.warning('DoseAccumulator: the frame shape changed from %s to %s. The dose is restarted.' %
+                        (self.dose.shape, temperature.shape))
+      self.dose = numpy.zeros(temperature.shape)
+    else:
+      interval = time - self.previousTime
+      if interval < 0.0:
+        raise ValueError('DoseAccumulator: time %g is before the previous frame (%g)' % (time, self.previousTime))
+      meanTemperature = self.previousTemperature + temperature
+      meanTemperature *= 0.5
+      rate = getCEM43Rate(meanTemperature)
+      rate *= interval
+      self.dose += rate
+    self.previousTemperature = temperature
+    self.previousTime = time
+    self.frames += 1
+    return self.dose
+
+
+#
+# Susceptibility correction
+#
+
+def findB0Axis(direction, B0vec):
+  """Find the NumPy array axis closest to the B0 direction.
+  TODO: We need to find the orientation vector of the B0 field w.r.t. the image matrix frame (not the patient frame)
+  """
+  B0vec = numpy.array([B0vec])
+  M = numpy.array(direction).reshape(3,3)
+  M = M.transpose()
+  # Calculate the magnitudes of inner products (or cosines, assuming the vectors are normal)
+  ac = numpy.abs(numpy.inner(M,B0vec))
+
+  return 2 - int(numpy.argmax(ac)) # Needs to be flipped for numpy; (x,y,z) in NRRD becomes (z,y,x)
+
+
+def generateDipoleKernel(shape, B0_dir, spacing=None):
+  """Return the dipole kernel 1/3 - k_B0^2/|k|^2 on the fftshift-ed k-space grid.
+  If 'spacing' ((z, y, x) order) is given, the k-space axes are scaled by the inverse voxel size.
+  The kernel is set to 0 at k = 0, where it is undefined.
+  """
+  axes = []
+  for i in range(3):
+    N = shape[i]
+    r = numpy.pi*(N-1)/N
+    k = numpy.linspace(-r, r, N)
+    if spacing is not None:
+      k = k / spacing[i]
+    axes.append(k)
+  k_grid = numpy.meshgrid(axes[0], axes[1], axes[2], indexing='ij', sparse=True)
+
+  k2 = k_grid[0]**2 + k_grid[1]**2 + k_grid[2]**2
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    kernel = 1./3. - k_grid[B0_dir]**2 / k2
+  kernel[k2 == 0.0] = 0.0
+
+  return kernel
+
+
+def generateRealDipoleKernel(shape, B0_dir, spacing=None, dtype=numpy.float64):
+  """Return the dipole kernel of generateDipoleKernel() for scipy.fft.rfftn()/irfftn().
+  The fftshift is folded into the kernel, and the kernel is symmetrized (K(k) + K(-k))/2 so that
+  irfftn() gives the same result as taking the real part of the complex inverse FFT. Only the
+  non-negative frequencies of the last axis are kept.
+  """
+  kernel = scipy.fft.ifftshift(generateDipoleKernel(shape, B0_dir, spacing))
+  # K(-k): reverse the frequency index (m -> -m mod N) along all axes
+  kernelNeg = numpy.roll(kernel[::-1, ::-1, ::-1], 1, axis=(0, 1, 2))
+  kernel = 0.5 * (kernel + kernelNeg)
+
+  return numpy.ascontiguousarray(kernel[:, :, :shape[2]//2+1], dtype=dtype)
+
+
+def getFFTShape(shape):
+  """Return the smallest even sizes >= 'shape' that are efficient for scipy.fft.
+  Even sizes keep the dipole kernel grid identical to the one of the unpadded, even-sized volume.
+  """
+  fftShape = []
+  for n in shape:
+    n = scipy.fft.next_fast_len(int(n), real=True)
+    while n % 2:
+      n = scipy.fft.next_fast_len(n + 1, real=True)
+    fftShape.append(n)
+  return tuple(fftShape)
+
+
+def getKernelSpacing(spacing):
+  """Return the voxel spacing ((x, y, z) order, e.g. VolumeGeometry.spacing) relative to the
+  smallest voxel size in the (z, y, x) order of generateDipoleKernel(), or None if the voxels are
+  isotropic (the dipole kernel only depends on the ratios of the voxel sizes).
+  """
+  if spacing is None:
+    return None
+  spacing = numpy.asarray(spacing, dtype=numpy.float64)[::-1]
+  if numpy.allclose(spacing, spacing.min(), rtol=1e-6, atol=0.0):
+    return None
+  return tuple(float(s) for s in spacing / spacing.min())
+
+
+class DipoleKernelCache(object):
+  """Bounded LRU cache of dipole kernels (generateRealDipoleKernel()) keyed by
+  (shape, B0_dir, spacing, padding, dtype). 'spacing' is the relative voxel size of getKernelSpacing()
+  (None: isotropic voxels), and 'padding' the number of voxels added to each axis of 'shape' before the FFT.
+  """
+
+  def __init__(self, maxSize=4):
+    self.maxSize = maxSize
+    self.kernels = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def clear(self):
+    self.kernels.clear()
+
+  def get(self, shape, B0_dir, spacing=None, padding=None, dtype=numpy.float64):
+    key = (tuple(shape), B0_dir,
+           None if spacing is None else tuple(spacing),
+           None if padding is None else tuple(padding),
+           numpy.dtype(dtype).str)
+    kernel = self.kernels.get(key)
+    if kernel is not None:
+      self.hits += 1
+      self.kernels.move_to_end(key)
+      return kernel
+
+    self.misses += 1
+    if padding is not None:
+      shape = [n + p for n, p in zip(shape, padding)]
+    kernel = generateRealDipoleKernel(shape, B0_dir, spacing, dtype)
+    kernel.flags.writeable = False
+    self.kernels[key] = kernel
+    while len(self.kernels) > self.maxSize:
+      self.kernels.popitem(last=False)
+    return kernel
+
+
+def convolveDipoleKernel(labelArray, B0_dir, padding='none', workers=-1, kernelCache=None, spacing=None):
+  """Convolve the label with the dipole kernel using real FFTs. 'spacing' is the relative voxel
+  size in (z, y, x) order (see getKernelSpacing(); None: isotropic voxels).
+  'padding' is 'none' (use the array size) or 'fast' (zero-pad to getFFTShape()). Padding is not
+  exact: the kernel is sampled on the padded k-space grid and the convolution wraps around the
+  padded volume, so 'fast' gives a different field than 'none' (see generateSusceptibilityMap()).
+  'workers' is passed to scipy.fft (-1: all CPUs). The FFTs are computed in the precision
+  of 'labelArray' (float32 or float64).
+  """
+  shape = labelArray.shape
+  if padding == 'fast':
+    fftShape = getFFTShape(shape)
+  else:
+    fftShape = shape
+  paddingSize = tuple(f - n for f, n in zip(fftShape, shape))
+
+  if kernelCache is not None:
+    kernel = kernelCache.get(shape, B0_dir, spacing, paddingSize, labelArray.dtype)
+  else:
+    kernel = generateRealDipoleKernel(fftShape, B0_dir, spacing, labelArray.dtype)
+
+  k_label = scipy.fft.rfftn(labelArray, s=fftShape, workers=workers)
+  k_label *= kernel
+  field = scipy.fft.irfftn(k_label, s=fftShape, workers=workers)
+
+  return field[:shape[0], :shape[1], :shape[2]]
+
+
+def generateSusceptibilityMap(labelArray, direction, param, kernelCache=None, spacing=None):
+  """Compute the phase shift caused by an object with a constant susceptibility
+  difference (param['deltaChi']) using the dipole kernel in the k-space.
+  The kernel is taken from 'kernelCache' (DipoleKernelCache) if given. 'spacing' is the voxel
+  spacing ((x, y, z) order, e.g. VolumeGeometry.spacing); the k-space grid is scaled for
+  anisotropic voxels (see getKernelSpacing()). Without 'spacing', the voxels are taken as isotropic.
+
+  Optional parameters:
+    param['suscCorrFFTPadding']: 'none' (default; FFT on the volume grid), 'fast' (zero-pad to
+                                 fast FFT sizes), or 'bbox' (crop to the object's bounding box plus
+                                 a margin, then zero-pad)
+    param['suscCorrFFTMargin']:  margin (voxels) for 'bbox' (default: 16)
+    param['fftWorkers']:         number of FFT worker threads (default: -1, all CPUs)
+    param['precision']:          'double' (default) or 'single' (see getFloatType())
+
+  'fast' and 'bbox' are faster approximations. They change the k-space grid of the dipole kernel
+  and the wrap-around of the convolution, and the error is largest at the object, not at the
+  volume edges. For a 14x202x202 volume (padded to 16x216x216), 'fast' differs from 'none' by up
+  to 5% of the maximum phase shift, and 'bbox' by up to 7%. Volumes with odd dimensions can differ
+  by more than 50%.
+  """
+  gammaPI = param['gamma'] * 2.0 * numpy.pi
+  TE    = param['TE']
+  deltaChi = param['deltaChi']
+  H0    = param['B0']
+  padding = param.get('suscCorrFFTPadding', 'none')
+  workers = param.get('fftWorkers', -1)
+
+  B0_dir = findB0Axis(direction, param['B0vec'])
+  logging.debug('generateSusceptibilityMap: B0_dir = %d' % B0_dir)
+  kernelSpacing = getKernelSpacing(spacing)
+
+  dtype = getFloatType(param)
+  labelArray = numpy.asarray(labelArray, dtype=dtype)
+  mask = 1.0 - labelArray
+
+  if padding == 'bbox':
+    # The field outside the bounding box + margin is ignored.
+    p_susc = numpy.zeros(labelArray.shape, dtype=dtype)
+    box = getLabelBoundingBox(labelArray, param.get('suscCorrFFTMargin', 16))
+    if box is not None:
+      p_susc[box] = convolveDipoleKernel(labelArray[box], B0_dir, 'fast', workers, kernelCache, kernelSpacing)
+  else:
+    p_susc = convolveDipoleKernel(labelArray, B0_dir, padding, workers, kernelCache, kernelSpacing)
+  p_susc *= gammaPI * H0 * TE * deltaChi
+
+  # Mask
+  return p_susc * mask
+
+
+def segmentObject(baselineArray, referenceArray):
+  """Segment the object (e.g. an applicator) from the magnitude images and
+  return it as a uint8 label array.
+  """
+  baselineImage = sitk.GetImageFromArray(baselineArray)
+  referenceImage = sitk.GetImageFromArray(referenceArray)
+
+  # Subtraction
+  image_diff = baselineImage - referenceImage
+
+  # Threshold
+  otsu_filter = sitk.MaximumEntropyThresholdImageFilter()
+  otsu_filter.SetInsideValue(0)
+  otsu_filter.SetOutsideValue(1)
+  otsu_filter.SetNumberOfHistogramBins(5)
+  image_threshold = otsu_filter.Execute(image_diff)
+
+  # Relabel connected regions
+  cc_filter = sitk.ConnectedComponentImageFilter()
+  image_cc = cc_filter.Execute(image_threshold)
+  relabel_filter = sitk.RelabelComponentImageFilter()
+  relabel_filter.SetMinimumObjectSize(30)
+  image_relabel = relabel_filter.Execute(image_cc)
+
+  # Pick the largest region (regions are sorted by area)
+  image_obj = (image_relabel == 1)
+
+  # Smoothing
+  dilate_filter = sitk.BinaryDilateImageFilter()
+  dilate_filter.SetKernelRadius([1,1,1])
+  dilate_filter.SetForegroundValue(1.0)
+  dilate_filter.SetBackgroundValue(0.0)
+  image_obj = dilate_filter.Execute(image_obj)
+
+  erode_filter = sitk.BinaryErodeImageFilter()
+  erode_filter.SetKernelRadius([2,2,2])
+  erode_filter.SetForegroundValue(1.0)
+  erode_filter.SetBackgroundValue(0.0)
+  image_obj = erode_filter.Execute(image_obj)
+
+  return sitk.GetArrayFromImage(image_obj)
+
+
+def getArrayHash(*arrays):
+  """Return a hash (hex string) of the shape, type and content of the arrays.
+  """
+  h = hashlib.sha1()
+  for array in arrays:
+    array = numpy.ascontiguousarray(array)
+    h.update(repr((array.shape, array.dtype.str)).encode())
+    h.update(array.data)
+  return h.hexdigest()
+
+
+def getDiceCoefficient(labelA, labelB):
+  """Return the Dice coefficient of the voxels > 0 of two labels (1.0 if both are empty).
+  """
+  a = getInsideMask(labelA)
+  b = getInsideMask(labelB)
+  total = numpy.count_nonzero(a) + numpy.count_nonzero(b)
+  if total == 0:
+    return 1.0
+  return 2.0 * numpy.count_nonzero(a & b) / total
+
+
+# Parameters of generateSusceptibilityMap() that change the result
+susceptibilityMapKeys = ('deltaChi', 'gamma', 'TE', 'B0', 'B0vec', 'suscCorrFFTPadding', 'suscCorrFFTMargin', 'precision')
+
+
+class SusceptibilityCache(object):
+  """Memoized object label (segmentObject()) and susceptibility phase map (generateSusceptibilityMap())
+  of the last frame. The label is keyed by a hash of the magnitude images, and the map by a hash
+  of the label, the direction, the spacing and the parameters in susceptibilityMapKeys, so unchanged inputs
+  are neither segmented nor convolved again.
+
+  When the magnitude images change, param['suscCorrResegment'] selects the re-segmentation policy:
+    'always':   (default) segment the new images
+    'interval': keep the label for param['suscCorrResegmentInterval'] frames (default: 10) after
+                each segmentation
+    'dice':     segment the new images, but keep the previous label (and its map) unless the
+                Dice coefficient of the two labels falls below param['suscCorrDiceThreshold']
+                (default: 0.95)
+  """
+
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.mapHits = 0
+    self.mapMisses = 0
+    self.clear()
+
+  def clear(self):
+    self.magnitudeKey = None
+    self.label = None
+    self.framesSinceSegmentation = 0
+    self.mapKey = None
+    self.deltaPhase = None
+
+  def getLabel(self, objectBaseline, objectReference, param, profiler=None):
+    """Return the object label (uint8) segmented from the magnitude images.
+    """
+    key = getArrayHash(objectBaseline, objectReference)
+    if key == self.magnitudeKey:
+      self.hits += 1
+      return self.label
+
+    policy = param.get('suscCorrResegment', 'always')
+    current = self.label is not None and self.label.shape == numpy.shape(objectBaseline)
+    if current and policy == 'interval' and self.framesSinceSegmentation < param.get('suscCorrResegmentInterval', 10):
+      self.hits += 1
+      self.framesSinceSegmentation += 1
+      self.magnitudeKey = key
+      return self.label
+
+    self.misses += 1
+    if profiler is None:
+      label = segmentObject(objectBaseline, objectReference)
+    else:
+      with profiler.stage('segmentation'):
+        label = segmentObject(objectBaseline, objectReference)
+    label.flags.writeable = False
+    if not (current and policy == 'dice' and
+            getDiceCoefficient(label, self.label) >= param.get('suscCorrDiceThreshold', 0.95)):
+      self.label = label
+    self.framesSinceSegmentation = 1
+    self.magnitudeKey = key
+    return self.label
+
+  def getMap(self, objectLabel, direction, param, kernelCache=None, spacing=None):
+    """Return the susceptibility phase map of 'objectLabel' (see generateSusceptibilityMap()).
+    """
+    key = (getArrayHash(objectLabel), tuple(direction), getKernelSpacing(spacing),
+           tuple((name, repr(param.get(name))) for name in susceptibilityMapKeys))
+    if key == self.mapKey:
+      self.mapHits += 1
+      return self.deltaPhase
+
+    self.mapMisses += 1
+    deltaPhase = generateSusceptibilityMap(objectLabel, direction, param, kernelCache, spacing)
+    deltaPhase.flags.writeable = False
+    self.mapKey = key
+    self.deltaPhase = deltaPhase
+    return deltaPhase
+
+
+#
+# Referenceless thermometry
+#
+
+def getPolynomialExponents(order, dimension=3):
+  """Return the exponents (z, y, x) of the monomials of a polynomial of total degree 'order'
+  in 3D, or in the (y, x) plane of each slice if 'dimension' is 2.
+  """
+  exponents = []
+  for degree in range(order + 1):
+    for ez in range(degree + 1 if dimension == 3 else 1):
+      for ey in range(degree - ez + 1):
+        exponents.append((ez, ey, degree - ez - ey))
+  return exponents
+
+
+class PolynomialFit(object):
+  """Least-squares fit of a low-order polynomial to the phase inside a ROI (boolean (Z, Y, X) array).
+  The design matrix only depends on the ROI, so its pseudo-inverse is computed once (by QR
+  factorization); fitting a frame is then a matrix-vector product, and the background is evaluated
+  from the per-axis powers of the coordinates. If 'dimension' is 2, each slice is fitted separately;
+  slices with fewer ROI voxels than coefficients get no background.
+  """
+
+  def __init__(self, roi, order=2, dimension=3):
+    roi = getInsideMask(roi)
+    self.shape = roi.shape
+    self.order = order
+    self.dimension = dimension
+    self.exponents = getPolynomialExponents(order, dimension)
+
+    # Powers of the coordinates, normalized to [-1, 1]
+    self.powers = [numpy.vander((2.0 * numpy.arange(n) + 1.0) / n - 1.0, order + 1, increasing=True)
+                   for n in self.shape]
+    self.planes = [numpy.outer(self.powers[1][:, ey], self.powers[2][:, ex]) for _, ey, ex in self.exponents]
+
+    # Pseudo-inverse of the design matrix of each group (the volume, or each slice)
+    groups = [roi] if dimension == 3 else [roi[z] for z in range(self.shape[0])]
+    self.indices = []
+    self.pinvs = []
+    for group in groups:
+      index = numpy.flatnonzero(group)
+      if len(index) < len(self.exponents):
+        if dimension == 3:
+          raise ValueError('PolynomialFit: %d ROI voxels for %d coefficients' % (len(index), len(self.exponents)))
+        self.indices.append(None)
+        self.pinvs.append(None)
+        continue
+      coords = numpy.unravel_index(index, group.shape)
+      powers = self.powers if dimension == 3 else self.powers[1:]
+      design = numpy.column_stack([numpy.prod([p[c, e] for p, c, e in zip(powers, coords, exponent[-len(coords):])],
+                                              axis=0) for exponent in self.exponents])
+      q, r = numpy.linalg.qr(design)
+      self.indices.append(index)
+      self.pinvs.append(scipy.linalg.solve_triangular(r, q.T))
+    skipped = sum(1 for pinv in self.pinvs if pinv is None)
+    if skipped:
+      logging.warning('PolynomialFit: %d slice(s) without enough ROI voxels are not corrected' % skipped)
+
+  def getCoefficients(self, phase):
+    """Return the coefficients (..., Z, K) of the fit of a (Z, Y, X) or (T, Z, Y, X) phase array,
+    as one set per slice (the z powers are folded into the coefficients in 3D).
+    """
+    phase = numpy.asarray(phase)
+    frames = phase.reshape((-1,) + self.shape)
+    coefficients = numpy.zeros((frames.shape[0], self.shape[0], len(self.exponents)), dtype=numpy.float64)
+    if self.dimension == 3:
+      values = frames.reshape(frames.shape[0], -1)[:, self.indices[0]]
+      zPowers = numpy.array([self.powers[0][:, ez] for ez, _, _ in self.exponents]).T
+      coefficients[:] = values.dot(self.pinvs[0].T)[:, numpy.newaxis, :] * zPowers
+    else:
+      for z, (index, pinv) in enumerate(zip(self.indices, self.pinvs)):
+        if pinv is not None:
+          coefficients[:, z] = frames[:, z].reshape(frames.shape[0], -1)[:, index].dot(pinv.T)
+    return coefficients.reshape(phase.shape[:-2] + (len(self.exponents),))
+
+  def getBackground(self, phase):
+    """Return the fitted background of a (Z, Y, X) or (T, Z, Y, X) phase array.
+    """
+    coefficients = self.getCoefficients(phase).astype(phase.dtype, copy=False)
+    background = numpy.zeros(numpy.shape(phase), dtype=phase.dtype)
+    for k, plane in enumerate(self.planes):
+      background += coefficients[..., k, numpy.newaxis, numpy.newaxis] * plane.astype(phase.dtype, copy=False)
+    return background
+
+
+class PolynomialFitCache(object):
+  """Bounded LRU cache of PolynomialFit objects keyed by (shape, order, dimension) and a hash of the ROI.
+  """
+
+  def __init__(self, maxSize=4):
+    self.maxSize = maxSize
+    self.fits = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def clear(self):
+    self.fits.clear()
+
+  def get(self, roi, order=2, dimension=3):
+    roi = getInsideMask(roi)
+    key = (roi.shape, order, dimension, hashlib.sha1(numpy.packbits(roi).tobytes()).hexdigest())
+    fit = self.fits.get(key)
+    if fit is not None:
+      self.hits += 1
+      self.fits.move_to_end(key)
+      return fit
+
+    self.misses += 1
+    fit = PolynomialFit(roi, order, dimension)
+    self.fits[key] = fit
+    while len(self.fits) > self.maxSize:
+      self.fits.popitem(last=False)
+    return fit
+
+
+#
+# Pipeline
+#
+
+class BaselineCache(object):
+  """Preprocessed baseline phase shared across frames.
+  The entry is identified by a key built from the caller-supplied baseline key and the
+  parameters that affect the preprocessing; a different key replaces the entry.
+  """
+
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.clear()
+
+  def clear(self):
+    self.key = None
+    self.mask = None
+    self.phase = None
+    self._conjugate = None
+
+  def contains(self, key):
+    return key is not None and key == self.key
+
+  def store(self, key, phase, mask):
+    self.key = key
+    self.phase = phase
+    self.mask = mask
+    self._conjugate = None
+
+  @property
+  def conjugate(self):
+    """exp(-i*phase), computed on first use.
+    """
+    if self._conjugate is None:
+      self._conjugate = numpy.exp(-1.0j * self.phase)
+    return self._conjugate
+
+
+ThermometryResult = collections.namedtuple('ThermometryResult', ['temperature', 'phaseDiff', 'objectLabel'])
+
+
+# Parameters that are only used after the phase difference is computed: the conversion to temperature
+# (unless they also change the susceptibility correction), and the threshold, output and display stages
+temperatureKeys = ('alpha', 'gamma', 'B0', 'TE', 'BT')
+finalStageKeys = ('upperThreshold', 'lowerThreshold', 'displayInterpolation', 'colorScaleMin', 'colorScaleMax',
+                  'tempMapVolumeNode', 'outputType', 'outputScale', 'outputOffset', 'suscCorrAutoObjectLabelNode',
+                  'doseVolumeNode', 'doseLabelNode', 'doseThreshold', 'fftWorkers')
+
+
+class ResultCache(object):
+  """Intermediate products of the last frame: the phase difference, the object label and the
+  temperature before the threshold. The phase difference is keyed by the inputs and the parameters
+  that affect it, and the temperature by the parameters in temperatureKeys, so a threshold-, output-
+  or display-only change only applies the threshold again, and a change of the conversion only
+  converts the cached phase difference again.
+  'nodeKey(value)' returns a key of an input node that changes whenever the node is modified, or
+  None if 'value' is not a node (see VolumeIO.VolumeIO.getNodeKey()).
+  """
+
+  def __init__(self, nodeKey=None):
+    self.nodeKey = nodeKey
+    self.hits = 0
+    self.misses = 0
+    self.clear()
+
+  def clear(self):
+    self.entry = None
+
+  def getKeys(self, param):
+    """Return the keys (phaseKey, temperatureKey) of the intermediate products for 'param'.
+    """
+    # With susceptibility correction, the phase difference depends on some of the temperature keys
+    correction = param.get('suscCorrMethod', 'off') not in ('off', None)
+    phaseKey = []
+    for name, value in sorted(param.items()):
+      if name in finalStageKeys or (name in temperatureKeys and not (correction and name in susceptibilityMapKeys)):
+        continue
+      key = self.nodeKey(value) if self.nodeKey is not None else None
+      phaseKey.append((name, repr(value) if key is None else key))
+    return (tuple(phaseKey), tuple(repr(param.get(name)) for name in temperatureKeys))
+
+  def store(self, param, result, **data):
+    """Keep the phase difference and the object label of 'result' (ThermometryResult) computed with
+    'param', and its temperature if it is not thresholded. The 'data' items (e.g. the geometry) are
+    kept in the entry.
+    """
+    phaseKey, temperatureKey = self.getKeys(param)
+    thresholded = param.get('upperThreshold', False) or param.get('lowerThreshold', False)
+    self.entry = dict(data, phaseKey=phaseKey, temperatureKey=temperatureKey, phaseDiff=result.phaseDiff,
+                      objectLabel=result.objectLabel, temperature=None if thresholded else result.temperature)
+
+  def lookup(self, param):
+    """Return the entry stored for the same inputs and phase parameters, or None.
+    """
+    if self.entry is None or self.getKeys(param)[0] != self.entry['phaseKey']:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return self.entry
+
+  def getResult(self, engine, param):
+    """Return the ThermometryResult of the entry returned by lookup() for 'param'. Only the conversion
+    to temperature (if its parameters changed) and the threshold are computed.
+    """
+    entry = self.entry
+    temperatureKey = self.getKeys(param)[1]
+    if entry['temperature'] is None or temperatureKey != entry['temperatureKey']:
+      entry['temperature'] = engine.convertTemperature(entry['phaseDiff'], param)
+      entry['temperatureKey'] = temperatureKey
+    return ThermometryResult(engine.thresholdTemperature(entry['temperature'], param), entry['phaseDiff'],
+                             entry['objectLabel'])
+
+
+class ThermometryEngine(object):
+  """Array-in/array-out PRF thermometry pipeline.
+  'param' uses the same keys as PRFThermometryLogic.runSingleFrame(), except that
+  volume nodes are replaced by the arrays passed to run().
+  The pipeline stages are timed by 'profiler' (Profiling.PipelineProfiler; disabled by default).
+  """
+
+  def __init__(self, profiler=None):
+    self.baselineCache = BaselineCache()
+    self.kernelCache = DipoleKernelCache()
+    self.maskCache = MaskCache()
+    self.polynomialFitCache = PolynomialFitCache()
+    self.susceptibilityCache = SusceptibilityCache()
+    self.profiler = profiler if profiler is not None else Profiling.PipelineProfiler(enabled=False)
+    self.resetTemporalUnwrapping()
+
+  def resetTemporalUnwrapping(self):
+    """Forget the previous frame used by the temporal phase unwrapping in computePhaseDifference().
+    """
+    self.previousPhaseDiff = None
+    self.previousPhaseDiffKey = None
+
+  def preprocess(self, array, scalarType='', mask=None, dtype=numpy.float64):
+    """Cast the raw phase to 'dtype', apply the (boolean) mask and scale it to radians.
+    The mask is applied in place unless the input array is already of 'dtype'.
+    """
+    with self.profiler.stage('cast'):
+      castArray = numpy.asarray(array, dtype=dtype)
+    if mask is not None:
+      with self.profiler.stage('mask'):
+        if isinstance(array, numpy.ndarray) and numpy.may_share_memory(castArray, array):
+          castArray = castArray * mask
+        else:
+          numpy.multiply(castArray, mask, out=castArray)
+    array = castArray
+    with self.profiler.stage('scale'):
+      return scalePhase(array, scalarType)
+
+  def getMask(self, shape, param, mask=None, geometry=None):
+    """Return the mask as a boolean array, or None. param['simpleMask'] selects a generated mask
+    (cached by 'maskCache'): 'disk' (relative 'simpleMask.radius'; round in physical units if
+    'geometry' is given) or 'ellipsoid' ('simpleMask.center' (LPS, mm) and 'simpleMask.radii' (mm)).
+    Otherwise, the voxels of 'mask' greater than 0 are inside.
+    """
+    simpleMask = param.get('simpleMask')
+    if simpleMask == 'disk':
+      return self.maskCache.get('disk', shape, geometry, radius=param['simpleMask.radius'])
+    if simpleMask == 'ellipsoid':
+      return self.maskCache.get('ellipsoid', shape, geometry, param['simpleMask.center'], param['simpleMask.radii'])
+    if mask is not None:
+      return getInsideMask(mask)
+    return mask
+
+  def getBaselineCacheKey(self, baselineKey, param, scalarType='', geometry=None):
+    if baselineKey is None:
+      return None
+    simpleMask = param.get('simpleMask')
+    simpleMaskKey = None
+    if simpleMask == 'disk':
+      simpleMaskKey = (simpleMask, param['simpleMask.radius'], geometry)
+    elif simpleMask == 'ellipsoid':
+      simpleMaskKey = (simpleMask, tuple(param['simpleMask.center']), tuple(param['simpleMask.radii']), geometry)
+    return (baselineKey, scalarType, simpleMaskKey,
+            bool(param['usePhaseUnwrapping']), getUnwrapMethod(param), param.get('useMaskedUnwrapping', True),
+            numpy.dtype(getFloatType(param)).str)
+
+  def prepareBaseline(self, baseline, param, mask=None, scalarType='', baselineKey=None, geometry=None, cache=None):
+    """Return the BaselineCache holding the masked, scaled (and optionally unwrapped) baseline phase.
+    'baselineKey' must change whenever the baseline or the mask data change (e.g. node IDs and
+    modified times); if it is None, the baseline is always recomputed. 'baseline' and 'mask' are
+    not used if the cache already holds the entry for 'baselineKey'. 'geometry' is used for the
+    generated masks (see getMask()). 'cache' is a BaselineCache to use instead of the engine's
+    (e.g. one per baseline of a Baselines.BaselineLibrary).
+    """
+    if cache is None:
+      cache = self.baselineCache
+    key = self.getBaselineCacheKey(baselineKey, param, scalarType, geometry)
+    if cache.contains(key):
+      cache.hits += 1
+      return cache
+
+    cache.misses += 1
+    mask = self.getMask(numpy.shape(baseline), param, mask, geometry)
+    baselinePhase = self.preprocess(baseline, scalarType, mask, getFloatType(param))
+    if param['usePhaseUnwrapping']:
+      with self.profiler.stage('unwrap'):
+        baselinePhase = unwrap(baselinePhase, getUnwrapMask(param, mask), getUnwrapMethod(param))
+    cache.store(key, baselinePhase, mask)
+    return cache
+
+  def computePhaseDifference(self, baseline, reference, param, mask=None, scalarType='', baselineKey=None, geometry=None):
+    """Return the phase shift (radians) between the raw baseline and reference phase arrays.
+    """
+    cachedBaseline = self.prepareBaseline(baseline, param, mask, scalarType, baselineKey, geometry)
+    if not self.useTemporalUnwrapping(param) or cachedBaseline.key is None:
+      return self.computePhaseDifferenceFromBaseline(cachedBaseline, reference, param, scalarType)
+
+    # Temporal unwrapping against the previous frame with the same baseline
+    previousPhaseDiff = None
+    if self.previousPhaseDiffKey == cachedBaseline.key and numpy.shape(self.previousPhaseDiff) == numpy.shape(reference):
+      previousPhaseDiff = self.previousPhaseDiff
+    phaseDiff = self.computePhaseDifferenceFromBaseline(cachedBaseline, reference, param, scalarType, previousPhaseDiff)
+    self.previousPhaseDiff = phaseDiff
+    self.previousPhaseDiffKey = cachedBaseline.key
+    return phaseDiff
+
+  def computePhaseDifferenceFromBaseline(self, cachedBaseline, reference, param, scalarType='', previousPhaseDiff=None):
+    """Return the phase shift (radians) between a preprocessed baseline (see prepareBaseline())
+    and a raw reference phase array. If 'previousPhaseDiff' (the result for the previous frame) is
+    given, the phase shift is unwrapped temporally (see unwrapPhaseDifference()).
+    """
+    referencePhase = self.preprocess(reference, scalarType, cachedBaseline.mask, getFloatType(param))
+    unwrapMask = getUnwrapMask(param, cachedBaseline.mask)
+
+    # Phase unwrapping on the raw input images
+    if param['usePhaseUnwrapping']:
+      with self.profiler.stage('unwrap'):
+        referencePhase = alignPhaseOffset(cachedBaseline.phase,
+                                          unwrap(referencePhase, unwrapMask, getUnwrapMethod(param)),
+                                          unwrapMask, param.get('phaseOffsetEstimator', 'mean'))
+
+    phaseRangeShift = numpy.pi * param['phaseRangeShiftDeg']/180.0
+    with self.profiler.stage('complexDifference'):
+      baselineConjugate = cachedBaseline.conjugate if param['useComplex'] else None
+      phaseDiff = computePhaseDifference(cachedBaseline.phase, referencePhase, param['useComplex'], phaseRangeShift,
+                                         baselineConjugate)
+
+    if param['usePhaseUnwrappingPost']:
+      with self.profiler.stage('unwrap'):
+        phaseDiff = self.unwrapPhaseDifference(phaseDiff, param, unwrapMask, previousPhaseDiff)
+
+    return phaseDiff
+
+  def getReferencelessROI(self, shape, param, mask=None, geometry=None):
+    """Return the ROI of the background fit in the referenceless mode: a ring (spherical shell)
+    between the relative radii param['referenceless.innerRadius'] and param['referenceless.outerRadius']
+    around param['referenceless.center'] (see generateDiskMask()), inside 'mask' (boolean) if given.
+    """
+    center = param.get('referenceless.center', [0.5,0.5,0.5])
+    outer = self.maskCache.get('disk', shape, geometry, center, param.get('referenceless.outerRadius', 0.3))
+    inner = self.maskCache.get('disk', shape, geometry, center, param.get('referenceless.innerRadius', 0.15))
+    roi = outer & ~inner
+    if mask is not None:
+      roi &= mask
+    return roi
+
+  def computeReferencelessPhaseDifference(self, reference, param, mask=None, scalarType='', geometry=None):
+    """Return the phase shift (radians) of a raw (Z, Y, X) or (T, Z, Y, X) reference phase array
+    relative to its background, estimated without a baseline by fitting a polynomial of order
+    param['referenceless.order'] (default: 2) in the ROI of getReferencelessROI(), in 3D or slice by
+    slice (param['referenceless.dimension']: 3 (default) or 2). The fit is cached per ROI and order
+    (see PolynomialFitCache). The phase is unwrapped spatially if either unwrapping option is on;
+    otherwise, it must not wrap inside the ROI.
+    """
+    shape = numpy.shape(reference)[-3:]
+    mask = self.getMask(shape, param, mask, geometry)
+    phase = self.preprocess(reference, scalarType, mask, getFloatType(param))
+    if param['usePhaseUnwrapping'] or param['usePhaseUnwrappingPost']:
+      unwrapMask = getUnwrapMask(param, mask)
+      frames = phase.reshape((-1,) + shape)
+      for i in range(frames.shape[0]):
+        with self.profiler.stage('unwrap'):
+          frames[i] = unwrap(frames[i], unwrapMask, getUnwrapMethod(param))
+
+    with self.profiler.stage('backgroundFit'):
+      fit = self.polynomialFitCache.get(self.getReferencelessROI(shape, param, mask, geometry),
+                                        param.get('referenceless.order', 2), param.get('referenceless.dimension', 3))
+      phase -= fit.getBackground(phase)
+      if mask is not None:
+        phase *= mask
+    return phase
+
+  def useTemporalUnwrapping(self, param):
+    return bool(param['usePhaseUnwrappingPost'] and param.get('temporalUnwrapping', False))
+
+  def unwrapPhaseDifference(self, phaseDiff, param, unwrapMask=None, previousPhaseDiff=None):
+    """Unwrap the phase shift spatially, or temporally against 'previousPhaseDiff' if
+    param['temporalUnwrapping'] is on (see unwrapTemporal()).
+    """
+    if previousPhaseDiff is not None and self.useTemporalUnwrapping(param):
+      return unwrapTemporal(phaseDiff, previousPhaseDiff, unwrapMask, getUnwrapMethod(param),
+                            param.get('temporalUnwrapping.maxChange', numpy.pi/2),
+                            param.get('temporalUnwrapping.maxFailure', 0.05))
+    return unwrap(phaseDiff, unwrapMask, getUnwrapMethod(param))
+
+  def unwrapPhaseDifferenceSeries(self, phaseDiff, param, unwrapMask=None, previousPhaseDiff=None):
+    """Unwrap a (T, Z, Y, X) phase shift series in place. With temporal unwrapping, the first
+    frame is unwrapped against 'previousPhaseDiff' (the last frame of the previous chunk), or
+    spatially if None, and each following frame against the previous one.
+    """
+    for i in range(phaseDiff.shape[0]):
+      with self.profiler.stage('unwrap'):
+        phaseDiff[i] = self.unwrapPhaseDifference(phaseDiff[i], param, unwrapMask, previousPhaseDiff)
+      previousPhaseDiff = phaseDiff[i]
+
+  def computeSusceptibilityCorrection(self, param, geometry, objectLabel=None, objectBaseline=None, objectReference=None):
+    """Return (deltaPhase, objectLabel) for the selected susceptibility correction method,
+    or (None, None) if the correction is off. 'geometry' (VolumeGeometry) gives the B0 axis and the
+    voxel spacing of the dipole kernel. The label and the map are memoized across frames
+    (see SusceptibilityCache); 'deltaPhase' is read-only.
+    """
+    method = param.get('suscCorrMethod', 'off')
+    if method == 'manual':
+      objectLabel = numpy.asarray(objectLabel, dtype=numpy.int16)
+    elif method == 'auto':
+      objectLabel = self.susceptibilityCache.getLabel(objectBaseline, objectReference, param, self.profiler)
+    else:
+      return (None, None)
+    with self.profiler.stage('susceptibility'):
+      return (self.susceptibilityCache.getMap(objectLabel, geometry.direction, param, self.kernelCache, geometry.spacing),
+              objectLabel)
+
+  def computeTemperature(self, phaseDiff, param):
+    """Convert the phase shift to temperature and apply the threshold.
+    """
+    return self.thresholdTemperature(self.convertTemperature(phaseDiff, param), param)
+
+  def convertTemperature(self, phaseDiff, param):
+    """Convert the phase shift to temperature, without the threshold (e.g. for the thermal dose).
+    """
+    with self.profiler.stage('temperature'):
+      return phaseToTemperature(phaseDiff, param['alpha'], param['gamma'], param['B0'], param['TE'], param['BT'])
+
+  def thresholdTemperature(self, temperature, param):
+    """Apply param['lowerThreshold'] and param['upperThreshold'] (if set) to a temperature map.
+    The input is not modified.
+    """
+    upperThreshold = param.get('upperThreshold', False)
+    lowerThreshold = param.get('lowerThreshold', False)
+    if upperThreshold or lowerThreshold:
+      with self.profiler.stage('threshold'):
+        temperature = applyThreshold(temperature, lowerThreshold, upperThreshold)
+    return temperature
+
+  def computePhaseDifferenceSeries(self, baseline, referenceSeries, param, mask=None, scalarType='', baselineKey=None,
+                                   executor=None, geometry=None):
+    """Vectorized version of computePhaseDifference() for a (T, Z, Y, X) reference series.
+    Scaling, masking and the complex difference are computed for all frames at once;
+    only phase unwrapping, which is inherently 3D, is done frame by frame.
+    If 'executor' (Parallel.FrameExecutor) is given, the frames are instead processed
+    independently on its thread or process pool.
+    """
+    cachedBaseline = self.prepareBaseline(baseline, param, mask, scalarType, baselineKey, geometry)
+    return self.computePhaseDifferenceSeriesFromBaseline(cachedBaseline, referenceSeries, param, scalarType, executor)
+
+  def computePhaseDifferenceSeriesFromBaseline(self, cachedBaseline, referenceSeries, param, scalarType='', executor=None,
+                                               previousPhaseDiff=None):
+    """computePhaseDifferenceSeries() against a baseline prepared by prepareBaseline().
+    'previousPhaseDiff' is the phase shift of the frame before the series (for temporal unwrapping).
+    """
+    if executor is not None:
+      if not self.useTemporalUnwrapping(param):
+        return executor.computePhaseDifferences(self, cachedBaseline, referenceSeries, param, scalarType)
+      # The frames depend on each other in the temporal unwrapping, which is done serially afterwards
+      phaseDiff = executor.computePhaseDifferences(self, cachedBaseline, referenceSeries,
+                                                   dict(param, usePhaseUnwrappingPost=False), scalarType)
+      self.unwrapPhaseDifferenceSeries(phaseDiff, param, getUnwrapMask(param, cachedBaseline.mask), previousPhaseDiff)
+      return phaseDiff
+
+    referencePhase = self.preprocess(referenceSeries, scalarType, cachedBaseline.mask, getFloatType(param))
+    unwrapMask = getUnwrapMask(param, cachedBaseline.mask)
+
+    if param['usePhaseUnwrapping']:
+      for i in range(referencePhase.shape[0]):
+        with self.profiler.stage('unwrap'):
+          referencePhase[i] = alignPhaseOffset(cachedBaseline.phase,
+                                               unwrap(referencePhase[i], unwrapMask, getUnwrapMethod(param)),
+                                               unwrapMask, param.get('phaseOffsetEstimator', 'mean'))
+
+    phaseRangeShift = numpy.pi * param['phaseRangeShiftDeg']/180.0
+    with self.profiler.stage('complexDifference'):
+      baselineConjugate = cachedBaseline.conjugate[numpy.newaxis] if param['useComplex'] else None
+      phaseDiff = computePhaseDifference(cachedBaseline.phase[numpy.newaxis], referencePhase, param['useComplex'],
+                                         phaseRangeShift, baselineConjugate)
+    del referencePhase
+
+    if param['usePhaseUnwrappingPost']:
+      self.unwrapPhaseDifferenceSeries(phaseDiff, param, unwrapMask, previousPhaseDiff)
+
+    return phaseDiff
+
+  def computePhaseDifferenceSeriesFromLibrary(self, baselineLibrary, referenceSeries, param, scalarType='', executor=None,
+                                              geometry=None):
+    """computePhaseDifferenceSeries() with the nearest baseline of a Baselines.BaselineLibrary for each
+    frame. The frames that share a baseline are processed together. Temporal unwrapping is not used,
+    as consecutive frames may have different baselines.
+    """
+    matches = numpy.array([baselineLibrary.findNearest(frame).index for frame in referenceSeries])
+    param = dict(param, temporalUnwrapping=False)
+    phaseDiff = None
+    for index in numpy.unique(matches):
+      frames = numpy.flatnonzero(matches == index)
+      cachedBaseline = baselineLibrary.prepare(self, index, param, geometry)
+      group = self.computePhaseDifferenceSeriesFromBaseline(cachedBaseline, referenceSeries[frames], param, scalarType,
+                                                            executor)
+      if phaseDiff is None:
+        phaseDiff = numpy.empty((len(matches),) + group.shape[1:], dtype=group.dtype)
+      phaseDiff[frames] = group
+    return phaseDiff
+
+  def runSeries(self, baseline, referenceSeries, param, mask=None, scalarType='', geometry=None, objectLabel=None,
+                baselineKey=None, executor=None, baselineLibrary=None):
+    """Run the full pipeline for a (T, Z, Y, X) reference series against a single baseline, or against
+    the nearest baseline of 'baselineLibrary' (Baselines.BaselineLibrary; 'baseline' is then not used).
+    With param['referenceless'], no baseline is used (see computeReferencelessPhaseDifference()).
+    Automatic (per-frame) susceptibility correction is not available in this mode; a manual object
+    label is applied to all frames. See computePhaseDifferenceSeries() for 'executor'.
+    """
+    if geometry is None:
+      geometry = VolumeGeometry.identity()
+
+    if param.get('referenceless', False):
+      phaseDiff = self.computeReferencelessPhaseDifference(referenceSeries, param, mask, scalarType, geometry)
+    elif baselineLibrary is not None:
+      phaseDiff = self.computePhaseDifferenceSeriesFromLibrary(baselineLibrary, referenceSeries, param, scalarType,
+                                                               executor, geometry)
+    else:
+      phaseDiff = self.computePhaseDifferenceSeries(baseline, referenceSeries, param, mask, scalarType, baselineKey,
+                                                    executor, geometry)
+
+    if param.get('suscCorrMethod', 'off') == 'manual' and objectLabel is not None:
+      deltaPhase, objectLabel = self.computeSusceptibilityCorrection(param, geometry, objectLabel)
+      with self.profiler.stage('susceptibility'):
+        phaseDiff -= deltaPhase[numpy.newaxis]
+    elif param.get('suscCorrMethod', 'off') != 'off':
+      logging.warning('runSeries: susceptibility correction requires an object label in the series mode. Skipped.')
+
+    return ThermometryResult(self.computeTemperature(phaseDiff, param), phaseDiff, objectLabel)
+
+  def iterSeries(self, baseline, referenceSeries, param, mask=None, scalarType='', geometry=None, objectLabel=None,
+                 baselineKey=None, executor=None, chunkSize=8, baselineLibrary=None):
+    """Out-of-core version of runSeries(). 'referenceSeries' is a (T, Z, Y, X) array or a lazily read
+    series (see Streaming.openSeries()), processed in chunks of 'chunkSize' frames, so only a few
+    frames are in memory at a time. Yields (start, ThermometryResult) for each chunk, where 'start'
+    is the index of the first frame of the chunk. Temporal unwrapping continues across the chunks
+    (except with a 'baselineLibrary', see computePhaseDifferenceSeriesFromLibrary()).
+    """
+    if geometry is None:
+      geometry = VolumeGeometry.identity()
+
+    referenceless = param.get('referenceless', False)
+    if baselineLibrary is None and not referenceless:
+      cachedBaseline = self.prepareBaseline(baseline, param, mask, scalarType, baselineKey, geometry)
+
+    deltaPhase = None
+    if param.get('suscCorrMethod', 'off') == 'manual' and objectLabel is not None:
+      deltaPhase, objectLabel = self.computeSusceptibilityCorrection(param, geometry, objectLabel)
+    elif param.get('suscCorrMethod', 'off') != 'off':
+      logging.warning('iterSeries: susceptibility correction requires an object label in the series mode. Skipped.')
+
+    previousPhaseDiff = None
+    for start in range(0, len(referenceSeries), chunkSize):
+      if referenceless:
+        phaseDiff = self.computeReferencelessPhaseDifference(referenceSeries[start:start+chunkSize], param, mask,
+                                                             scalarType, geometry)
+      elif baselineLibrary is not None:
+        phaseDiff = self.computePhaseDifferenceSeriesFromLibrary(baselineLibrary, referenceSeries[start:start+chunkSize],
+                                                                 param, scalarType, executor, geometry)
+      else:
+        phaseDiff = self.computePhaseDifferenceSeriesFromBaseline(cachedBaseline, referenceSeries[start:start+chunkSize],
+                                                                  param, scalarType, executor, previousPhaseDiff)
+      if self.useTemporalUnwrapping(param) and not referenceless:
+        previousPhaseDiff = phaseDiff[-1].copy()
+      if deltaPhase is not None:
+        with self.profiler.stage('susceptibility'):
+          phaseDiff -= deltaPhase[numpy.newaxis]
+      yield start, ThermometryResult(self.computeTemperature(phaseDiff, param), phaseDiff, objectLabel)
+
+  def run(self, baseline, reference, param, mask=None, scalarType='', geometry=None,
+          objectLabel=None, objectBaseline=None, objectReference=None, baselineKey=None, baselineLibrary=None):
+    """Run the full pipeline: raw phase -> phase difference -> temperature.
+    See prepareBaseline() for 'baselineKey'. With a 'baselineLibrary' (Baselines.BaselineLibrary),
+    the baseline nearest to 'reference' is used instead of 'baseline' (see baselineLibrary.lastMatch).
+    With param['referenceless'], 'baseline' is not used either: the background phase is fitted in
+    'reference' itself (see computeReferencelessPhaseDifference()).
+    """
+    if geometry is None:
+      geometry = VolumeGeometry.identity()
+
+    if param.get('referenceless', False):
+      phaseDiff = self.computeReferencelessPhaseDifference(reference, param, mask, scalarType, geometry)
+    elif baselineLibrary is not None:
+      cachedBaseline = baselineLibrary.select(self, reference, param, geometry)
+      phaseDiff = self.computePhaseDifferenceFromBaseline(cachedBaseline, reference, param, scalarType)
+    else:
+      phaseDiff = self.computePhaseDifference(baseline, reference, param, mask, scalarType, baselineKey, geometry)
+
+    deltaPhase, objectLabel = self.computeSusceptibilityCorrection(param, geometry, objectLabel,
+                                                                   objectBaseline, objectReference)
+    if deltaPhase is not None:
+      with self.profiler.stage('susceptibility'):
+        phaseDiff = phaseDiff - deltaPhase
+
+    return ThermometryResult(self.computeTemperature(phaseDiff, param), phaseDiff, objectLabel)
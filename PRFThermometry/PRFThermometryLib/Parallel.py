@@ -0,0 +1,84 @@
+"""Parallel multi-frame execution for the PRF thermometry engine.
+
+Once the baseline is fixed, the phase difference (including phase unwrapping) of each frame
+is independent of the other frames. FrameExecutor distributes the frames over a thread pool
+(default; NumPy and scikit-image release the GIL for the heavy parts) or a process pool
+(for headless use), and returns the results in frame index order.
+"""
+
+import concurrent.futures
+import os
+import numpy
+
+from . import Engine
+
+
+# Per-process state for the process pool (set by _initializeWorker())
+_worker = {}
+
+
+def isPrimitive(value):
+  if isinstance(value, (list, tuple)):
+    return all(isPrimitive(item) for item in value)
+  return value is None or isinstance(value, (bool, int, float, str))
+
+
+def getWorkerParam(param):
+  """Return the entries of 'param' with primitive values (None, bool, int, float, str, and lists
+  or tuples of those) for the process pool. Volume nodes and other objects of the caller (which
+  cannot be pickled, or only exist in the calling process) are left out.
+  """
+  return dict((key, value) for key, value in param.items() if isPrimitive(value))
+
+
+def _initializeWorker(baselinePhase, mask, param, scalarType):
+  cachedBaseline = Engine.BaselineCache()
+  cachedBaseline.store(None, baselinePhase, mask)
+  _worker['engine'] = Engine.ThermometryEngine()
+  _worker['baseline'] = cachedBaseline
+  _worker['param'] = param
+  _worker['scalarType'] = scalarType
+
+
+def _computePhaseDifference(reference):
+  return _worker['engine'].computePhaseDifferenceFromBaseline(_worker['baseline'], reference, _worker['param'],
+                                                              _worker['scalarType'])
+
+
+class FrameExecutor(object):
+  """Computes per-frame phase differences on a thread ('thread') or process ('process') pool.
+  'workers' is the number of workers (None or 0: number of CPUs).
+  """
+
+  def __init__(self, workers=None, mode='thread'):
+    if mode not in ('thread', 'process'):
+      raise ValueError("FrameExecutor: unknown mode '%s'" % mode)
+    if not workers:
+      workers = os.cpu_count() or 1
+    self.workers = workers
+    self.mode = mode
+
+  def computePhaseDifferences(self, engine, cachedBaseline, referenceSeries, param, scalarType=''):
+    """Return the (T, Z, Y, X) phase differences of 'referenceSeries' against 'cachedBaseline'
+    (see ThermometryEngine.prepareBaseline()).
+    """
+    phaseDiff = numpy.empty(numpy.shape(referenceSeries), dtype=Engine.getFloatType(param))
+
+    if self.mode == 'process':
+      executor = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_initializeWorker,
+                                                        initargs=(cachedBaseline.phase, cachedBaseline.mask,
+                                                                  getWorkerParam(param), scalarType))
+      function = _computePhaseDifference
+    else:
+      if param['useComplex']:
+        cachedBaseline.conjugate  # Compute it once before the threads share it
+      executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+      function = lambda reference: engine.computePhaseDifferenceFromBaseline(cachedBaseline, reference, param,
+                                                                             scalarType)
+
+    with executor:
+      # Executor.map() yields the results in the order of the input frames
+      for i, result in enumerate(executor.map(function, referenceSeries)):
+        phaseDiff[i] = result
+
+    return phaseDiff
@@ -0,0 +1,149 @@
+"""Synthetic phase image phantoms for testing and benchmarking the PRF thermometry engine.
+
+PhantomGenerator simulates a baseline and a series of wrapped reference phase images (raw
+scanner values, see encodePhase()) with a Gaussian heating spot, a linear background phase,
+a global phase drift, noise, a tissue mask, and an object (e.g. an applicator) inserted after
+the baseline, whose susceptibility shifts the phase around it. The reference frames are
+generated on demand, so long series of large volumes do not need to fit in memory.
+"""
+
+import numpy
+import scipy.ndimage
+
+from . import Engine
+
+
+def getDefaultParam():
+  """Return the engine parameters used by the phantoms (the defaults of the module panel).
+  """
+  return {
+    'usePhaseUnwrapping': False, 'usePhaseUnwrappingPost': True, 'useComplex': True,
+    'phaseRangeShiftDeg': 30.0, 'alpha': -0.01, 'gamma': 42.576, 'B0': 3.0, 'TE': 0.01, 'BT': 37.0,
+    'B0vec': [0.0, 0.0, 1.0], 'deltaChi': 3.2, 'upperThreshold': False, 'lowerThreshold': False,
+    'suscCorrMethod': 'manual', 'simpleMask': None,
+    }
+
+
+def encodePhase(phase, scalarType='short'):
+  """Wrap the phase (radians) and convert it to raw scanner values (the inverse of Engine.scalePhase()).
+  """
+  phase = numpy.angle(numpy.exp(1.0j * phase))
+  if scalarType == 'unsigned short':
+    return numpy.round((phase + numpy.pi) * 2048.0 / numpy.pi).astype(numpy.uint16)
+  return numpy.round(phase * 4096.0 / numpy.pi).astype(numpy.int16)
+
+
+class PhantomGenerator(object):
+  """Generates a synthetic PRF thermometry series of 'frames' frames of 'shape' (z, y, x).
+
+  The peak temperature rise of the heating spot increases linearly to 'peakHeating' (deg C) at
+  the last frame. 'drift' is the global phase drift per frame (radians) and 'noise' the standard
+  deviation of the phase noise (radians). If 'susceptibility' is True, a cylindrical object along
+  the x axis is present in the reference frames (not in the baseline). 'param' overrides the
+  engine parameters of getDefaultParam().
+  """
+
+  def __init__(self, shape=(16,128,128), frames=10, peakHeating=40.0, drift=0.0, noise=0.02,
+               susceptibility=True, scalarType='short', seed=0, param=None):
+    self.shape = tuple(shape)
+    self.frames = frames
+    self.peakHeating = peakHeating
+    self.drift = drift
+    self.noise = noise
+    self.scalarType = scalarType
+    self.seed = seed
+    self.param = getDefaultParam()
+    if not susceptibility:
+      self.param['suscCorrMethod'] = 'off'
+    if param:
+      self.param.update(param)
+
+    # Coordinates relative to the volume size (-0.5 to 0.5)
+    z, y, x = [(numpy.arange(n, dtype=numpy.float64) + 0.5) / n - 0.5 for n in self.shape]
+    z, y, x = z[:, None, None], y[None, :, None], x[None, None, :]
+    aspect = self.shape[0] / float(max(self.shape))
+
+    self.backgroundPhase = 6.0 * x + 4.0 * y + 2.0 * z
+    self.mask = ((x / 0.45)**2 + (y / 0.45)**2 + (z / 0.45)**2 <= 1.0).astype(numpy.uint8)
+    self.spot = numpy.exp(-((x - 0.05)**2 + y**2 + (z * aspect)**2) / (2.0 * 0.05**2))
+
+    # Object: a thin cylinder along the x axis, ending near the heating spot
+    self.objectLabel = numpy.zeros(self.shape, dtype=numpy.int16)
+    if susceptibility:
+      radius = max(0.02, 1.5 / min(self.shape[1:]))
+      inside = ((y / radius)**2 + (z * aspect / radius)**2 <= 1.0) & (x < 0.0) & (x > -0.4)
+      self.objectLabel[numpy.broadcast_to(inside, self.shape)] = 1
+      direction = Engine.VolumeGeometry.identity().direction
+      self.susceptibilityPhase = Engine.generateSusceptibilityMap(self.objectLabel, direction, self.param)
+    else:
+      self.susceptibilityPhase = numpy.zeros(self.shape)
+
+  def getParam(self):
+    return dict(self.param)
+
+  def getPhasePerDegree(self):
+    p = self.param
+    return p['alpha'] * 2.0 * numpy.pi * p['gamma'] * p['B0'] * p['TE']
+
+  def getHeating(self, frame):
+    """Peak temperature rise (deg C) at 'frame'.
+    """
+    return self.peakHeating * (frame + 1) / float(self.frames)
+
+  def getTemperature(self, frame):
+    """True temperature (deg C) at 'frame'.
+    """
+    return self.param['BT'] + self.getHeating(frame) * self.spot
+
+  def getNoise(self, frame):
+    # A separate seed for each frame makes the frames reproducible in any order (baseline: frame -1)
+    rng = numpy.random.default_rng((self.seed, frame + 1))
+    return self.noise * rng.standard_normal(self.shape)
+
+  def getBaseline(self):
+    return encodePhase(self.backgroundPhase + self.getNoise(-1), self.scalarType)
+
+  def getReference(self, frame):
+    phase = self.backgroundPhase + self.drift * (frame + 1) + self.getHeating(frame) * self.getPhasePerDegree() * self.spot
+    phase = phase + self.susceptibilityPhase + self.getNoise(frame)
+    return encodePhase(phase, self.scalarType)
+
+  def getReferenceSeries(self, start=0, stop=None):
+    """Return the reference frames 'start' to 'stop' - 1 (default: all) as a (T, Z, Y, X) array.
+    """
+    if stop is None:
+      stop = self.frames
+    dtype = numpy.uint16 if self.scalarType == 'unsigned short' else numpy.int16
+    series = numpy.empty((stop - start,) + self.shape, dtype=dtype)
+    for i in range(start, stop):
+      series[i - start] = self.getReference(i)
+    return series
+
+  def iterReferences(self):
+    for i in range(self.frames):
+      yield self.getReference(i)
+
+  def getMask(self):
+    return self.mask
+
+  def getObjectLabel(self):
+    return self.objectLabel
+
+  def getEvaluationMask(self, margin=2):
+    """Voxels inside the mask and more than 'margin' voxels away from the object, where the
+    susceptibility field is smooth enough to be unwrapped (for accuracy checks).
+    """
+    evaluationMask = self.mask > 0
+    if numpy.any(self.objectLabel):
+      evaluationMask &= ~scipy.ndimage.binary_dilation(self.objectLabel > 0, iterations=margin)
+    return evaluationMask
+
+  def getObjectBaseline(self):
+    """Magnitude image before the object is inserted (for Engine.segmentObject()).
+    """
+    return self.mask.astype(numpy.int16) * 1000
+
+  def getObjectReference(self):
+    """Magnitude image with the object (signal void).
+    """
+    return self.mask.astype(numpy.int16) * (1 - self.objectLabel) * 1000
@@ -0,0 +1,181 @@
+"""Per-stage timing and profiling hooks for the PRF thermometry pipeline.
+
+The engine and the Slicer logic wrap each pipeline stage (pull, cast, mask, scale, unwrap,
+complexDifference, backgroundFit, susceptibility, segmentation, temperature, threshold, push,
+display) in 'with profiler.stage(name):'. The stages are recorded for the frame that is active on the
+calling thread (see PipelineProfiler.activate()), so a frame can be pulled on the main thread,
+computed on a worker thread and pushed on the main thread again.
+
+  profiler = Profiling.PipelineProfiler()
+  profiler.addCallback(lambda frame: print(frame.toDict()))
+  engine = Engine.ThermometryEngine(profiler=profiler)
+  frame = profiler.beginFrame('frame 0')
+  with profiler.activate(frame):
+    engine.run(baseline, reference, param)
+  profiler.endFrame(frame)
+  profiler.exportCSV('profile.csv')
+"""
+
+import collections
+import contextlib
+import csv
+import json
+import threading
+import time
+import tracemalloc
+
+
+StageRecord = collections.namedtuple('StageRecord', ['frame', 'stage', 'time', 'peakMemory'])
+
+
+class FrameProfile(object):
+  """Stage timings of a single frame. 'stages' maps the stage names to the accumulated wall time (s)
+  and 'peakMemory' to the largest memory peak (bytes) allocated by the stage if memory tracking is on.
+  """
+
+  def __init__(self, index, label=None):
+    self.index = index
+    self.label = label
+    self.stages = collections.OrderedDict()
+    self.peakMemory = collections.OrderedDict()
+    self.startTime = time.perf_counter()
+    self.totalTime = None
+
+  def add(self, stage, elapsed, peakMemory=None):
+    self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+    if peakMemory is not None:
+      self.peakMemory[stage] = max(self.peakMemory.get(stage, 0), peakMemory)
+
+  def toDict(self):
+    return {
+      'frame': self.index,
+      'label': self.label,
+      'totalTime': self.totalTime,
+      'stages': dict(self.stages),
+      'peakMemory': dict(self.peakMemory),
+      }
+
+
+class PipelineProfiler(object):
+  """Records the wall time (and optionally the peak memory allocated above the memory in use at the
+  start of the stage) of the pipeline stages.
+  A disabled profiler ('enabled' False) records nothing and adds almost no overhead.
+  With 'trackMemory', tracemalloc is started on the first stage; it slows down the pipeline
+  considerably, and memory allocated outside the Python allocator (e.g. in FFTW or ITK) is not
+  traced. Nested stages reset the peak of the enclosing stage.
+  """
+
+  def __init__(self, enabled=True, trackMemory=False):
+    self.enabled = enabled
+    self.trackMemory = trackMemory
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._callbacks = []
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.records = []
+      self.frames = []
+      self._frameCount = 0
+
+  def addCallback(self, callback):
+    """Call 'callback(frameProfile)' whenever a frame is completed by endFrame().
+    """
+    self._callbacks.append(callback)
+
+  def removeCallback(self, callback):
+    self._callbacks.remove(callback)
+
+  def beginFrame(self, label=None):
+    """Return a new FrameProfile, or None if the profiler is disabled.
+    """
+    if not self.enabled:
+      return None
+    with self._lock:
+      frame = FrameProfile(self._frameCount, label)
+      self._frameCount += 1
+    return frame
+
+  def endFrame(self, frame):
+    if frame is None:
+      return
+    frame.totalTime = time.perf_counter() - frame.startTime
+    with self._lock:
+      self.frames.append(frame)
+    for callback in self._callbacks:
+      callback(frame)
+
+  @contextlib.contextmanager
+  def activate(self, frame):
+    """Attribute the stages run by the calling thread inside the 'with' block to 'frame'.
+    """
+    previous = getattr(self._local, 'frame', None)
+    self._local.frame = frame
+    try:
+      yield frame
+    finally:
+      self._local.frame = previous
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    if not self.enabled:
+      yield
+      return
+
+    trackMemory = self.trackMemory
+    if trackMemory:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+      tracemalloc.reset_peak()
+      startMemory = tracemalloc.get_traced_memory()[0]
+    startTime = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - startTime
+      peakMemory = tracemalloc.get_traced_memory()[1] - startMemory if trackMemory else None
+      frame = getattr(self._local, 'frame', None)
+      with self._lock:
+        self.records.append(StageRecord(frame.index if frame is not None else None, name, elapsed, peakMemory))
+        if frame is not None:
+          frame.add(name, elapsed, peakMemory)
+
+  def getSummary(self):
+    """Return an OrderedDict mapping the stage names to 'count', 'totalTime', 'meanTime', 'maxTime'
+    and 'peakMemory' (None if memory tracking is off).
+    """
+    summary = collections.OrderedDict()
+    with self._lock:
+      records = list(self.records)
+    for record in records:
+      entry = summary.setdefault(record.stage, {'count': 0, 'totalTime': 0.0, 'maxTime': 0.0, 'peakMemory': None})
+      entry['count'] += 1
+      entry['totalTime'] += record.time
+      entry['maxTime'] = max(entry['maxTime'], record.time)
+      if record.peakMemory is not None:
+        entry['peakMemory'] = max(entry['peakMemory'] or 0, record.peakMemory)
+    for entry in summary.values():
+      entry['meanTime'] = entry['totalTime'] / entry['count']
+    return summary
+
+  def exportCSV(self, path):
+    """Write one row per recorded stage (frame, label, stage, time, peakMemory).
+    """
+    with self._lock:
+      records = list(self.records)
+      labels = dict((frame.index, frame.label) for frame in self.frames)
+    with open(path, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(['frame', 'label', 'stage', 'time', 'peakMemory'])
+      for record in records:
+        writer.writerow(['' if record.frame is None else record.frame, labels.get(record.frame, '') or '',
+                         record.stage, '%.6f' % record.time, '' if record.peakMemory is None else record.peakMemory])
+
+  def exportJSON(self, path):
+    """Write the completed frames and the summary as JSON.
+    """
+    with self._lock:
+      frames = [frame.toDict() for frame in self.frames]
+    with open(path, 'w') as f:
+      json.dump({'frames': frames, 'summary': self.getSummary()}, f, indent=2)
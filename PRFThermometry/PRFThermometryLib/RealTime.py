@@ -0,0 +1,118 @@
+"""Latest-frame-wins real-time pipeline.
+
+Frames (e.g. the incoming reference phase images in the automatic update mode) are processed
+on a background thread. If frames arrive faster than they can be processed, only the newest
+pending frame is kept, so the displayed result never lags behind by more than one frame.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+
+class LatestFramePipeline(object):
+  """Runs 'process(frame)' on a worker thread for the newest submitted frame.
+
+  submit() and takeResult() can be called from any thread (typically the GUI thread, which
+  polls takeResult() with a timer and displays the result). A frame is counted as dropped if it
+  is replaced by a newer frame before it is processed, or if its result is replaced by a newer
+  result before it is taken.
+  """
+
+  def __init__(self, process, latencyHistory=100):
+    self.process = process
+    self._condition = threading.Condition()
+    self._pending = None
+    self._result = None
+    self._running = False
+    self._thread = None
+    self._latencyHistory = latencyHistory
+    self.resetStatistics()
+
+  def resetStatistics(self):
+    with self._condition:
+      self.submitted = 0
+      self.processed = 0
+      self.dropped = 0
+      self.failed = 0
+      self.latencies = collections.deque(maxlen=self._latencyHistory)
+
+  def start(self):
+    with self._condition:
+      if self._running:
+        return
+      self._running = True
+    self._thread = threading.Thread(target=self._run, name='LatestFramePipeline')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout=None):
+    """Stop the worker thread. A pending frame is discarded; a frame being processed is completed.
+    """
+    with self._condition:
+      self._running = False
+      self._pending = None
+      self._condition.notify_all()
+    if self._thread is not None:
+      self._thread.join(timeout)
+      self._thread = None
+
+  def isRunning(self):
+    return self._running
+
+  def submit(self, frame):
+    with self._condition:
+      if self._pending is not None:
+        self.dropped += 1
+      self._pending = (frame, time.perf_counter())
+      self.submitted += 1
+      self._condition.notify()
+
+  def takeResult(self):
+    """Return (frame, result, latency) for the newest processed frame, or None if there is no new result.
+    'latency' is the time (s) from submit() to the end of processing.
+    """
+    with self._condition:
+      result = self._result
+      self._result = None
+      return result
+
+  def getStatistics(self):
+    with self._condition:
+      latencies = list(self.latencies)
+      return {
+        'submitted': self.submitted,
+        'processed': self.processed,
+        'dropped': self.dropped,
+        'failed': self.failed,
+        'lastLatency': latencies[-1] if latencies else None,
+        'meanLatency': sum(latencies) / len(latencies) if latencies else None,
+        'maxLatency': max(latencies) if latencies else None,
+        }
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while self._running and self._pending is None:
+          self._condition.wait()
+        if not self._running:
+          return
+        frame, submitTime = self._pending
+        self._pending = None
+
+      try:
+        result = self.process(frame)
+      except Exception:
+        logging.exception('LatestFramePipeline: processing failed')
+        with self._condition:
+          self.failed += 1
+        continue
+
+      latency = time.perf_counter() - submitTime
+      with self._condition:
+        if self._result is not None:
+          self.dropped += 1
+        self._result = (frame, result, latency)
+        self.processed += 1
+        self.latencies.append(latency)
@@ -0,0 +1,643 @@
+"""Out-of-core reading of long 4D phase series.
+
+openSeries() returns a lazily read series of (Z, Y, X) frames: len(series) is the number of frames,
+series[i] reads a single frame and series[start:stop] a (T, Z, Y, X) chunk. Only the frames that are
+accessed are read, so the resident memory stays bounded to a few frames regardless of the length of
+the session (see ThermometryEngine.iterSeries()).
+
+  series = Streaming.openSeries('session/reference.nrrd')
+  for start, result in engine.iterSeries(series[0], series, param, geometry=series.geometry,
+                                         scalarType=series.scalarType):
+    ...
+
+Supported inputs:
+  NRRD (.nrrd, .nhdr)  'raw' data is memory-mapped (attached or detached, e.g. a raw file with a
+                       detached .nhdr header); 'gzip' data is decompressed frame by frame (fast
+                       for sequential access only). The frames should be the slowest axis (e.g.
+                       'sizes: 256 256 32 100'); a list axis first (Slicer .seq.nrrd) is supported
+                       for raw data, but each frame is then gathered from the whole file.
+  raw files            openRaw()
+  other 4D images      read frame by frame with the SimpleITK/ITK streaming reader (NIfTI, MetaImage, ...)
+  directories          a DICOM folder (each series is a frame, or, for a single series, each temporal
+                       position), or otherwise the image files in the folder in alphabetical order
+  lists, glob patterns one 3D image file per frame
+"""
+
+import glob
+import gzip
+import json
+import mmap
+import os
+import re
+import numpy
+import SimpleITK as sitk
+
+from . import Engine
+
+
+def getScalarType(dtype):
+  """Return the scalar type string used by Engine.scalePhase() for a NumPy data type.
+  """
+  return {numpy.dtype(numpy.uint16): 'unsigned short', numpy.dtype(numpy.int16): 'short'}.get(numpy.dtype(dtype).newbyteorder('='), '')
+
+
+class FrameSeries(object):
+  """Base class of the lazily read series. Subclasses set 'shape' ((T, Z, Y, X)), 'dtype', 'geometry'
+  (of a frame) and implement getFrames(start, stop).
+  """
+
+  shape = (0, 0, 0, 0)
+  dtype = numpy.dtype(numpy.float64)
+  geometry = None
+  indexValues = None  # Index value (e.g. time) of each frame, if known (see FrameWriter)
+  indexUnit = ''      # Unit of the index values (e.g. 's')
+  metaData = None     # Key/value fields of the file header, if any (e.g. Engine.outputScaleKey)
+
+  @property
+  def frameShape(self):
+    return tuple(self.shape[1:])
+
+  @property
+  def scalarType(self):
+    return getScalarType(self.dtype)
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self))
+      if step != 1:
+        return numpy.stack([self.getFrames(i, i + 1)[0] for i in range(start, stop, step)])
+      return self.getFrames(start, max(start, stop))
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('Frame %d out of range (%d frames)' % (index, len(self)))
+    return self.getFrames(index, index + 1)[0]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def getFrames(self, start, stop):
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+
+class MemoryMappedSeries(FrameSeries):
+  """Series memory-mapped from a raw data file. 'dataShape' is the shape of the data in C order
+  (e.g. (T, Z, Y, X)) and 'timeAxis' the index of the frame axis in 'dataShape'.
+  The frames are read-only views of the file (no copy). The pages of the previously read frames
+  are released whenever new frames are read, so the mapped file does not accumulate in the
+  resident memory (the released pages are read from the file again if they are accessed).
+  """
+
+  def __init__(self, path, dataShape, dtype, offset=0, timeAxis=0, geometry=None):
+    self.path = path
+    self.dtype = numpy.dtype(dtype)
+    with open(path, 'rb') as f:
+      self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    count = int(numpy.prod(dataShape))
+    data = numpy.frombuffer(self.mmap, dtype=self.dtype, count=count, offset=offset).reshape(dataShape)
+    self.frames = numpy.moveaxis(data, timeAxis, 0)
+    self.shape = self.frames.shape
+    self.geometry = geometry if geometry is not None else Engine.VolumeGeometry.identity()
+
+  def getFrames(self, start, stop):
+    if hasattr(mmap, 'MADV_DONTNEED'):
+      self.mmap.madvise(mmap.MADV_DONTNEED)
+    return self.frames[start:stop]
+
+  def close(self):
+    # The mapping is closed when the last frame view is released
+    self.frames = None
+    self.mmap = None
+
+
+class GzipSeries(FrameSeries):
+  """Series read from gzip compressed data with contiguous frames. The frames are decompressed on
+  demand; going back to an earlier frame decompresses the data again from the beginning.
+  """
+
+  def __init__(self, path, shape, dtype, offset=0, geometry=None):
+    self.path = path
+    self.shape = tuple(shape)
+    self.dtype = numpy.dtype(dtype)
+    self.offset = offset
+    self.geometry = geometry if geometry is not None else Engine.VolumeGeometry.identity()
+    self.frameBytes = int(numpy.prod(self.shape[1:])) * self.dtype.itemsize
+    self.file = None
+
+  def getFrames(self, start, stop):
+    # GzipFile can only seek forward; rewinding it would go back to the start of the NRRD header
+    if self.file is not None and self.file.tell() > start * self.frameBytes:
+      self.close()
+    if self.file is None:
+      rawFile = open(self.path, 'rb')
+      rawFile.seek(self.offset)
+      self.file = gzip.GzipFile(fileobj=rawFile)
+    self.file.seek(start * self.frameBytes)
+    data = self.file.read((stop - start) * self.frameBytes)
+    return numpy.frombuffer(data, dtype=self.dtype).reshape((stop - start,) + self.shape[1:])
+
+  def close(self):
+    if self.file is not None:
+      rawFile = self.file.fileobj
+      self.file.close()
+      rawFile.close()
+      self.file = None
+
+
+class FileSeries(FrameSeries):
+  """Series of one image per frame. Each item of 'sources' is a file name or a list of DICOM file names.
+  """
+
+  def __init__(self, sources):
+    if not sources:
+      raise ValueError('FileSeries: no frames')
+    self.sources = list(sources)
+    image = self.readImage(0)
+    array = sitk.GetArrayViewFromImage(image)
+    self.shape = (len(self.sources),) + array.shape
+    self.dtype = array.dtype
+    self.geometry = Engine.VolumeGeometry.fromImage(image)
+
+  def readImage(self, index):
+    return sitk.ReadImage(self.sources[index])
+
+  def getFrames(self, start, stop):
+    frames = numpy.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+    for i in range(start, stop):
+      # The view does not keep the image alive
+      image = self.readImage(i)
+      frames[i - start] = sitk.GetArrayViewFromImage(image)
+    return frames
+
+
+class ExtractSeries(FrameSeries):
+  """Series read frame by frame from a 4D image file with the ITK streaming reader
+  (ImageFileReader.SetExtractIndex()/SetExtractSize()).
+  """
+
+  def __init__(self, path):
+    self.path = path
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    if reader.GetDimension() != 4:
+      raise ValueError("'%s' is not a 4D image" % path)
+    size = reader.GetSize()
+    self.frameSize = list(size[:3])
+    self.shape = (size[3],) + tuple(size[:3])[::-1]
+    direction = reader.GetDirection()
+    self.geometry = Engine.VolumeGeometry(tuple(reader.GetOrigin()[:3]), tuple(reader.GetSpacing()[:3]),
+                                          tuple(direction[row * 4 + column] for row in range(3) for column in range(3)))
+    self.dtype = numpy.dtype(sitk.GetArrayViewFromImage(self.readFrame(0)).dtype)
+
+  def readFrame(self, index):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(self.path)
+    reader.SetExtractIndex([0, 0, 0, index])
+    reader.SetExtractSize(self.frameSize + [0])
+    return reader.Execute()
+
+  def getFrames(self, start, stop):
+    frames = numpy.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+    for i in range(start, stop):
+      image = self.readFrame(i)
+      frames[i - start] = sitk.GetArrayViewFromImage(image)
+    return frames
+
+
+#
+# NRRD
+#
+
+_nrrdTypes = {
+  'int8': numpy.int8, 'signed char': numpy.int8, 'int8_t': numpy.int8,
+  'uchar': numpy.uint8, 'unsigned char': numpy.uint8, 'uint8': numpy.uint8, 'uint8_t': numpy.uint8,
+  'short': numpy.int16, 'short int': numpy.int16, 'signed short': numpy.int16, 'signed short int': numpy.int16,
+  'int16': numpy.int16, 'int16_t': numpy.int16,
+  'ushort': numpy.uint16, 'unsigned short': numpy.uint16, 'unsigned short int': numpy.uint16,
+  'uint16': numpy.uint16, 'uint16_t': numpy.uint16,
+  'int': numpy.int32, 'signed int': numpy.int32, 'int32': numpy.int32, 'int32_t': numpy.int32,
+  'uint': numpy.uint32, 'unsigned int': numpy.uint32, 'uint32': numpy.uint32, 'uint32_t': numpy.uint32,
+  'float': numpy.float32, 'double': numpy.float64,
+  }
+
+_nrrdDomainKinds = ('domain', 'space')
+
+
+def readNrrdHeader(path):
+  """Return the fields of a NRRD header (lower case names) and the offset of the data in the file
+  (None if the data file is detached).
+  """
+  fields = {}
+  with open(path, 'rb') as f:
+    magic = f.readline()
+    if not magic.startswith(b'NRRD'):
+      raise ValueError("'%s' is not a NRRD file" % path)
+    while True:
+      line = f.readline()
+      if not line or not line.strip():
+        break
+      line = line.decode('latin-1').rstrip('\r\n')
+      if line.startswith('#') or ':=' in line:
+        continue
+      name, _, value = line.partition(':')
+      fields[name.strip().lower()] = value.strip()
+    offset = f.tell() if 'data file' not in fields and 'datafile' not in fields else None
+  return fields, offset
+
+
+def readNrrdKeyValues(path):
+  """Return the key/value pairs ('key:=value' lines) of a NRRD header.
+  """
+  keyValues = {}
+  with open(path, 'rb') as f:
+    f.readline()
+    while True:
+      line = f.readline()
+      if not line or not line.strip():
+        break
+      line = line.decode('latin-1').rstrip('\r\n')
+      if ':=' in line and not line.startswith('#'):
+        key, _, value = line.partition(':=')
+        keyValues[key] = value
+  return keyValues
+
+
+def _parseVectors(text):
+  vectors = []
+  for token in re.findall(r'\([^)]*\)|none', text):
+    if token == 'none':
+      vectors.append(None)
+    else:
+      vectors.append([float(v) for v in token.strip('()').split(',')])
+  return vectors
+
+
+def getNrrdGeometry(fields, spatialAxes):
+  """Return the VolumeGeometry (LPS) of the spatial axes of a NRRD header. For a 4D space (ITK writes
+  4D images with 'space dimension: 4'), the first three coordinates are used.
+  """
+  directions = _parseVectors(fields.get('space directions', ''))
+  if len(directions) > max(spatialAxes):
+    vectors = [numpy.array(directions[axis][:3]) for axis in spatialAxes]
+  else:
+    spacings = fields.get('spacings', '').split()
+    vectors = []
+    for i, axis in enumerate(spatialAxes):
+      vector = numpy.zeros(3)
+      vector[i] = float(spacings[axis]) if len(spacings) > axis and spacings[axis] != 'nan' else 1.0
+      vectors.append(vector)
+  origin = numpy.array(_parseVectors(fields.get('space origin', '(0,0,0)'))[0][:3])
+
+  space = fields.get('space', 'left-posterior-superior').lower()
+  if space in ('right-anterior-superior', 'ras'):
+    flip = numpy.array([-1.0, -1.0, 1.0])
+    vectors = [vector * flip for vector in vectors]
+    origin = origin * flip
+
+  spacing = tuple(float(numpy.linalg.norm(vector)) for vector in vectors)
+  # The direction matrix has the axis directions as columns (row-major order)
+  direction = numpy.column_stack([vector / norm for vector, norm in zip(vectors, spacing)])
+  return Engine.VolumeGeometry(tuple(float(v) for v in origin), spacing, tuple(float(v) for v in direction.flatten()))
+
+
+def openNrrd(path):
+  """Open a 3D or 4D NRRD file as a series (a 3D file is a single frame). The index values of a frame
+  file written by FrameWriter are read from its index file.
+  """
+  series = _openNrrd(path)
+  series.metaData = readNrrdKeyValues(path)
+  indexPath = getFrameFilePaths(path)[2]
+  if os.path.exists(indexPath):
+    indexName, indexUnit, indexValues = readFrameIndex(indexPath)
+    series.indexName = indexName
+    series.indexUnit = indexUnit
+    series.indexValues = indexValues[:len(series)]
+  return series
+
+
+def _openNrrd(path):
+  fields, offset = readNrrdHeader(path)
+  sizes = [int(n) for n in fields['sizes'].split()]
+  dimension = len(sizes)
+  if dimension not in (3, 4):
+    raise ValueError("'%s': %dD NRRD files are not supported" % (path, dimension))
+
+  dtype = numpy.dtype(_nrrdTypes[fields['type'].lower()])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('>' if fields.get('endian', 'little') == 'big' else '<')
+
+  # Frame axis: the non-spatial axis ('none' direction or a non-domain kind); the last axis by default
+  timeAxis = None
+  if dimension == 4:
+    timeAxis = 3
+    directions = _parseVectors(fields.get('space directions', ''))
+    kinds = fields.get('kinds', '').split()
+    for axis in range(4):
+      if (len(directions) == 4 and directions[axis] is None) or (len(kinds) == 4 and kinds[axis].lower() not in _nrrdDomainKinds):
+        timeAxis = axis
+        break
+  spatialAxes = [axis for axis in range(dimension) if axis != timeAxis]
+  geometry = getNrrdGeometry(fields, spatialAxes)
+
+  dataFile = fields.get('data file', fields.get('datafile'))
+  if dataFile is not None:
+    if dataFile.startswith('LIST') or len(dataFile.split()) > 1:
+      raise ValueError("'%s': multiple data files are not supported" % path)
+    dataPath = os.path.join(os.path.dirname(os.path.abspath(path)), dataFile)
+    offset = 0
+  else:
+    dataPath = path
+  if int(fields.get('line skip', 0)) != 0:
+    raise ValueError("'%s': 'line skip' is not supported" % path)
+
+  # The NRRD sizes are ordered from the fastest axis; the C order shape is reversed
+  dataShape = tuple(sizes[::-1])
+  encoding = fields.get('encoding', 'raw').lower()
+  byteSkip = int(fields.get('byte skip', 0))
+  if encoding == 'raw':
+    if byteSkip == -1:
+      offset = os.path.getsize(dataPath) - int(numpy.prod(dataShape)) * dtype.itemsize
+    else:
+      offset += byteSkip
+    if timeAxis is None:
+      return MemoryMappedSeries(dataPath, (1,) + dataShape, dtype, offset, 0, geometry)
+    return MemoryMappedSeries(dataPath, dataShape, dtype, offset, dimension - 1 - timeAxis, geometry)
+
+  if encoding in ('gzip', 'gz'):
+    if byteSkip != 0:
+      raise ValueError("'%s': 'byte skip' is not supported for gzip data" % path)
+    if timeAxis is None:
+      return GzipSeries(dataPath, (1,) + dataShape, dtype, offset, geometry)
+    if timeAxis != dimension - 1:
+      raise ValueError("'%s': the frames are interleaved (axis %d); save the series with the frames as the "
+                       "last axis or with 'raw' encoding" % (path, timeAxis))
+    return GzipSeries(dataPath, dataShape, dtype, offset, geometry)
+
+  raise ValueError("'%s': NRRD encoding '%s' is not supported" % (path, encoding))
+
+
+def openRaw(path, frameShape, dtype, offset=0, frames=None, geometry=None):
+  """Memory-map a raw file of consecutive (Z, Y, X) frames of 'dtype' starting at byte 'offset'.
+  The number of frames is derived from the file size if not given.
+  """
+  dtype = numpy.dtype(dtype)
+  frameShape = tuple(frameShape)
+  if frames is None:
+    frames = (os.path.getsize(path) - offset) // (int(numpy.prod(frameShape)) * dtype.itemsize)
+  return MemoryMappedSeries(path, (frames,) + frameShape, dtype, offset, 0, geometry)
+
+
+#
+# Append-only frame files
+#
+
+_nrrdTypeNames = {
+  numpy.dtype(numpy.int8): 'int8', numpy.dtype(numpy.uint8): 'uint8', numpy.dtype(numpy.int16): 'short',
+  numpy.dtype(numpy.uint16): 'ushort', numpy.dtype(numpy.int32): 'int', numpy.dtype(numpy.uint32): 'uint',
+  numpy.dtype(numpy.float32): 'float', numpy.dtype(numpy.float64): 'double',
+  }
+
+
+def getFrameFilePaths(path):
+  """Return the paths of the header (.nhdr), the data (.raw) and the index (.index.jsonl) of a frame file.
+  """
+  base = path[:-len('.nhdr')] if path.lower().endswith('.nhdr') else path
+  return base + '.nhdr', base + '.raw', base + '.index.jsonl'
+
+
+def readFrameIndex(indexPath):
+  """Return the index name, the index unit and the index values of a frame file. An incomplete last
+  line (e.g. after a crash) is ignored.
+  """
+  indexName, indexUnit, indexValues = 'frame', '', []
+  with open(indexPath) as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        break
+      if 'indexName' in record:
+        indexName = record['indexName']
+        indexUnit = record.get('indexUnit', '')
+      else:
+        indexValues.append(record['value'])
+  return indexName, indexUnit, indexValues
+
+
+def _formatVector(vector):
+  return '(%s)' % ','.join(repr(float(v)) for v in vector)
+
+
+class FrameWriter(object):
+  """Append-only writer of a series of (Z, Y, X) frames to a frame file: the raw data (.raw), a detached
+  NRRD header (.nhdr, the frames are the last axis) and an index of the frame values (.index.jsonl,
+  JSON Lines). Each frame is written to the disk as soon as it is appended, so memory stays bounded
+  and the frames written before a crash are kept. The header always describes the complete frames
+  only, so the file can be opened (lazily, with openSeries()) while it is being written.
+
+  With 'resume', the frames of an existing frame file are kept (an incomplete last frame is discarded)
+  and new frames are appended after them; otherwise an existing frame file is overwritten. The
+  key/value fields of the existing header are kept as well ('metaData' takes precedence).
+  With 'sync', each frame is also flushed to the disk with fsync (slower, but survives a power loss).
+  'metaData' (a dict of strings, e.g. Engine.getOutputMetaData()) is written to the header as
+  key/value fields.
+
+    with Streaming.FrameWriter('out/TempMap.nhdr', frameShape, numpy.float32, geometry) as writer:
+      for start, result in engine.iterSeries(...):
+        writer.extend(result.temperature)
+  """
+
+  def __init__(self, path, frameShape, dtype=numpy.float32, geometry=None, indexName='frame', indexUnit='',
+               resume=False, sync=False, metaData=None):
+    self.headerPath, self.dataPath, self.indexPath = getFrameFilePaths(path)
+    self.frameShape = tuple(frameShape)
+    self.dtype = numpy.dtype(dtype).newbyteorder('<')
+    if self.dtype.newbyteorder('=') not in _nrrdTypeNames:
+      raise ValueError('FrameWriter: unsupported data type %s' % self.dtype)
+    self.geometry = geometry if geometry is not None else Engine.VolumeGeometry.identity()
+    self.indexName = indexName
+    self.indexUnit = indexUnit
+    self.sync = sync
+    self.metaData = dict(metaData or {})
+    self.frameBytes = int(numpy.prod(self.frameShape)) * self.dtype.itemsize
+    self.indexValues = []
+
+    directory = os.path.dirname(os.path.abspath(self.headerPath))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    if resume and os.path.exists(self.dataPath) and os.path.exists(self.indexPath):
+      self.indexName, self.indexUnit, indexValues = readFrameIndex(self.indexPath)
+      if os.path.exists(self.headerPath):
+        self.metaData = dict(readNrrdKeyValues(self.headerPath), **self.metaData)
+      frames = min(len(indexValues), os.path.getsize(self.dataPath) // self.frameBytes)
+      self.indexValues = indexValues[:frames]
+      self.dataFile = open(self.dataPath, 'r+b')
+      self.dataFile.truncate(frames * self.frameBytes)
+      self.dataFile.seek(0, os.SEEK_END)
+      # Rewrite the index without an incomplete last record (atomically replaced)
+      self.indexFile = open(self.indexPath + '.partial', 'w')
+      self._writeIndexRecord({'indexName': self.indexName, 'indexUnit': self.indexUnit})
+      for value in self.indexValues:
+        self._writeIndexRecord({'value': value})
+      self._sync(self.indexFile)
+      self.indexFile.close()
+      os.replace(self.indexPath + '.partial', self.indexPath)
+      self.indexFile = open(self.indexPath, 'a')
+    else:
+      if os.path.exists(self.headerPath):
+        os.remove(self.headerPath)
+      self.dataFile = open(self.dataPath, 'wb')
+      self.indexFile = open(self.indexPath, 'w')
+      self._writeIndexRecord({'indexName': self.indexName, 'indexUnit': self.indexUnit})
+      self._sync(self.indexFile)
+    if self.indexValues:
+      self.writeHeader()
+
+  def __len__(self):
+    return len(self.indexValues)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _writeIndexRecord(self, record):
+    self.indexFile.write(json.dumps(record) + '\n')
+
+  def _sync(self, f):
+    f.flush()
+    if self.sync:
+      os.fsync(f.fileno())
+
+  def append(self, frame, indexValue=None):
+    """Append a frame. 'indexValue' defaults to the frame number.
+    """
+    frame = numpy.asarray(frame)
+    if frame.shape != self.frameShape:
+      raise ValueError('FrameWriter: frame shape %s differs from %s' % (frame.shape, self.frameShape))
+    if indexValue is None:
+      indexValue = str(len(self.indexValues))
+    # Data first, then the index and the header: a frame is only listed once its data is complete
+    self.dataFile.write(numpy.ascontiguousarray(frame, dtype=self.dtype).tobytes())
+    self._sync(self.dataFile)
+    self._writeIndexRecord({'value': indexValue})
+    self._sync(self.indexFile)
+    self.indexValues.append(indexValue)
+    self.writeHeader()
+
+  def extend(self, frames, indexValues=None):
+    for i, frame in enumerate(frames):
+      self.append(frame, None if indexValues is None else indexValues[i])
+
+  def writeHeader(self):
+    """(Re)write the NRRD header for the frames appended so far (atomically replaced).
+    """
+    geometry = self.geometry
+    direction = numpy.asarray(geometry.direction, dtype=numpy.float64).reshape(3, 3)
+    directions = [_formatVector(direction[:, axis] * geometry.spacing[axis]) for axis in range(3)]
+    sizes = tuple(self.frameShape[::-1]) + (len(self.indexValues),)
+    lines = [
+      'NRRD0004',
+      '# Append-only frame file (see PRFThermometryLib/Streaming.py)',
+      'type: %s' % _nrrdTypeNames[self.dtype.newbyteorder('=')],
+      'dimension: 4',
+      'space: left-posterior-superior',
+      'sizes: %d %d %d %d' % sizes,
+      'space directions: %s none' % ' '.join(directions),
+      'kinds: domain domain domain list',
+      'endian: little',
+      'encoding: raw',
+      'space origin: %s' % _formatVector(geometry.origin),
+      'data file: %s' % os.path.basename(self.dataPath),
+      ]
+    lines += ['%s:=%s' % (key, value) for key, value in sorted(self.metaData.items())]
+    partialPath = self.headerPath + '.partial'
+    with open(partialPath, 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+      self._sync(f)
+    os.replace(partialPath, self.headerPath)
+
+  def close(self):
+    if self.dataFile is not None:
+      self.dataFile.close()
+      self.indexFile.close()
+      self.dataFile = None
+      self.indexFile = None
+
+
+#
+# DICOM
+#
+
+def getDicomTag(fileName, tag, default=None):
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(fileName)
+  reader.ReadImageInformation()
+  if reader.HasMetaDataKey(tag):
+    return reader.GetMetaData(tag).strip()
+  return default
+
+
+def getDicomFrameFileNames(path):
+  """Return the file names of the frames of a DICOM directory, one list per frame (an empty list if
+  there is no DICOM series). Each series is a frame (ordered by the series number); a single series
+  with several temporal positions (0020|0100) is split into one frame per position.
+  """
+  reader = sitk.ImageSeriesReader()
+  # GDCM warns if there is no series, which is expected for a directory of other image files
+  warningDisplay = sitk.ProcessObject.GetGlobalWarningDisplay()
+  sitk.ProcessObject.SetGlobalWarningDisplay(False)
+  try:
+    seriesIDs = reader.GetGDCMSeriesIDs(path)
+  finally:
+    sitk.ProcessObject.SetGlobalWarningDisplay(warningDisplay)
+  if not seriesIDs:
+    return []
+
+  if len(seriesIDs) > 1:
+    series = [reader.GetGDCMSeriesFileNames(path, seriesID) for seriesID in seriesIDs]
+    series.sort(key=lambda fileNames: int(getDicomTag(fileNames[0], '0020|0011', '0') or 0))
+    return [list(fileNames) for fileNames in series]
+
+  fileNames = reader.GetGDCMSeriesFileNames(path, seriesIDs[0])
+  positions = {}
+  for fileName in fileNames:
+    positions.setdefault(getDicomTag(fileName, '0020|0100'), []).append(fileName)
+  if len(positions) == 1:
+    return [list(fileNames)]
+  return [positions[key] for key in sorted(positions, key=lambda position: int(position or 0))]
+
+
+def openSeries(source):
+  """Open a series lazily (see the module documentation). 'source' is a file name, a directory,
+  a glob pattern, or a list of file names (one per frame).
+  """
+  if isinstance(source, (list, tuple)):
+    return FileSeries(source)
+  if glob.has_magic(source):
+    return FileSeries(sorted(glob.glob(source)))
+  if os.path.isdir(source):
+    frames = getDicomFrameFileNames(source)
+    if not frames:
+      frames = sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if not name.startswith('.') and os.path.isfile(os.path.join(source, name)))
+    return FileSeries(frames)
+  if source.lower().endswith(('.nrrd', '.nhdr')):
+    return openNrrd(source)
+
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(source)
+  reader.ReadImageInformation()
+  if reader.GetDimension() == 4:
+    return ExtractSeries(source)
+  return FileSeries([source])
@@ -0,0 +1,126 @@
+"""Phase unwrapping backends.
+
+A backend is a function 'unwrapper(arrayPhase, inside=None)' that takes a wrapped phase array
+(1D to 3D) and an optional boolean array of the voxels to be unwrapped, and returns the unwrapped
+phase as an array of the same shape. Backends are registered by name with registerUnwrapper()
+and selected with param['unwrapMethod'] (see Engine.unwrap()).
+
+Built-in backends:
+  'skimage'        Quality-guided unwrapping (scikit-image unwrap_phase) in 3D (default)
+  'skimage-2d'     scikit-image unwrap_phase applied slice by slice
+  'laplacian'      Least-squares unwrapping by solving the Poisson equation with the DCT
+                   (Ghiglia and Romero, JOSA A 1994); O(N log N), followed by a congruence step
+  'laplacian-2d'   'laplacian' applied slice by slice
+"""
+
+import collections
+import numpy
+import scipy.fft
+from skimage.restoration import unwrap_phase
+
+
+Unwrapper = collections.namedtuple('Unwrapper', ['name', 'function', 'description'])
+
+_unwrappers = collections.OrderedDict()
+
+
+def registerUnwrapper(name, function, description=''):
+  _unwrappers[name] = Unwrapper(name, function, description)
+
+
+def getUnwrapper(name):
+  try:
+    return _unwrappers[name].function
+  except KeyError:
+    raise ValueError("Unknown phase unwrapping method '%s' (available: %s)" % (name, ', '.join(_unwrappers)))
+
+
+def getUnwrapperNames():
+  return list(_unwrappers.keys())
+
+
+def getUnwrapperDescription(name):
+  return _unwrappers[name].description
+
+
+def wrap(arrayPhase):
+  """Wrap the phase to [-pi, pi).
+  """
+  return (arrayPhase + numpy.pi) % (2.0 * numpy.pi) - numpy.pi
+
+
+def sliceWise(unwrapper):
+  """Return a backend that applies 'unwrapper' to each slice (first axis) of a 3D array.
+  Each slice is shifted by 2*pi*N to match the previous slice, since the slices are unwrapped
+  independently.
+  """
+  def unwrapSlices(arrayPhase, inside=None):
+    if arrayPhase.ndim < 3:
+      return unwrapper(arrayPhase, inside)
+    unwrapped = numpy.empty(arrayPhase.shape, dtype=numpy.float64)
+    for i in range(arrayPhase.shape[0]):
+      unwrapped[i] = unwrapper(arrayPhase[i], None if inside is None else inside[i])
+      if i > 0:
+        difference = unwrapped[i] - unwrapped[i-1]
+        if inside is not None:
+          difference = difference[inside[i] & inside[i-1]]
+        if difference.size > 0:
+          unwrapped[i] -= 2.0 * numpy.pi * numpy.round(numpy.median(difference) / (2.0 * numpy.pi))
+    return unwrapped
+  return unwrapSlices
+
+
+def unwrapSkimage(arrayPhase, inside=None):
+  if inside is not None:
+    arrayPhase = numpy.ma.masked_array(arrayPhase, mask=~inside)
+  return numpy.ma.getdata(unwrap_phase(arrayPhase))
+
+
+def unwrapLaplacian(arrayPhase, inside=None):
+  """Unweighted least-squares phase unwrapping. The wrapped phase differences between neighboring
+  voxels are integrated by solving the discrete Poisson equation with Neumann boundary conditions
+  using the type-II DCT. Differences across the mask boundary are ignored. The solution is then
+  made congruent with the input (the input plus an integer multiple of 2*pi at every voxel).
+  """
+  arrayPhase = numpy.asarray(arrayPhase, dtype=numpy.float64)
+  ndim = arrayPhase.ndim
+
+  # Divergence of the wrapped gradient
+  rho = numpy.zeros(arrayPhase.shape)
+  for axis in range(ndim):
+    gradient = wrap(numpy.diff(arrayPhase, axis=axis))
+    if inside is not None:
+      lower = [slice(None)] * ndim
+      upper = [slice(None)] * ndim
+      lower[axis] = slice(None, -1)
+      upper[axis] = slice(1, None)
+      gradient *= (inside[tuple(lower)] & inside[tuple(upper)])
+    padding = [(0, 0)] * ndim
+    padding[axis] = (1, 1)
+    rho += numpy.diff(numpy.pad(gradient, padding), axis=axis)
+
+  # Solve the Poisson equation in the DCT domain
+  rhoHat = scipy.fft.dctn(rho, type=2, norm='ortho')
+  eigenvalues = numpy.zeros(arrayPhase.shape)
+  for axis in range(ndim):
+    n = arrayPhase.shape[axis]
+    shape = [1] * ndim
+    shape[axis] = n
+    eigenvalues = eigenvalues + (2.0 * numpy.cos(numpy.pi * numpy.arange(n) / n) - 2.0).reshape(shape)
+  eigenvalues.flat[0] = 1.0
+  rhoHat /= eigenvalues
+  rhoHat.flat[0] = 0.0
+  solution = scipy.fft.idctn(rhoHat, type=2, norm='ortho')
+
+  # Remove the arbitrary constant and enforce congruence with the wrapped input
+  residual = arrayPhase - solution
+  if inside is not None and numpy.any(inside):
+    residual = residual[inside]
+  solution += numpy.angle(numpy.mean(numpy.exp(1.0j * residual)))
+  return arrayPhase + 2.0 * numpy.pi * numpy.round((solution - arrayPhase) / (2.0 * numpy.pi))
+
+
+registerUnwrapper('skimage', unwrapSkimage, 'Quality-guided 3D unwrapping (scikit-image)')
+registerUnwrapper('skimage-2d', sliceWise(unwrapSkimage), 'Quality-guided unwrapping, slice by slice (scikit-image)')
+registerUnwrapper('laplacian', unwrapLaplacian, 'Least-squares 3D unwrapping with the DCT (fast, O(N log N))')
+registerUnwrapper('laplacian-2d', sliceWise(unwrapLaplacian), 'Least-squares unwrapping with the DCT, slice by slice')
@@ -0,0 +1,298 @@
+"""Volume I/O between a scene and the NumPy arrays of the engine.
+
+The logic reads and writes volumes through an adapter: SlicerVolumeIO for the Slicer scene, or
+MemoryVolumeIO for MemoryScene, a pure in-memory stand-in that needs neither Slicer nor VTK (for
+tests and benchmarks). Volumes are passed as nodes; they are never looked up by name.
+
+pull() returns a read-only NumPy view of the voxels (z, y, x) of a node. A copy is only made if it
+is requested (e.g. when the frame is computed on a worker thread while the scene may update the
+node), if the voxel type has to be converted, or if the voxels are not C-contiguous. push() writes into the existing voxel buffer of
+the node if the shape and the type match. The adapters count the views and copies they make:
+
+  scene = VolumeIO.MemoryScene()
+  io = VolumeIO.MemoryVolumeIO()
+  referenceNode = scene.addVolume('reference', referenceArray, geometry)
+  tempMapNode = scene.addVolume('TempMap')
+  reference = io.pull(referenceNode)
+  ...
+  io.push(tempMapNode, temperature, io.getGeometry(referenceNode))
+  print(io.getCounts())
+"""
+
+import itertools
+import numpy
+
+from . import Engine
+
+
+# VTK names of the voxel types (vtkImageData.GetScalarTypeAsString())
+scalarTypeNames = {
+  'int8': 'signed char', 'uint8': 'unsigned char', 'int16': 'short', 'uint16': 'unsigned short',
+  'int32': 'int', 'uint32': 'unsigned int', 'int64': 'long long', 'uint64': 'unsigned long long',
+  'float32': 'float', 'float64': 'double',
+  }
+
+
+class VolumeIO(object):
+  """Base class of the volume I/O adapters. Subclasses implement getArray(), setArray(),
+  modified(), getGeometry() and setGeometry().
+  """
+
+  def __init__(self):
+    self.resetCounts()
+
+  def resetCounts(self):
+    self.views = 0
+    self.copies = 0
+    self.bytesCopied = 0
+
+  def getCounts(self):
+    return {'views': self.views, 'copies': self.copies, 'bytesCopied': self.bytesCopied}
+
+  def countCopy(self, array):
+    self.copies += 1
+    self.bytesCopied += array.nbytes
+
+  def getArray(self, node):
+    """Return the voxel array (z, y, x) of the node (a view of its buffer), or None if it has no data.
+    """
+    raise NotImplementedError
+
+  def setArray(self, node, array):
+    """Replace the voxel buffer of the node by 'array'.
+    """
+    raise NotImplementedError
+
+  def modified(self, node):
+    """Notify that the voxels of the node were modified in place.
+    """
+    raise NotImplementedError
+
+  def getGeometry(self, node):
+    """Return the Engine.VolumeGeometry (SimpleITK/LPS convention) of the node.
+    """
+    raise NotImplementedError
+
+  def setGeometry(self, node, geometry):
+    raise NotImplementedError
+
+  def getNodeKey(self, value):
+    """Return a key that changes whenever the node or its voxels are modified, or None if 'value'
+    is not a node (e.g. a parameter value).
+    """
+    raise NotImplementedError
+
+  def getScalarType(self, node):
+    """Return the VTK name of the voxel type of the node ('' if it has no data).
+    """
+    array = self.getArray(node)
+    if array is None:
+      return ''
+    return scalarTypeNames.get(array.dtype.name, array.dtype.name)
+
+  def pull(self, node, dtype=None, copy=False):
+    """Return the voxels of the node as a read-only view, or as a (C-contiguous) copy if 'copy' is
+    True, if 'dtype' differs from the voxel type or if the voxels are not C-contiguous. Returns None
+    if the node has no data.
+    """
+    array = self.getArray(node)
+    if array is None:
+      return None
+    if copy or not array.flags.c_contiguous or (dtype is not None and array.dtype != numpy.dtype(dtype)):
+      array = numpy.array(array, dtype=dtype, order='C')
+      self.countCopy(array)
+      return array
+    self.views += 1
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+  def push(self, node, array, geometry=None):
+    """Store 'array' (z, y, x) in the node, and set its geometry if given. The array is copied into
+    the existing buffer if the shape and the type match; otherwise the buffer is replaced.
+    """
+    array = numpy.asarray(array)
+    target = self.getArray(node)
+    if geometry is not None:
+      self.setGeometry(node, geometry)
+    if target is not None and target.shape == array.shape and target.dtype == array.dtype:
+      if not numpy.may_share_memory(target, array):
+        target[...] = array
+        self.countCopy(array)
+      self.modified(node)
+    else:
+      self.setArray(node, array)
+
+
+class SlicerVolumeIO(VolumeIO):
+  """Volume I/O on the Slicer scene, using NumPy views of the image data of the volume nodes
+  (slicer.util.arrayFromVolume()).
+  """
+
+  def __init__(self):
+    VolumeIO.__init__(self)
+    import slicer.util
+    import vtk
+    self.util = slicer.util
+    self.vtk = vtk
+    self.nodeClass = slicer.vtkMRMLNode
+
+  def getArray(self, node):
+    imageData = node.GetImageData()
+    if imageData == None or imageData.GetPointData().GetScalars() == None:
+      return None
+    return self.util.arrayFromVolume(node)
+
+  def setArray(self, node, array):
+    # The image data is rebuilt from a copy of the array
+    self.util.updateVolumeFromArray(node, array)
+    self.countCopy(array)
+
+  def modified(self, node):
+    self.util.arrayFromVolumeModified(node)
+
+  def getNodeKey(self, value):
+    if not isinstance(value, self.nodeClass):
+      return None
+    imageData = value.GetImageData() if value.IsA('vtkMRMLVolumeNode') else None
+    return (value.GetID(), value.GetMTime(), imageData.GetMTime() if imageData != None else 0)
+
+  def getScalarType(self, node):
+    imageData = node.GetImageData()
+    if imageData == None:
+      return ''
+    return imageData.GetScalarTypeAsString()
+
+  def getGeometry(self, node):
+    ijkToRAS = self.vtk.vtkMatrix4x4()
+    node.GetIJKToRASDirectionMatrix(ijkToRAS)
+    direction = []
+    for row in range(3):
+      sign = -1.0 if row < 2 else 1.0  # RAS -> LPS
+      for column in range(3):
+        direction.append(sign * ijkToRAS.GetElement(row, column))
+    origin = node.GetOrigin()
+    return Engine.VolumeGeometry((-origin[0], -origin[1], origin[2]), tuple(node.GetSpacing()), tuple(direction))
+
+  def setGeometry(self, node, geometry):
+    ijkToRAS = self.vtk.vtkMatrix4x4()
+    for row in range(3):
+      sign = -1.0 if row < 2 else 1.0  # LPS -> RAS
+      for column in range(3):
+        ijkToRAS.SetElement(row, column, sign * geometry.direction[row * 3 + column])
+    node.SetIJKToRASDirectionMatrix(ijkToRAS)
+    node.SetSpacing(geometry.spacing)
+    node.SetOrigin(-geometry.origin[0], -geometry.origin[1], geometry.origin[2])
+
+
+#
+# In-memory scene
+#
+
+_modifiedTimes = itertools.count(1)
+
+
+class MemoryVolumeNode(object):
+  """Volume node of a MemoryScene: a voxel array (z, y, x), an Engine.VolumeGeometry and attributes.
+  Implements the few vtkMRMLNode methods used by the logic (GetID(), GetName(), GetMTime(),
+  Modified(), IsA(), GetImageData() and the attributes).
+  """
+
+  def __init__(self, nodeID, name, array=None, geometry=None):
+    self.nodeID = nodeID
+    self.name = name
+    self.array = array
+    self.geometry = geometry if geometry is not None else Engine.VolumeGeometry.identity()
+    self.attributes = {}
+    self.Modified()
+
+  def GetID(self):
+    return self.nodeID
+
+  def GetName(self):
+    return self.name
+
+  def SetName(self, name):
+    self.name = name
+    self.Modified()
+
+  def GetMTime(self):
+    return self.mtime
+
+  def Modified(self):
+    self.mtime = next(_modifiedTimes)
+
+  def IsA(self, className):
+    return className in ('vtkMRMLNode', 'vtkMRMLVolumeNode', 'vtkMRMLScalarVolumeNode')
+
+  def GetImageData(self):
+    # The voxels are held in 'array'; Modified() is called whenever they change
+    return None
+
+  def GetAttribute(self, name):
+    return self.attributes.get(name)
+
+  def SetAttribute(self, name, value):
+    self.attributes[name] = value
+    self.Modified()
+
+  def RemoveAttribute(self, name):
+    self.attributes.pop(name, None)
+    self.Modified()
+
+
+class MemoryScene(object):
+  """Pure in-memory stand-in for the MRML scene, holding MemoryVolumeNodes.
+  """
+
+  def __init__(self):
+    self.nodes = []
+    self._nodeIds = itertools.count(1)
+
+  def addVolume(self, name, array=None, geometry=None):
+    node = MemoryVolumeNode('MemoryVolumeNode%d' % next(self._nodeIds), name, array, geometry)
+    self.nodes.append(node)
+    return node
+
+  def removeNode(self, node):
+    self.nodes.remove(node)
+
+  def getNodeByID(self, nodeID):
+    for node in self.nodes:
+      if node.GetID() == nodeID:
+        return node
+    return None
+
+  def getNodesByName(self, name):
+    return [node for node in self.nodes if node.GetName() == name]
+
+
+class MemoryVolumeIO(VolumeIO):
+  """Volume I/O on MemoryVolumeNodes. setArray() keeps a reference to the array (no copy), unless
+  it is not C-contiguous.
+  """
+
+  def getArray(self, node):
+    return node.array
+
+  def setArray(self, node, array):
+    if not array.flags.c_contiguous:
+      array = numpy.ascontiguousarray(array)
+      self.countCopy(array)
+    node.array = array
+    node.Modified()
+
+  def modified(self, node):
+    node.Modified()
+
+  def getNodeKey(self, value):
+    if not isinstance(value, MemoryVolumeNode):
+      return None
+    return (value.GetID(), value.GetMTime())
+
+  def getGeometry(self, node):
+    return node.geometry
+
+  def setGeometry(self, node, geometry):
+    node.geometry = geometry
+    node.Modified()
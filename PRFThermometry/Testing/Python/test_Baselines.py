@@ -0,0 +1,107 @@
+"""Tests of PRFThermometryLib.Baselines that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Baselines, Engine, Phantom
+
+
+class BaselineLibraryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.shape = (8, 32, 32)
+    self.mask = Engine.generateDiskMask(self.shape, radius=0.45, dtype=bool)
+    self.rng = numpy.random.default_rng(0)
+    z, y, x = numpy.meshgrid(*[numpy.linspace(0.0, 1.0, n) for n in self.shape], indexing='ij')
+    self.grid = (z, y, x)
+
+  def getFrame(self, cycle, drift=0.0, noise=0.02):
+    """Return a raw phase frame at the position 'cycle' (0 to 1) of the breathing cycle.
+    """
+    z, y, x = self.grid
+    angle = 2.0 * numpy.pi * cycle
+    phase = 1.5 * numpy.sin(2.0 * numpy.pi * x + angle) + 0.8 * numpy.cos(2.0 * numpy.pi * y + 2.0 * angle) + 0.3 * z
+    return Phantom.encodePhase(phase + drift + noise * self.rng.standard_normal(self.shape))
+
+  def getLibrary(self, count, **kwargs):
+    library = Baselines.BaselineLibrary(self.mask, scalarType='short', **kwargs)
+    for cycle in numpy.arange(count) / float(count):
+      library.add(self.getFrame(cycle))
+    return library
+
+  def getBruteForceNearest(self, library, frame):
+    distances = numpy.linalg.norm(numpy.array(library.signatures) - library.getSignature(frame), axis=1)
+    return int(numpy.argmin(distances)), float(distances.min())
+
+  def test_Nearest(self):
+    library = self.getLibrary(60)
+    for i in range(20):
+      frame = self.getFrame(self.rng.uniform(), drift=self.rng.uniform(-numpy.pi, numpy.pi))
+      match = library.findNearest(frame)
+      index, distance = self.getBruteForceNearest(library, frame)
+      self.assertEqual(match.index, index)
+      self.assertAlmostEqual(match.distance, distance, places=5)
+      self.assertEqual(library.lastMatch, match)
+    self.assertIsNotNone(library._tree)
+
+    # A frame of the library (with a uniform drift) is its own nearest baseline
+    self.assertEqual(library.findNearest(self.getFrame(17 / 60.0, drift=1.0)).index, 17)
+
+  def test_SmallLibrary(self):
+    # With no more baselines than candidates, all the signatures are compared
+    library = self.getLibrary(3, candidates=4)
+    frame = self.getFrame(0.3)
+    self.assertEqual(library.findNearest(frame).index, 1)
+    self.assertIsNone(library._tree)
+    self.assertEqual(library.findNearest(frame).index, self.getBruteForceNearest(library, frame)[0])
+
+  def test_Add(self):
+    # Baselines added after a lookup are indexed on the next lookup
+    library = self.getLibrary(20)
+    frame = self.getFrame(0.525)
+    self.assertIn(library.findNearest(frame).index, (10, 11))
+    index = library.add(self.getFrame(0.525))
+    self.assertEqual(index, 20)
+    self.assertEqual(library.findNearest(frame).index, 20)
+    self.assertEqual(library._tree.n, 21)
+
+    with self.assertRaises(ValueError):
+      library.add(numpy.zeros((8, 16, 16), dtype=numpy.int16))
+    library.clear()
+    self.assertEqual(len(library), 0)
+
+  def test_Empty(self):
+    library = Baselines.BaselineLibrary(self.mask)
+    with self.assertRaises(ValueError):
+      library.findNearest(self.getFrame(0.0))
+
+  def test_Select(self):
+    # The nearest baseline gives the result of that baseline alone, and is preprocessed once
+    generator = Phantom.PhantomGenerator(self.shape, frames=4, susceptibility=False)
+    param = dict(generator.getParam(), suscCorrMethod='off')
+    library = Baselines.BaselineLibrary(generator.getMask(), scalarType='short', maxPrepared=1)
+    library.add(generator.getReference(3))
+    library.add(generator.getBaseline())
+    engine = Engine.ThermometryEngine()
+    result = engine.run(None, generator.getReference(0), param, baselineLibrary=library)
+    self.assertEqual(library.lastMatch.index, 1)
+    expected = engine.run(generator.getBaseline(), generator.getReference(0), param, mask=generator.getMask())
+    numpy.testing.assert_allclose(result.temperature, expected.temperature, rtol=0.0, atol=1e-9)
+
+    cache = library.select(engine, generator.getReference(0), param)
+    self.assertIs(library.select(engine, generator.getReference(0), param), cache)
+    library.prepare(engine, 0, param)
+    self.assertEqual(len(library.prepared), 1)
+    self.assertIsNot(library.select(engine, generator.getReference(0), param), cache)
+
+
+if __name__ == '__main__':
+  unittest.main()
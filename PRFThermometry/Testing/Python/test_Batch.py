@@ -0,0 +1,94 @@
+"""Tests of PRFThermometryLib.Batch that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Batch, Engine, Phantom
+
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.generator = Phantom.PhantomGenerator((8,32,32), frames=3, peakHeating=20.0)
+    param = dict(self.generator.getParam(), suscCorrMethod='off')
+    sessions = []
+    for name in ('case001', 'case002'):
+      os.makedirs(os.path.join(self.directory, name))
+      sitk.WriteImage(sitk.GetImageFromArray(self.generator.getBaseline()),
+                      os.path.join(self.directory, name, 'baseline.nrrd'))
+      sitk.WriteImage(sitk.JoinSeries([sitk.GetImageFromArray(frame) for frame in self.generator.iterReferences()]),
+                      os.path.join(self.directory, name, 'reference.nrrd'))
+      sitk.WriteImage(sitk.GetImageFromArray(self.generator.getMask().astype(numpy.uint8)),
+                      os.path.join(self.directory, name, 'mask.nrrd'))
+      sessions.append({'name': name, 'baseline': name + '/baseline.nrrd', 'reference': name + '/reference.nrrd',
+                       'mask': name + '/mask.nrrd', 'output': 'out/%s_TempMap.nrrd' % name})
+    self.jobsPath = os.path.join(self.directory, 'jobs.json')
+    with open(self.jobsPath, 'w') as f:
+      json.dump({'param': param, 'sessions': sessions}, f)
+    self.manifestPath = os.path.join(self.directory, 'jobs.manifest.jsonl')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_Session(self):
+    session, param = Batch.loadJobs(self.jobsPath)[0]
+    self.assertEqual(session['output'], os.path.join(self.directory, 'out/case001_TempMap.nrrd'))
+    self.assertEqual(Batch.processSession(session, param), 3)
+
+    temperature = sitk.GetArrayFromImage(sitk.ReadImage(session['output']))
+    self.assertEqual(temperature.shape, (3, 8, 32, 32))
+    expected = Engine.ThermometryEngine().run(self.generator.getBaseline(), self.generator.getReference(2), param,
+                                              mask=self.generator.getMask()).temperature
+    numpy.testing.assert_allclose(temperature[2], expected, rtol=0.0, atol=1e-4)
+
+  def test_Rerun(self):
+    sessions = Batch.loadJobs(self.jobsPath)
+    entries = Batch.runBatch(sessions, self.manifestPath, workers=1)
+    self.assertEqual([entry['status'] for entry in entries], ['done', 'done'])
+    self.assertEqual([entry['frames'] for entry in entries], [3, 3])
+
+    # The sessions done with the same inputs and parameters are skipped
+    self.assertEqual(Batch.runBatch(sessions, self.manifestPath, workers=1), [])
+
+    # ... unless the parameters or the output changed, or the batch is forced
+    sessions = Batch.loadJobs(self.jobsPath, {'upperThreshold': 50.0})
+    os.remove(sessions[1][0]['output'])
+    entries = Batch.runBatch(sessions[:1], self.manifestPath, workers=1)
+    self.assertEqual([entry['session'] for entry in entries], ['case001'])
+    entries = Batch.runBatch(Batch.loadJobs(self.jobsPath), self.manifestPath, workers=1)
+    self.assertEqual(sorted(entry['session'] for entry in entries), ['case001', 'case002'])
+    entries = Batch.runBatch(Batch.loadJobs(self.jobsPath), self.manifestPath, workers=2, force=True)
+    self.assertEqual(len(entries), 2)
+
+    manifest = Batch.loadManifest(self.manifestPath)
+    self.assertEqual(sorted(manifest), ['case001', 'case002'])
+    with open(self.manifestPath) as f:
+      self.assertEqual(len(f.readlines()), 7)
+
+  def test_FailedSession(self):
+    # A failed session is recorded in the manifest and processed again in the next run
+    sessions = Batch.loadJobs(self.jobsPath)
+    os.remove(sessions[0][0]['reference'])
+    entries = Batch.runBatch(sessions, self.manifestPath, workers=1)
+    self.assertEqual(sorted((entry['session'], entry['status']) for entry in entries),
+                     [('case001', 'failed'), ('case002', 'done')])
+    self.assertFalse(os.path.exists(sessions[0][0]['output']))
+    entries = Batch.runBatch(sessions, self.manifestPath, workers=1)
+    self.assertEqual([entry['session'] for entry in entries], ['case001'])
+
+
+if __name__ == '__main__':
+  unittest.main()
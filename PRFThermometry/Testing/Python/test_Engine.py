@@ -0,0 +1,454 @@
+"""Tests of PRFThermometryLib.Engine that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Benchmark, Engine, Phantom, VolumeIO
+
+
+def getSusceptibilityParam(**kwargs):
+  param = {'gamma': 42.576, 'TE': 0.01, 'deltaChi': 3.2, 'B0': 3.0, 'B0vec': [0.0, 0.0, 1.0]}
+  param.update(kwargs)
+  return param
+
+
+class SeriesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.generator = Phantom.PhantomGenerator((8,32,32), frames=3)
+    self.param = self.generator.getParam()
+
+  def test_SeriesEqualsSingleFrame(self):
+    generator = self.generator
+    result = Engine.ThermometryEngine().runSeries(generator.getBaseline(), generator.getReferenceSeries(), self.param,
+                                                  mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    self.assertEqual(result.temperature.shape, (generator.frames,) + generator.getBaseline().shape)
+    for i in range(generator.frames):
+      single = Engine.ThermometryEngine().run(generator.getBaseline(), generator.getReference(i), self.param,
+                                              mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+      numpy.testing.assert_allclose(result.temperature[i], single.temperature, rtol=0.0, atol=1e-9)
+
+    evaluationMask = generator.getEvaluationMask()
+    error = numpy.abs(result.temperature[-1] - generator.getTemperature(generator.frames - 1))[evaluationMask]
+    self.assertLess(error.max(), 3.0)
+
+
+  def test_SinglePrecision(self):
+    generator = self.generator
+    double = Engine.ThermometryEngine().runSeries(generator.getBaseline(), generator.getReferenceSeries(), self.param,
+                                                  mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    single = Engine.ThermometryEngine().runSeries(generator.getBaseline(), generator.getReferenceSeries(),
+                                                  dict(self.param, precision='single'),
+                                                  mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    self.assertEqual(single.temperature.dtype, numpy.float32)
+    self.assertEqual(single.phaseDiff.dtype, numpy.float32)
+    numpy.testing.assert_allclose(single.temperature, double.temperature, rtol=0.0, atol=1e-3)
+
+
+  def test_TemporalUnwrapping(self):
+    # The phase shift wraps (up to 8 rad); the frames are unwrapped against the previous ones,
+    # also across the chunks of iterSeries()
+    generator = Phantom.PhantomGenerator((8,32,32), frames=4, peakHeating=80.0)
+    param = dict(generator.getParam(), temporalUnwrapping=True)
+    engine = Engine.ThermometryEngine()
+    result = engine.runSeries(generator.getBaseline(), generator.getReferenceSeries(), param,
+                              mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    evaluationMask = generator.getEvaluationMask()
+    for i in range(generator.frames):
+      error = numpy.abs(result.temperature[i] - generator.getTemperature(i))[evaluationMask]
+      self.assertLess(error.max(), 3.0)
+
+    chunks = engine.iterSeries(generator.getBaseline(), generator.getReferenceSeries(), param, mask=generator.getMask(),
+                               objectLabel=generator.getObjectLabel(), chunkSize=1)
+    temperature = numpy.concatenate([chunk.temperature for start, chunk in chunks])
+    numpy.testing.assert_allclose(temperature, result.temperature, rtol=0.0, atol=1e-9)
+
+
+class BaselineCacheTest(unittest.TestCase):
+
+  def test_BaselineCache(self):
+    generator = Phantom.PhantomGenerator((8,32,32), frames=2)
+    param = dict(generator.getParam(), suscCorrMethod='off')
+    engine = Engine.ThermometryEngine()
+    first = engine.run(generator.getBaseline(), generator.getReference(1), param, mask=generator.getMask(),
+                       baselineKey=('baseline', 1))
+    self.assertEqual((engine.baselineCache.hits, engine.baselineCache.misses), (0, 1))
+
+    # Same key: the cached baseline is used (the arrays passed are ignored)
+    cached = engine.run(None, generator.getReference(1), param, baselineKey=('baseline', 1))
+    self.assertEqual((engine.baselineCache.hits, engine.baselineCache.misses), (1, 1))
+    numpy.testing.assert_array_equal(cached.temperature, first.temperature)
+
+    # A new key or a parameter of the preprocessing invalidates the entry
+    engine.run(generator.getReference(0), generator.getReference(1), param, mask=generator.getMask(),
+               baselineKey=('baseline', 2))
+    engine.run(generator.getReference(0), generator.getReference(1), dict(param, precision='single'),
+               mask=generator.getMask(), baselineKey=('baseline', 2))
+    self.assertEqual((engine.baselineCache.hits, engine.baselineCache.misses), (1, 3))
+
+
+class MaskCacheTest(unittest.TestCase):
+
+  def test_DiskMask(self):
+    engine = Engine.ThermometryEngine()
+    param = {'simpleMask': 'disk', 'simpleMask.radius': 0.25}
+    mask = engine.getMask((8, 32, 32), param)
+    self.assertEqual(mask.dtype, bool)
+    self.assertFalse(mask.flags.writeable)
+    numpy.testing.assert_array_equal(mask, Engine.generateDiskMask((8, 32, 32), radius=0.25) > 0)
+    self.assertIs(engine.getMask((8, 32, 32), param), mask)
+    self.assertEqual((engine.maskCache.hits, engine.maskCache.misses), (1, 1))
+
+    # Round in physical units: with a 4x coarser slice spacing, the disk covers fewer slices
+    geometry = Engine.VolumeGeometry((0.0, 0.0, 0.0), (1.0, 1.0, 4.0), (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+    physical = engine.getMask((8, 32, 32), param, geometry=geometry)
+    self.assertEqual(engine.maskCache.misses, 2)
+    self.assertLess(numpy.count_nonzero(physical.any(axis=(1, 2))), numpy.count_nonzero(mask.any(axis=(1, 2))))
+
+  def test_EllipsoidMask(self):
+    geometry = Engine.VolumeGeometry((-10.0, -20.0, 0.0), (0.5, 0.5, 2.0), (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+    param = {'simpleMask': 'ellipsoid', 'simpleMask.center': [0.0, -10.0, 8.0], 'simpleMask.radii': [5.0, 5.0, 4.0]}
+    mask = Engine.ThermometryEngine().getMask((8, 40, 40), param, geometry=geometry)
+    # Center at index (x, y, z) = (20, 20, 4); 5 mm = 10 voxels in x and y, 4 mm = 2 slices in z
+    self.assertTrue(mask[4, 20, 20])
+    self.assertTrue(mask[4, 20, 30] and not mask[4, 20, 31])
+    self.assertTrue(mask[6, 20, 20] and not mask[7, 20, 20])
+
+  def test_Eviction(self):
+    cache = Engine.MaskCache(maxSize=2)
+    first = cache.get('disk', (4, 16, 16), radius=0.2)
+    cache.get('disk', (4, 16, 16), radius=0.3)
+    cache.get('disk', (4, 16, 16), radius=0.4)
+    self.assertEqual(len(cache.masks), 2)
+    self.assertIsNot(cache.get('disk', (4, 16, 16), radius=0.2), first)
+    with self.assertRaises(ValueError):
+      cache.get('box', (4, 16, 16))
+
+
+class ReferencelessTest(unittest.TestCase):
+
+  def setUp(self):
+    # Phantom heating on a known quadratic background (that does not wrap)
+    self.generator = Phantom.PhantomGenerator((8,32,32), frames=2, peakHeating=20.0, susceptibility=False)
+    z, y, x = numpy.mgrid[0:8, 0:32, 0:32] / 32.0
+    self.background = 0.5 + 0.8 * x - 0.6 * y * y + 0.3 * x * z
+    self.param = dict(self.generator.getParam(), referenceless=True, usePhaseUnwrapping=False,
+                      usePhaseUnwrappingPost=False, **{'referenceless.center': [0.5, 0.5, 0.55],
+                                                       'referenceless.innerRadius': 0.25,
+                                                       'referenceless.outerRadius': 0.45})
+
+  def getReference(self, frame):
+    generator = self.generator
+    phase = self.background + generator.getHeating(frame) * generator.getPhasePerDegree() * generator.spot
+    return Phantom.encodePhase(phase + generator.getNoise(frame))
+
+  def test_Background(self):
+    generator = self.generator
+    engine = Engine.ThermometryEngine()
+    noiseless = engine.run(None, Phantom.encodePhase(self.background), self.param)
+    self.assertLess(numpy.abs(noiseless.phaseDiff).max(), 1e-3)
+
+    result = engine.run(None, self.getReference(1), self.param, mask=generator.getMask())
+    error = numpy.abs(result.temperature - generator.getTemperature(1))[generator.getMask() > 0]
+    self.assertLess(error.max(), 1.5)
+    self.assertAlmostEqual(result.temperature.max(), generator.getTemperature(1).max(), delta=1.0)
+
+  def test_FitCache(self):
+    generator = self.generator
+    geometry = Engine.VolumeGeometry((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+    engine = Engine.ThermometryEngine()
+    first = engine.run(None, self.getReference(0), self.param, mask=generator.getMask(), geometry=geometry)
+    self.assertEqual((engine.polynomialFitCache.misses, engine.polynomialFitCache.hits), (1, 0))
+
+    # The same mask and geometry reuse the fit
+    second = engine.run(None, self.getReference(1), self.param, mask=generator.getMask().copy(), geometry=geometry)
+    self.assertEqual((engine.polynomialFitCache.misses, engine.polynomialFitCache.hits), (1, 1))
+    self.assertGreater(second.temperature.max(), first.temperature.max())
+
+    # Another mask, spacing or order is fitted again
+    mask = generator.getMask().copy()
+    mask[:, :16] = 0
+    engine.run(None, self.getReference(1), self.param, mask=mask, geometry=geometry)
+    self.assertEqual((engine.polynomialFitCache.misses, engine.polynomialFitCache.hits), (2, 1))
+    anisotropic = Engine.VolumeGeometry((0.0, 0.0, 0.0), (1.0, 1.0, 4.0), geometry.direction)
+    engine.run(None, self.getReference(1), self.param, mask=generator.getMask(), geometry=anisotropic)
+    engine.run(None, self.getReference(1), dict(self.param, **{'referenceless.order': 1}), mask=generator.getMask(),
+               geometry=geometry)
+    self.assertEqual((engine.polynomialFitCache.misses, engine.polynomialFitCache.hits), (4, 1))
+
+
+class SusceptibilityTest(unittest.TestCase):
+
+  shape = (14, 202, 202)  # padded to (16, 216, 216) by 'fast'
+  direction = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+  def test_FFTShape(self):
+    self.assertNotEqual(Engine.getFFTShape(self.shape), self.shape)
+
+  def test_DefaultPadding(self):
+    labelArray = Benchmark.getNeedleLabel(self.shape)
+    param = getSusceptibilityParam()
+    B0_dir = Engine.findB0Axis(self.direction, param['B0vec'])
+    # The complex-FFT convolution on the volume grid (the implementation before the real FFTs)
+    reference = Benchmark.legacySusceptibilityField(labelArray, B0_dir)
+    reference *= param['gamma'] * 2.0 * numpy.pi * param['B0'] * param['TE'] * param['deltaChi'] * (1.0 - labelArray)
+
+    p_susc = Engine.generateSusceptibilityMap(labelArray, self.direction, param)
+    numpy.testing.assert_allclose(p_susc, reference, rtol=0.0, atol=1e-9 * numpy.abs(reference).max())
+
+    p_none = Engine.generateSusceptibilityMap(labelArray, self.direction, getSusceptibilityParam(suscCorrFFTPadding='none'))
+    numpy.testing.assert_array_equal(p_susc, p_none)
+
+  def test_PaddedApproximation(self):
+    # 'fast' and 'bbox' are opt-in approximations (see generateSusceptibilityMap())
+    labelArray = Benchmark.getNeedleLabel(self.shape)
+    reference = Engine.generateSusceptibilityMap(labelArray, self.direction, getSusceptibilityParam())
+    scale = numpy.abs(reference).max()
+    for padding, bound in (('fast', 0.05), ('bbox', 0.07)):
+      p_susc = Engine.generateSusceptibilityMap(labelArray, self.direction, getSusceptibilityParam(suscCorrFFTPadding=padding))
+      error = numpy.abs(p_susc - reference).max() / scale
+      self.assertGreater(error, 1e-3, padding)
+      self.assertLess(error, bound, padding)
+
+
+  def test_AnisotropicSpacing(self):
+    # Outside a sphere, the field is the analytic dipole field (R/r)^3 (3 cos^2(theta) - 1) / 3; on
+    # anisotropic voxels, the k-space grid has to be scaled by the voxel size to match it
+    param = getSusceptibilityParam(gamma=0.5 / numpy.pi, TE=1.0, deltaChi=1.0, B0=1.0)
+    spacing = (1.0, 1.0, 2.0)
+    z, y, x = numpy.ogrid[0:48, 0:96, 0:96]
+    z, y, x = (z - 23.5) * spacing[2], (y - 47.5) * spacing[1], (x - 47.5) * spacing[0]
+    r = numpy.sqrt(x*x + y*y + z*z)
+    labelArray = (r <= 10.0).astype(numpy.float64)
+    outside = (r > 15.0) & (r < 30.0)
+    analytic = ((10.0 / r)**3 * (3.0 * z*z / (r*r) - 1.0) / 3.0)[outside]
+    errors = []
+    for voxelSpacing in (None, spacing):
+      p_susc = Engine.generateSusceptibilityMap(labelArray, self.direction, param, spacing=voxelSpacing)
+      errors.append(numpy.abs(p_susc[outside] - analytic).max() / numpy.abs(analytic).max())
+    self.assertLess(errors[1], 0.15)
+    self.assertGreater(errors[0], 0.3)
+
+    # Isotropic voxels give the same kernel, whatever their size
+    kernelCache = Engine.DipoleKernelCache()
+    p_susc = Engine.generateSusceptibilityMap(labelArray, self.direction, param, kernelCache)
+    numpy.testing.assert_array_equal(
+      Engine.generateSusceptibilityMap(labelArray, self.direction, param, kernelCache, (1.5, 1.5, 1.5)), p_susc)
+    Engine.generateSusceptibilityMap(labelArray, self.direction, param, kernelCache, spacing)
+    Engine.generateSusceptibilityMap(labelArray, self.direction, param, kernelCache, (2.0, 2.0, 4.0))
+    self.assertEqual((kernelCache.hits, kernelCache.misses), (2, 2))
+
+  def test_KernelCache(self):
+    labelArray = Benchmark.getNeedleLabel((8, 80, 80))
+    param = getSusceptibilityParam()
+    kernelCache = Engine.DipoleKernelCache(maxSize=2)
+    p_susc = Engine.generateSusceptibilityMap(labelArray, self.direction, param, kernelCache)
+    numpy.testing.assert_array_equal(Engine.generateSusceptibilityMap(labelArray, self.direction, param, kernelCache), p_susc)
+    numpy.testing.assert_array_equal(Engine.generateSusceptibilityMap(labelArray, self.direction, param), p_susc)
+    self.assertEqual((kernelCache.hits, kernelCache.misses), (1, 1))
+
+    # Least recently used kernels are evicted
+    misses = kernelCache.misses
+    kernel = kernelCache.get((8, 80, 80), 0)
+    self.assertFalse(kernel.flags.writeable)
+    kernelCache.get((8, 80, 80), 1)
+    kernelCache.get((8, 80, 80), 2)
+    self.assertEqual(len(kernelCache.kernels), 2)
+    self.assertIsNot(kernelCache.get((8, 80, 80), 0), kernel)
+    self.assertEqual(kernelCache.misses, misses + 4)
+
+
+class SusceptibilityCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    z, y, x = numpy.ogrid[0:12, 0:48, 0:48]
+    self.grid = (z, y, x)
+    self.objectBaseline = (((z - 6)**2 / 36.0 + (y - 24)**2 / 400.0 + (x - 24)**2 / 400.0) <= 1.0).astype(numpy.int16) * 1000
+    self.param = getSusceptibilityParam(suscCorrMethod='auto')
+    self.direction = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+  def getObjectReference(self, length):
+    """Magnitude image with a needle (signal void) of 'length' voxels along x.
+    """
+    z, y, x = self.grid
+    needle = ((y - 24)**2 + (z - 6)**2 <= 4) & (x >= 6) & (x < 6 + length)
+    return (self.objectBaseline * ~needle).astype(numpy.int16)
+
+  def getLabel(self, cache, length, **kwargs):
+    return cache.getLabel(self.objectBaseline, self.getObjectReference(length), dict(self.param, **kwargs))
+
+  def test_Always(self):
+    cache = Engine.SusceptibilityCache()
+    label = self.getLabel(cache, 30)
+    self.assertFalse(label.flags.writeable)
+    # Unchanged images (new arrays with the same content) are not segmented again
+    self.assertIs(self.getLabel(cache, 30), label)
+    self.assertEqual((cache.misses, cache.hits), (1, 1))
+    # Any change is segmented, even if the label barely changes
+    changed = self.getLabel(cache, 31)
+    self.assertIsNot(changed, label)
+    self.assertGreater(numpy.count_nonzero(changed), numpy.count_nonzero(label))
+    self.assertEqual((cache.misses, cache.hits), (2, 1))
+
+    deltaPhase = cache.getMap(changed, self.direction, self.param)
+    self.assertIs(cache.getMap(changed.copy(), self.direction, self.param), deltaPhase)
+    cache.getMap(changed, self.direction, dict(self.param, TE=0.02))
+    cache.getMap(label, self.direction, dict(self.param, TE=0.02))
+    self.assertEqual((cache.mapMisses, cache.mapHits), (3, 1))
+    # Only anisotropic voxels change the map
+    cache.getMap(label, self.direction, dict(self.param, TE=0.02), spacing=(2.0, 2.0, 2.0))
+    cache.getMap(label, self.direction, dict(self.param, TE=0.02), spacing=(1.0, 1.0, 2.0))
+    self.assertEqual((cache.mapMisses, cache.mapHits), (4, 2))
+
+  def test_Interval(self):
+    cache = Engine.SusceptibilityCache()
+    label = self.getLabel(cache, 30, suscCorrResegment='interval', suscCorrResegmentInterval=3)
+    # The label is kept for 3 frames after the segmentation; unchanged images do not count
+    for length in (20, 20, 34):
+      self.assertIs(self.getLabel(cache, length, suscCorrResegment='interval', suscCorrResegmentInterval=3), label)
+    self.assertEqual((cache.misses, cache.hits, cache.framesSinceSegmentation), (1, 3, 3))
+    segmented = self.getLabel(cache, 20, suscCorrResegment='interval', suscCorrResegmentInterval=3)
+    self.assertIsNot(segmented, label)
+    self.assertEqual((cache.misses, cache.framesSinceSegmentation), (2, 1))
+    # A new volume size is always segmented
+    cache.getLabel(self.objectBaseline[:10], self.getObjectReference(20)[:10],
+                   dict(self.param, suscCorrResegment='interval', suscCorrResegmentInterval=3))
+    self.assertEqual(cache.misses, 3)
+
+  def test_Dice(self):
+    # The new images are segmented; the previous label is kept if the Dice coefficient is at least the threshold
+    label = Engine.segmentObject(self.objectBaseline, self.getObjectReference(30))
+    dice = Engine.getDiceCoefficient(label, Engine.segmentObject(self.objectBaseline, self.getObjectReference(31)))
+    self.assertGreater(dice, 0.95)
+    for threshold, kept in ((dice, True), (dice + 1e-9, False), (0.95, True)):
+      cache = Engine.SusceptibilityCache()
+      first = self.getLabel(cache, 30, suscCorrResegment='dice', suscCorrDiceThreshold=threshold)
+      deltaPhase = cache.getMap(first, self.direction, self.param)
+      second = self.getLabel(cache, 31, suscCorrResegment='dice', suscCorrDiceThreshold=threshold)
+      self.assertEqual(cache.misses, 2)
+      self.assertEqual(second is first, kept, threshold)
+      self.assertEqual(cache.getMap(second, self.direction, self.param) is deltaPhase, kept, threshold)
+
+    # A larger change replaces the label at the default threshold
+    cache = Engine.SusceptibilityCache()
+    first = self.getLabel(cache, 30, suscCorrResegment='dice')
+    self.assertIsNot(self.getLabel(cache, 20, suscCorrResegment='dice'), first)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.generator = Phantom.PhantomGenerator((8,32,32), frames=2)
+    self.scene = VolumeIO.MemoryScene()
+    self.volumeIO = VolumeIO.MemoryVolumeIO()
+    self.baselineNode = self.scene.addVolume('baseline', self.generator.getBaseline())
+    self.referenceNode = self.scene.addVolume('reference', self.generator.getReference(1))
+    self.param = dict(self.generator.getParam(), baselinePhaseVolumeNode=self.baselineNode,
+                      referencePhaseVolumeNode=self.referenceNode, tempMapVolumeNode=self.scene.addVolume('TempMap'),
+                      colorScaleMin=20.0, colorScaleMax=80.0, outputType='double')
+    self.engine = Engine.ThermometryEngine()
+    self.cache = Engine.ResultCache(self.volumeIO.getNodeKey)
+
+  def computeFrame(self, param):
+    return self.engine.run(self.volumeIO.pull(param['baselinePhaseVolumeNode']),
+                           self.volumeIO.pull(param['referencePhaseVolumeNode']), param, mask=self.generator.getMask(),
+                           objectLabel=self.generator.getObjectLabel())
+
+  def test_FinalStages(self):
+    param = dict(self.param, suscCorrMethod='off')
+    result = self.computeFrame(param)
+    self.assertIsNone(self.cache.lookup(param))
+    self.cache.store(param, result, geometry='geometry')
+
+    # Display-, threshold- and output-only changes reuse the phase difference and the temperature
+    entry = self.cache.lookup(dict(param, colorScaleMin=30.0, outputType='short', fftWorkers=2,
+                                   tempMapVolumeNode=self.scene.addVolume('TempMap2')))
+    self.assertEqual(entry['geometry'], 'geometry')
+    thresholdParam = dict(param, upperThreshold=50.0, lowerThreshold=40.0)
+    self.assertIs(self.cache.lookup(thresholdParam), entry)
+    cached = self.cache.getResult(self.engine, thresholdParam)
+    self.assertIs(cached.phaseDiff, result.phaseDiff)
+    self.assertIs(entry['temperature'], result.temperature)
+    numpy.testing.assert_array_equal(cached.temperature,
+                                     self.engine.thresholdTemperature(result.temperature, thresholdParam))
+    self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    # The PRF constants (without susceptibility correction) only convert the phase difference again
+    for name, value in (('TE', 0.02), ('B0', 1.5), ('alpha', -0.0094)):
+      changedParam = dict(param, **{name: value})
+      self.assertIsNotNone(self.cache.lookup(changedParam))
+      cached = self.cache.getResult(self.engine, changedParam)
+      self.assertIs(cached.phaseDiff, result.phaseDiff)
+      numpy.testing.assert_allclose(cached.temperature, self.computeFrame(changedParam).temperature, rtol=0.0, atol=1e-9)
+      self.assertFalse(numpy.allclose(cached.temperature, result.temperature), name)
+
+  def test_Invalidation(self):
+    param = dict(self.param, suscCorrMethod='manual')
+    self.cache.store(param, self.computeFrame(param))
+    self.assertIsNotNone(self.cache.lookup(dict(param, alpha=-0.0094, BT=20.0)))
+
+    # With susceptibility correction, TE, B0 and gamma also change the phase difference
+    for name, value in (('TE', 0.02), ('B0', 1.5), ('gamma', 40.0), ('usePhaseUnwrapping', True),
+                        ('suscCorrMethod', 'off')):
+      self.assertIsNone(self.cache.lookup(dict(param, **{name: value})), name)
+
+    # Another or a modified input node
+    otherNode = self.scene.addVolume('reference2', self.generator.getReference(0))
+    self.assertIsNone(self.cache.lookup(dict(param, referencePhaseVolumeNode=otherNode)))
+    self.assertIsNotNone(self.cache.lookup(param))
+    self.volumeIO.push(self.referenceNode, self.generator.getReference(0))
+    self.assertIsNone(self.cache.lookup(param))
+    self.cache.clear()
+    self.assertIsNone(self.cache.lookup(param))
+
+
+class TemperatureTest(unittest.TestCase):
+
+  def test_DoseAboveThreshold(self):
+    # Voxels above the upper threshold are set to 0 in the temperature map, but still gain dose
+    generator = Phantom.PhantomGenerator((8,32,32), frames=4)
+    param = dict(generator.getParam(), upperThreshold=50.0)
+    engine = Engine.ThermometryEngine()
+    result = engine.runSeries(generator.getBaseline(), generator.getReferenceSeries(), param,
+                              mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    hottest = numpy.unravel_index(numpy.argmax(generator.getTemperature(3)), result.temperature.shape[1:])
+    self.assertEqual(result.temperature[-1][hottest], 0.0)
+
+    temperature = engine.convertTemperature(result.phaseDiff, param)
+    self.assertGreater(temperature[-1][hottest], 50.0)
+    numpy.testing.assert_array_equal(engine.thresholdTemperature(temperature, param), result.temperature)
+
+    accumulator = Engine.DoseAccumulator()
+    for i in range(generator.frames):
+      dose = accumulator.update(temperature[i], float(i))
+    self.assertGreater(dose[hottest], 10.0)
+
+
+class OutputFormatTest(unittest.TestCase):
+
+  def test_ShortOutput(self):
+    temperature = numpy.array([[[37.0, 42.13, 90.0]]])
+    param = {'outputType': 'short', 'outputScale': 0.01, 'outputOffset': 0.0}
+    stored = Engine.quantizeTemperature(temperature, param)
+    self.assertEqual(stored.dtype, numpy.int16)
+    self.assertEqual(stored[0, 0, 1], 4213)
+
+    metaData = Engine.getOutputMetaData(param)
+    self.assertEqual(metaData[Engine.outputUnitsKey], '0.01 deg C')
+    numpy.testing.assert_allclose(Engine.dequantizeTemperature(stored, *Engine.getOutputScale(metaData)), temperature)
+
+  def test_Units(self):
+    self.assertEqual(Engine.getOutputMetaData({})[Engine.outputUnitsKey], 'deg C')
+    self.assertEqual(Engine.getOutputUnits(0.05, 20.0), '0.05 deg C, offset 20 deg C')
+
+
+if __name__ == '__main__':
+  unittest.main()
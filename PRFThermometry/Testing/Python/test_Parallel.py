@@ -0,0 +1,60 @@
+"""Tests of PRFThermometryLib.Parallel that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Engine, Parallel, Phantom
+
+
+class FrameExecutorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.generator = Phantom.PhantomGenerator((8,32,32), frames=3)
+    self.param = dict(self.generator.getParam(), suscCorrMethod='off')
+    self.engine = Engine.ThermometryEngine()
+    self.cachedBaseline = self.engine.prepareBaseline(self.generator.getBaseline(), self.param, self.generator.getMask())
+
+  def test_WorkerParam(self):
+    # Objects of the caller (e.g. volume nodes) are not passed to the process pool
+    param = dict(self.param, baselinePhaseVolumeNode=threading.Lock(), maskVolumeNode=None,
+                 nodes=[threading.Lock()], B0vec=[0.0, 0.0, 1.0])
+    workerParam = Parallel.getWorkerParam(param)
+    self.assertNotIn('baselinePhaseVolumeNode', workerParam)
+    self.assertNotIn('nodes', workerParam)
+    self.assertIsNone(workerParam['maskVolumeNode'])
+    self.assertEqual(workerParam['B0vec'], [0.0, 0.0, 1.0])
+    pickle.dumps(workerParam)
+
+  def test_Modes(self):
+    referenceSeries = self.generator.getReferenceSeries()
+    param = dict(self.param, referencePhaseVolumeNode=threading.Lock())
+    serial = self.engine.computePhaseDifferenceSeriesFromBaseline(self.cachedBaseline, referenceSeries, param)
+    for mode in ('thread', 'process'):
+      phaseDiff = Parallel.FrameExecutor(2, mode).computePhaseDifferences(self.engine, self.cachedBaseline,
+                                                                          referenceSeries, param)
+      numpy.testing.assert_allclose(phaseDiff, serial, rtol=0.0, atol=1e-12, err_msg=mode)
+
+    # The arguments of the workers are pickled unless they are forked (e.g. on Windows and macOS)
+    startMethod = multiprocessing.get_start_method()
+    multiprocessing.set_start_method('spawn', force=True)
+    try:
+      phaseDiff = Parallel.FrameExecutor(2, 'process').computePhaseDifferences(self.engine, self.cachedBaseline,
+                                                                               referenceSeries, param)
+    finally:
+      multiprocessing.set_start_method(startMethod, force=True)
+    numpy.testing.assert_allclose(phaseDiff, serial, rtol=0.0, atol=1e-12)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,55 @@
+"""Tests of PRFThermometryLib.Phantom that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Engine, Phantom
+
+
+class PhantomGeneratorTest(unittest.TestCase):
+
+  def test_EncodePhase(self):
+    # encodePhase() is the inverse of Engine.scalePhase() (to the resolution of the raw values)
+    phase = numpy.linspace(-numpy.pi + 0.01, numpy.pi - 0.01, 101)
+    for scalarType, resolution in (('short', numpy.pi / 4096.0), ('unsigned short', numpy.pi / 2048.0)):
+      decoded = Engine.scalePhase(Phantom.encodePhase(phase, scalarType), scalarType)
+      numpy.testing.assert_allclose(decoded, phase, rtol=0.0, atol=0.5 * resolution + 1e-12, err_msg=scalarType)
+    # The phase is wrapped first
+    numpy.testing.assert_array_equal(Phantom.encodePhase(phase + 2.0 * numpy.pi), Phantom.encodePhase(phase))
+
+  def test_Reproducible(self):
+    generator = Phantom.PhantomGenerator((8,32,32), frames=4, drift=0.1, seed=3)
+    series = generator.getReferenceSeries()
+    self.assertEqual(series.shape, (4, 8, 32, 32))
+    self.assertEqual(series.dtype, numpy.int16)
+    # The frames do not depend on the order in which they are generated
+    numpy.testing.assert_array_equal(generator.getReference(2), series[2])
+    numpy.testing.assert_array_equal(generator.getReferenceSeries(1, 3), series[1:3])
+    numpy.testing.assert_array_equal(numpy.array(list(generator.iterReferences())), series)
+    other = Phantom.PhantomGenerator((8,32,32), frames=4, drift=0.1, seed=3)
+    numpy.testing.assert_array_equal(other.getReferenceSeries(), series)
+    self.assertFalse(numpy.array_equal(Phantom.PhantomGenerator((8,32,32), frames=4, seed=4).getReference(0),
+                                       generator.getReference(0)))
+
+  def test_GroundTruth(self):
+    generator = Phantom.PhantomGenerator((8,32,32), frames=4, peakHeating=20.0, susceptibility=False, noise=0.0)
+    self.assertEqual(generator.getParam()['suscCorrMethod'], 'off')
+    self.assertFalse(numpy.any(generator.getObjectLabel()))
+    self.assertAlmostEqual(generator.getHeating(3), 20.0)
+
+    result = Engine.ThermometryEngine().run(generator.getBaseline(), generator.getReference(3), generator.getParam(),
+                                            mask=generator.getMask())
+    error = numpy.abs(result.temperature - generator.getTemperature(3))[generator.getEvaluationMask()]
+    self.assertLess(error.max(), 0.1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,102 @@
+"""Tests of PRFThermometryLib.Profiling that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Engine, Phantom, Profiling
+
+
+class PipelineProfilerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.generator = Phantom.PhantomGenerator((8,32,32), frames=2)
+    self.param = dict(self.generator.getParam(), upperThreshold=100.0, lowerThreshold=-100.0)
+
+  def runFrame(self, engine, profiler, label):
+    frame = profiler.beginFrame(label)
+    with profiler.activate(frame):
+      engine.run(self.generator.getBaseline(), self.generator.getReference(1), self.param, mask=self.generator.getMask(),
+                 objectLabel=self.generator.getObjectLabel())
+    profiler.endFrame(frame)
+    return frame
+
+  def test_Stages(self):
+    profiler = Profiling.PipelineProfiler()
+    completed = []
+    profiler.addCallback(completed.append)
+    engine = Engine.ThermometryEngine(profiler=profiler)
+    frame = self.runFrame(engine, profiler, 'frame 0')
+
+    self.assertEqual(completed, [frame])
+    for stage in ('scale', 'unwrap', 'complexDifference', 'susceptibility', 'temperature', 'threshold'):
+      self.assertIn(stage, frame.stages)
+    self.assertGreaterEqual(frame.totalTime, sum(frame.stages.values()) - 1e-6)
+
+    summary = profiler.getSummary()
+    self.assertEqual(summary['temperature']['count'], 1)
+    self.assertAlmostEqual(summary['temperature']['totalTime'], frame.stages['temperature'])
+
+  def test_Threads(self):
+    # Stages run on another thread are recorded for the frame activated there
+    profiler = Profiling.PipelineProfiler()
+    engine = Engine.ThermometryEngine(profiler=profiler)
+    frame = profiler.beginFrame('worker')
+
+    def work():
+      with profiler.activate(frame):
+        engine.run(self.generator.getBaseline(), self.generator.getReference(1), dict(self.param, suscCorrMethod='off'),
+                   mask=self.generator.getMask())
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    with profiler.stage('push'):
+      pass
+    profiler.endFrame(frame)
+    self.assertIn('complexDifference', frame.stages)
+    self.assertNotIn('push', frame.stages)
+    self.assertIsNone(profiler.records[-1].frame)
+
+  def test_Disabled(self):
+    profiler = Profiling.PipelineProfiler(enabled=False)
+    engine = Engine.ThermometryEngine(profiler=profiler)
+    self.assertIsNone(self.runFrame(engine, profiler, 'frame 0'))
+    self.assertEqual(profiler.records, [])
+    self.assertEqual(profiler.frames, [])
+
+  def test_Export(self):
+    profiler = Profiling.PipelineProfiler()
+    engine = Engine.ThermometryEngine(profiler=profiler)
+    for i in range(2):
+      self.runFrame(engine, profiler, 'frame %d' % i)
+
+    directory = tempfile.mkdtemp()
+    try:
+      profiler.exportCSV(os.path.join(directory, 'profile.csv'))
+      profiler.exportJSON(os.path.join(directory, 'profile.json'))
+      with open(os.path.join(directory, 'profile.csv'), newline='') as f:
+        rows = list(csv.DictReader(f))
+      with open(os.path.join(directory, 'profile.json')) as f:
+        profile = json.load(f)
+    finally:
+      shutil.rmtree(directory)
+
+    self.assertEqual(len(rows), len(profiler.records))
+    self.assertEqual(set(row['label'] for row in rows), {'frame 0', 'frame 1'})
+    self.assertEqual([frame['label'] for frame in profile['frames']], ['frame 0', 'frame 1'])
+    self.assertEqual(profile['summary']['temperature']['count'], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+"""Tests of PRFThermometryLib.RealTime that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import RealTime
+
+
+def waitFor(condition, timeout=10.0):
+  end = time.time() + timeout
+  while not condition():
+    if time.time() > end:
+      raise AssertionError('Timeout')
+    time.sleep(0.001)
+
+
+class LatestFramePipelineTest(unittest.TestCase):
+
+  def test_LatestFrameWins(self):
+    started = threading.Event()
+    release = threading.Event()
+    processed = []
+
+    def process(frame):
+      started.set()
+      release.wait(10.0)
+      processed.append(frame)
+      if frame == 'fail':
+        raise ValueError(frame)
+      return frame * 10
+
+    pipeline = RealTime.LatestFramePipeline(process)
+    pipeline.start()
+    try:
+      # Frames submitted while frame 0 is processed replace each other; only the newest is processed
+      pipeline.submit(0)
+      started.wait(10.0)
+      for frame in range(1, 6):
+        pipeline.submit(frame)
+      release.set()
+      waitFor(lambda: pipeline.getStatistics()['processed'] == 2)
+      frame, result, latency = pipeline.takeResult()
+      self.assertEqual((frame, result), (5, 50))
+      self.assertGreater(latency, 0.0)
+      self.assertIsNone(pipeline.takeResult())
+      self.assertEqual(processed, [0, 5])
+
+      stat = pipeline.getStatistics()
+      self.assertEqual(stat['submitted'], 6)
+      self.assertEqual(stat['dropped'], 5)  # frames 1-4, and the result of frame 0 (never taken)
+
+      # A failing frame is counted, and the worker keeps running
+      pipeline.submit('fail')
+      waitFor(lambda: pipeline.getStatistics()['failed'] == 1)
+      pipeline.submit(7)
+      waitFor(lambda: pipeline.getStatistics()['processed'] == 3)
+      self.assertEqual(pipeline.takeResult()[1], 70)
+    finally:
+      pipeline.stop(10.0)
+    self.assertFalse(pipeline.isRunning())
+
+
+if __name__ == '__main__':
+  unittest.main()
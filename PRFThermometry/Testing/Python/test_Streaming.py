@@ -0,0 +1,200 @@
+"""Tests of PRFThermometryLib.Streaming that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Engine, Phantom, Streaming
+
+
+class SeriesInputTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.generator = Phantom.PhantomGenerator((8,32,32), frames=5, peakHeating=20.0)
+    self.series = self.generator.getReferenceSeries()
+    self.geometry = Engine.VolumeGeometry((10.0, -20.0, 5.0), (1.5, 1.5, 3.0), (0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def writeSeries(self, fileName, useCompression=False):
+    path = os.path.join(self.directory, fileName)
+    sitk.WriteImage(sitk.JoinSeries([self.geometry.toImage(frame) for frame in self.series]), path, useCompression)
+    return path
+
+  def assertSeries(self, series, checkGeometry=True):
+    try:
+      self.assertEqual(len(series), self.series.shape[0])
+      self.assertEqual(series.frameShape, self.series.shape[1:])
+      self.assertEqual(series.scalarType, 'short')
+      numpy.testing.assert_array_equal(series[3], self.series[3])
+      numpy.testing.assert_array_equal(series[-1], self.series[-1])
+      numpy.testing.assert_array_equal(series[1:4], self.series[1:4])
+      numpy.testing.assert_array_equal(series[::2], self.series[::2])
+      numpy.testing.assert_array_equal(numpy.array(list(series)), self.series)
+      with self.assertRaises(IndexError):
+        series[5]
+      if checkGeometry:
+        numpy.testing.assert_allclose(series.geometry.origin, self.geometry.origin, atol=1e-6)
+        numpy.testing.assert_allclose(series.geometry.spacing, self.geometry.spacing, atol=1e-6)
+        numpy.testing.assert_allclose(series.geometry.direction, self.geometry.direction, atol=1e-6)
+    finally:
+      series.close()
+
+  def test_Nrrd(self):
+    series = Streaming.openSeries(self.writeSeries('reference.nrrd'))
+    self.assertIsInstance(series, Streaming.MemoryMappedSeries)
+    self.assertSeries(series)
+    series = Streaming.openSeries(self.writeSeries('reference-gzip.nrrd', useCompression=True))
+    self.assertIsInstance(series, Streaming.GzipSeries)
+    self.assertSeries(series)
+
+  def test_OtherFormats(self):
+    series = Streaming.openSeries(self.writeSeries('reference.nii.gz'))
+    self.assertIsInstance(series, Streaming.ExtractSeries)
+    self.assertSeries(series)
+
+    paths = []
+    for i, frame in enumerate(self.series):
+      paths.append(os.path.join(self.directory, 'frame%02d.mha' % i))
+      sitk.WriteImage(self.geometry.toImage(frame), paths[-1])
+    self.assertSeries(Streaming.openSeries(paths))
+    self.assertSeries(Streaming.openSeries(os.path.join(self.directory, 'frame*.mha')))
+
+    path = os.path.join(self.directory, 'reference.raw')
+    with open(path, 'wb') as f:
+      f.write(b'header')
+      f.write(self.series.tobytes())
+    self.assertSeries(Streaming.openRaw(path, self.series.shape[1:], numpy.int16, offset=6), checkGeometry=False)
+
+  def test_IterSeries(self):
+    # The chunks of a lazily read series give the temperature of runSeries()
+    generator = self.generator
+    param = dict(generator.getParam(), temporalUnwrapping=True)
+    expected = Engine.ThermometryEngine().runSeries(generator.getBaseline(), self.series, param, mask=generator.getMask(),
+                                                    scalarType='short', objectLabel=generator.getObjectLabel()).temperature
+    series = Streaming.openSeries(self.writeSeries('reference.nrrd'))
+    try:
+      temperature = numpy.empty_like(expected)
+      for start, result in Engine.ThermometryEngine().iterSeries(generator.getBaseline(), series, param,
+                                                                 mask=generator.getMask(), scalarType=series.scalarType,
+                                                                 objectLabel=generator.getObjectLabel(), chunkSize=2):
+        temperature[start:start + result.temperature.shape[0]] = result.temperature
+    finally:
+      series.close()
+    numpy.testing.assert_allclose(temperature, expected, rtol=0.0, atol=1e-9)
+
+
+class FrameWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'TempMap.nhdr')
+    self.frames = numpy.random.default_rng(0).normal(40.0, 5.0, (5, 3, 4, 6)).astype(numpy.float32)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_RoundTrip(self):
+    geometry = Engine.VolumeGeometry((10.0, -20.0, 5.0), (1.5, 2.0, 3.0), (0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+    with Streaming.FrameWriter(self.path, self.frames.shape[1:], numpy.float32, geometry, indexName='time',
+                               indexUnit='s') as writer:
+      for i, frame in enumerate(self.frames):
+        writer.append(frame, '%g' % (2.5 * i))
+        if i == 1:
+          # The file can be read while it is being written
+          series = Streaming.openSeries(self.path)
+          self.assertEqual(len(series), 2)
+          series.close()
+    self.assertEqual(len(writer), self.frames.shape[0])
+
+    series = Streaming.openSeries(self.path)
+    try:
+      self.assertEqual(len(series), self.frames.shape[0])
+      self.assertEqual(series.frameShape, self.frames.shape[1:])
+      numpy.testing.assert_array_equal(series.getFrames(0, len(series)), self.frames)
+      numpy.testing.assert_allclose(series.geometry.origin, geometry.origin)
+      numpy.testing.assert_allclose(series.geometry.spacing, geometry.spacing)
+      numpy.testing.assert_allclose(series.geometry.direction, geometry.direction)
+      self.assertEqual(series.indexName, 'time')
+      self.assertEqual(series.indexUnit, 's')
+      self.assertEqual(series.indexValues, ['0', '2.5', '5', '7.5', '10'])
+    finally:
+      series.close()
+
+    # The header is a regular NRRD file (ITK reads the frames as the components of a vector image)
+    image = sitk.ReadImage(self.path)
+    self.assertEqual((image.GetSize(), image.GetNumberOfComponentsPerPixel()), ((6, 4, 3), 5))
+    numpy.testing.assert_array_equal(sitk.GetArrayFromImage(image)[..., 3], self.frames[3])
+
+    # Without 'resume', the frame file is overwritten
+    with Streaming.FrameWriter(self.path, self.frames.shape[1:]) as writer:
+      writer.append(self.frames[4])
+    series = Streaming.openSeries(self.path)
+    try:
+      self.assertEqual(len(series), 1)
+      self.assertEqual(series.indexValues, ['0'])
+      numpy.testing.assert_array_equal(series[0], self.frames[4])
+    finally:
+      series.close()
+
+  def test_Resume(self):
+    # A crash left an incomplete last frame and an incomplete index record
+    with Streaming.FrameWriter(self.path, self.frames.shape[1:]) as writer:
+      writer.extend(self.frames[:3])
+    headerPath, dataPath, indexPath = Streaming.getFrameFilePaths(self.path)
+    with open(dataPath, 'ab') as f:
+      f.write(self.frames[3].tobytes()[:50])
+    with open(indexPath, 'a') as f:
+      f.write('{"val')
+
+    with Streaming.FrameWriter(self.path, self.frames.shape[1:], resume=True) as writer:
+      self.assertEqual(len(writer), 3)
+      writer.extend(self.frames[3:])
+    self.assertEqual(os.path.getsize(dataPath), self.frames.nbytes)
+    self.assertEqual(Streaming.readFrameIndex(indexPath), ('frame', '', ['0', '1', '2', '3', '4']))
+
+    series = Streaming.openSeries(self.path)
+    try:
+      self.assertEqual(len(series), self.frames.shape[0])
+      numpy.testing.assert_array_equal(series.getFrames(0, len(series)), self.frames)
+    finally:
+      series.close()
+
+  def test_ResumeMetaData(self):
+    # The header fields of the first run are kept when the file is resumed without them
+    metaData = Engine.getOutputMetaData({'outputType': 'short', 'outputScale': 0.01})
+    with Streaming.FrameWriter(self.path, self.frames.shape[1:], numpy.int16, metaData=metaData) as writer:
+      writer.extend(Engine.quantizeTemperature(self.frames[:2], {'outputType': 'short'}))
+    with Streaming.FrameWriter(self.path, self.frames.shape[1:], numpy.int16, resume=True,
+                               metaData={'Comment': 'resumed'}) as writer:
+      writer.extend(Engine.quantizeTemperature(self.frames[2:], {'outputType': 'short'}))
+
+    keyValues = Streaming.readNrrdKeyValues(self.path)
+    for key, value in metaData.items():
+      self.assertEqual(keyValues[key], value)
+    self.assertEqual(keyValues['Comment'], 'resumed')
+
+    series = Streaming.openSeries(self.path)
+    try:
+      self.assertEqual(len(series), self.frames.shape[0])
+      scale, offset = Engine.getOutputScale(series.metaData)
+      temperature = Engine.dequantizeTemperature(series.getFrames(0, len(series)), scale, offset)
+    finally:
+      series.close()
+    numpy.testing.assert_allclose(temperature, self.frames, atol=0.005 + 1e-6)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+"""Tests of the phase unwrapping (Engine.unwrap(), PRFThermometryLib.Unwrapping) that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Engine, Unwrapping
+
+
+class UnwrapTest(unittest.TestCase):
+
+  def setUp(self):
+    z, y, x = numpy.mgrid[0:6, 0:40, 0:40]
+    # A smooth phase that wraps several times (at most 0.8 rad between neighbors)
+    self.truth = 0.02 * ((x - 20)**2 + (y - 18)**2) + 0.3 * z
+    self.wrapped = Unwrapping.wrap(self.truth)
+    self.mask = (x - 20)**2 + (y - 20)**2 < 15**2
+
+  def assertUnwrapped(self, unwrapped, inside=None, msg=None):
+    # Equal to the true phase up to a global offset of 2*pi*N
+    difference = unwrapped - self.truth
+    if inside is not None:
+      difference = difference[inside]
+    offset = difference.flat[0]
+    self.assertAlmostEqual(offset / (2.0 * numpy.pi), round(offset / (2.0 * numpy.pi)), places=6, msg=msg)
+    numpy.testing.assert_allclose(difference, offset, rtol=0.0, atol=1e-6, err_msg=msg)
+
+  def test_MaskedUnwrapping(self):
+    # Noise outside the mask does not affect the voxels inside, and is left unchanged
+    wrapped = self.wrapped.copy()
+    noise = numpy.random.default_rng(0).uniform(-numpy.pi, numpy.pi, wrapped.shape)
+    wrapped[~self.mask] = noise[~self.mask]
+    unwrapped = Engine.unwrap(wrapped, self.mask)
+    self.assertUnwrapped(unwrapped, self.mask)
+    numpy.testing.assert_array_equal(unwrapped[~self.mask], wrapped[~self.mask])
+
+    # An empty mask leaves the phase unchanged
+    numpy.testing.assert_array_equal(Engine.unwrap(wrapped, numpy.zeros(wrapped.shape, dtype=bool)), wrapped)
+
+
+  def test_Backends(self):
+    # All backends give the same unwrapped phase (up to 2*pi*N), with and without a mask
+    self.assertIn('laplacian', Unwrapping.getUnwrapperNames())
+    for method in Unwrapping.getUnwrapperNames():
+      self.assertUnwrapped(Engine.unwrap(self.wrapped, None, method), msg=method)
+      self.assertUnwrapped(Engine.unwrap(self.wrapped, self.mask, method), self.mask, msg=method)
+
+  def test_LaplacianCongruence(self):
+    # The least-squares solution is made congruent with the input: input + 2*pi*N at every voxel
+    unwrapped = Unwrapping.getUnwrapper('laplacian')(self.wrapped)
+    cycles = (unwrapped - self.wrapped) / (2.0 * numpy.pi)
+    numpy.testing.assert_allclose(cycles, numpy.round(cycles), rtol=0.0, atol=1e-9)
+
+  def test_UnknownMethod(self):
+    with self.assertRaises(ValueError):
+      Engine.unwrap(self.wrapped, method='unknown')
+
+
+  def test_TemporalUnwrapping(self):
+    # The next frame changes by less than pi/2: each voxel follows the previous frame
+    change = 0.5 * numpy.sin(numpy.linspace(0.0, numpy.pi, self.truth.size)).reshape(self.truth.shape)
+    unwrapped = Engine.unwrapTemporal(Unwrapping.wrap(self.truth + change), self.truth)
+    numpy.testing.assert_allclose(unwrapped, self.truth + change, rtol=0.0, atol=1e-9)
+
+    # A few voxels that change by more than pi/2 are unwrapped spatially
+    change[2, 10:13, 10:13] = 2.5
+    unwrapped = Engine.unwrapTemporal(Unwrapping.wrap(self.truth + change), self.truth)
+    numpy.testing.assert_allclose(unwrapped, self.truth + change, rtol=0.0, atol=1e-9)
+
+    # Otherwise, the whole frame is unwrapped spatially and aligned to the previous frame
+    unwrapped = Engine.unwrapTemporal(self.wrapped, self.truth + 2.5)
+    numpy.testing.assert_allclose(unwrapped, self.truth, rtol=0.0, atol=1e-9)
+
+
+class PhaseOffsetTest(unittest.TestCase):
+
+  def searchPhaseOffset(self, baselinePhase, referencePhase, nList=range(-4, 4)):
+    # Search of the original implementation: the pi*N with the smallest mean difference
+    meanDiff = [abs(numpy.mean(referencePhase + numpy.pi * n - baselinePhase)) for n in nList]
+    return referencePhase + numpy.pi * nList[int(numpy.argmin(meanDiff))]
+
+  def test_ClosedFormEqualsSearch(self):
+    rng = numpy.random.default_rng(0)
+    baselinePhase = rng.normal(0.0, 0.5, (4, 16, 16))
+    for n in range(-4, 4):
+      referencePhase = baselinePhase + rng.normal(0.2, 0.3, baselinePhase.shape) - numpy.pi * n
+      aligned = Engine.alignPhaseOffset(baselinePhase, referencePhase)
+      numpy.testing.assert_allclose(aligned, self.searchPhaseOffset(baselinePhase, referencePhase), rtol=0.0, atol=1e-12)
+    # Not limited to the searched range
+    numpy.testing.assert_allclose(Engine.alignPhaseOffset(baselinePhase, baselinePhase - 12 * numpy.pi), baselinePhase,
+                                  rtol=0.0, atol=1e-12)
+
+  def test_MedianEstimator(self):
+    # The median ignores the voxels of a wrong unwrapping region; the mean is pulled away
+    baselinePhase = numpy.zeros((4, 16, 16))
+    referencePhase = baselinePhase - 2.0 * numpy.pi
+    referencePhase[:, :6] += 8.0 * numpy.pi
+    aligned = Engine.alignPhaseOffset(baselinePhase, referencePhase, estimator='median', step=2.0 * numpy.pi)
+    numpy.testing.assert_allclose(aligned[:, 6:], 0.0, atol=1e-12)
+
+    # Only the voxels inside the mask are used
+    mask = numpy.zeros(baselinePhase.shape, dtype=bool)
+    mask[:, :6] = True
+    aligned = Engine.alignPhaseOffset(baselinePhase, referencePhase, mask, step=2.0 * numpy.pi)
+    numpy.testing.assert_allclose(aligned[mask], 0.0, atol=1e-12)
+
+
+if __name__ == '__main__':
+  unittest.main()
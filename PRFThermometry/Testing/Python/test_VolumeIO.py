@@ -0,0 +1,115 @@
+"""Tests of PRFThermometryLib.VolumeIO that run without Slicer:
+
+  python -m pytest PRFThermometry/Testing/Python
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from PRFThermometryLib import Engine, Phantom, VolumeIO
+
+
+class MemoryVolumeIOTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scene = VolumeIO.MemoryScene()
+    self.volumeIO = VolumeIO.MemoryVolumeIO()
+    self.geometry = Engine.VolumeGeometry((10.0, -20.0, 5.0), (1.5, 1.5, 3.0), (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+
+  def test_PullPush(self):
+    # A frame is viewed, not copied; the temperature is copied once, into the buffer of the output node
+    generator = Phantom.PhantomGenerator((8,32,32), frames=2)
+    referenceNode = self.scene.addVolume('reference', generator.getReference(1), self.geometry)
+    tempMapNode = self.scene.addVolume('TempMap', numpy.zeros(generator.shape))
+    buffer = tempMapNode.array
+
+    reference = self.volumeIO.pull(referenceNode)
+    self.assertTrue(numpy.shares_memory(reference, referenceNode.array))
+    self.assertFalse(reference.flags.writeable)
+    self.assertEqual(self.volumeIO.getScalarType(referenceNode), 'short')
+    result = Engine.ThermometryEngine().run(generator.getBaseline(), reference, generator.getParam(),
+                                            mask=generator.getMask(), objectLabel=generator.getObjectLabel())
+    mtime = tempMapNode.GetMTime()
+    self.volumeIO.push(tempMapNode, result.temperature, self.volumeIO.getGeometry(referenceNode))
+
+    self.assertEqual(self.volumeIO.getCounts(), {'views': 1, 'copies': 1, 'bytesCopied': result.temperature.nbytes})
+    self.assertIs(tempMapNode.array, buffer)
+    numpy.testing.assert_array_equal(tempMapNode.array, result.temperature)
+    self.assertEqual(tempMapNode.geometry, self.geometry)
+    self.assertGreater(tempMapNode.GetMTime(), mtime)
+    self.assertIs(self.scene.getNodeByID(tempMapNode.GetID()), tempMapNode)
+    self.assertEqual(self.scene.getNodesByName('TempMap'), [tempMapNode])
+
+  def test_InPlace(self):
+    node = self.scene.addVolume('TempMap', numpy.zeros((4, 5, 6)))
+    buffer = node.array
+
+    # An array that already is the voxel buffer is not copied, but the node is marked modified
+    buffer[1] = 37.0
+    mtime = node.GetMTime()
+    self.volumeIO.push(node, buffer)
+    self.assertGreater(node.GetMTime(), mtime)
+    self.assertEqual(self.volumeIO.copies, 0)
+
+    # A matching array is copied into the buffer
+    self.volumeIO.push(node, numpy.full((4, 5, 6), 40.0))
+    self.assertIs(node.array, buffer)
+    self.assertTrue(numpy.all(buffer == 40.0))
+    self.assertEqual(self.volumeIO.copies, 1)
+
+    # Another shape or type replaces the buffer (without a copy in memory)
+    temperature = numpy.full((4, 5, 6), 45.0, dtype=numpy.float32)
+    self.volumeIO.push(node, temperature)
+    self.assertIs(node.array, temperature)
+    self.assertEqual(self.volumeIO.getScalarType(node), 'float')
+    self.assertEqual(self.volumeIO.copies, 1)
+
+    # A node without data
+    emptyNode = self.scene.addVolume('empty')
+    self.assertIsNone(self.volumeIO.pull(emptyNode))
+    self.assertEqual(self.volumeIO.getScalarType(emptyNode), '')
+    self.volumeIO.push(emptyNode, temperature)
+    self.assertIs(emptyNode.array, temperature)
+    self.assertEqual(self.volumeIO.getCounts(), {'views': 0, 'copies': 1, 'bytesCopied': temperature.nbytes * 2})
+
+  def test_Copies(self):
+    array = numpy.arange(4 * 5 * 6, dtype=numpy.int16).reshape(4, 5, 6)
+    node = self.scene.addVolume('phase', array)
+
+    # Requested copies and converted voxel types
+    copy = self.volumeIO.pull(node, copy=True)
+    self.assertFalse(numpy.shares_memory(copy, array))
+    converted = self.volumeIO.pull(node, numpy.float64)
+    self.assertEqual(converted.dtype, numpy.float64)
+    numpy.testing.assert_array_equal(converted, array)
+    self.assertEqual((self.volumeIO.views, self.volumeIO.copies), (0, 2))
+    self.volumeIO.pull(node, numpy.int16)
+    self.assertEqual((self.volumeIO.views, self.volumeIO.copies), (1, 2))
+
+    # Non-contiguous voxels are copied to a C-contiguous array
+    self.volumeIO.resetCounts()
+    strided = self.scene.addVolume('strided', array[:, :, ::2])
+    transposed = self.scene.addVolume('transposed', array.transpose(2, 1, 0))
+    for stridedNode in (strided, transposed):
+      pulled = self.volumeIO.pull(stridedNode)
+      self.assertTrue(pulled.flags.c_contiguous)
+      numpy.testing.assert_array_equal(pulled, stridedNode.array)
+    self.assertEqual(self.volumeIO.getCounts(), {'views': 0, 'copies': 2,
+                                                 'bytesCopied': strided.array.nbytes + transposed.array.nbytes})
+
+    # ... and so is a non-contiguous array that replaces the buffer of a node
+    self.volumeIO.resetCounts()
+    outputNode = self.scene.addVolume('output')
+    self.volumeIO.push(outputNode, array[:, ::2])
+    self.assertTrue(outputNode.array.flags.c_contiguous)
+    numpy.testing.assert_array_equal(outputNode.array, array[:, ::2])
+    self.assertEqual(self.volumeIO.copies, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()